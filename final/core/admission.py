@@ -0,0 +1,156 @@
+import math
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from time import time
+
+class Overloaded(Exception):
+    """
+    受け付けられないときに返す
+    retry_after秒後に再送してもらう
+    """
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TokenBucket(object):
+    """
+    1秒あたりrate個のトークンが貯まり，最大burst個まで貯められるバケット
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+
+    def take(self, n: float = 1.0) -> bool:
+        now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def retry_after(self, n: float = 1.0) -> float:
+        """
+        n個のトークンが貯まるまでの秒数
+        """
+        return max(0.0, (n - self.tokens) / self.rate)
+
+class RateLimiter(object):
+    """
+    クライアントごとのトークンバケット
+    バケットは最近使ったmax_clients件だけを保持する
+    """
+    def __init__(self, rate: float, burst: float, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def check(self, client: str):
+        """
+        クライアントのリクエストを受け付けるか判定する
+        受け付けられなければOverloadedを返す
+        """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            bucket = self.buckets.get(client)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self.buckets[client] = bucket
+                while len(self.buckets) > self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(client)
+            if bucket.take():
+                return
+            self.rejected += 1
+            raise Overloaded('rate limit exceeded', bucket.retry_after())
+
+    def metrics(self) -> dict:
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'clients': len(self.buckets),
+            'rejected': self.rejected,
+        }
+
+class WorkQueue(object):
+    """
+    上限付きのキューと処理するスレッド
+    キューがいっぱいのときはすぐにOverloadedを返し，処理を待たせない
+    """
+    # 処理時間の移動平均の重み
+    SERVICE_TIME_WEIGHT = 0.2
+
+    def __init__(self, name: str, workers: int = 1, maxsize: int = 100):
+        self.name = name
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.service_time = 0.0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        for i in range(workers):
+            thread = threading.Thread(target=self.run, name=f'{name}-{i}', daemon=True)
+            thread.start()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            self.queue.put_nowait((future, fn, args, kwargs))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise Overloaded(f'{self.name} queue is full', self.retry_after())
+        with self.lock:
+            self.submitted += 1
+        return future
+
+    def run(self):
+        while True:
+            future, fn, args, kwargs = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                self.in_flight += 1
+            start = time()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as err:
+                future.set_exception(err)
+            finally:
+                elapsed = time() - start
+                with self.lock:
+                    self.in_flight -= 1
+                    self.completed += 1
+                    self.service_time += self.SERVICE_TIME_WEIGHT * (elapsed - self.service_time)
+
+    def retry_after(self) -> float:
+        """
+        今キューにある処理が終わるまでのおおよその秒数
+        """
+        return self.queue.qsize() * self.service_time / self.workers
+
+    def metrics(self) -> dict:
+        return {
+            'depth': self.queue.qsize(),
+            'capacity': self.queue.maxsize,
+            'workers': self.workers,
+            'in_flight': self.in_flight,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'service_time': self.service_time,
+        }
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,199 @@
+import threading
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class AnalyticsError(Exception):
+    pass
+
+class Column(object):
+    """
+    追加と末尾の切り詰めができるNumPyの配列
+    容量は2倍ずつ増やす
+    """
+    def __init__(self, dtype, capacity: int = 1024):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values: list):
+        n = self.size + len(values)
+        if n > len(self.data):
+            data = np.empty(max(n, len(self.data) * 2), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:n] = values
+        self.size = n
+
+    def truncate(self, size: int):
+        self.size = min(self.size, size)
+
+    @property
+    def values(self):
+        return self.data[:self.size]
+
+class ChainStats(object):
+    """
+    メインチェーンのブロックとトランザクションを列ごとのNumPy配列で持ち，集計する
+    集計のたびにチェーンの増えた分だけを追加し，切り替わった分は切り詰めてから追加し直す
+    刈り込まれたブロックはヘッダだけを数える
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.columns = None
+        # 列に入れたブロックのハッシュ値と，そのブロックまでのトランザクション数
+        self.block_hashes = []
+        self.tx_ends = []
+        # アドレスとidの対応
+        self.ids = {}
+        self.addresses = []
+
+    def reset(self):
+        self.columns = {
+            'block_index': Column(np.int64),
+            'block_timestamp': Column(np.float64),
+            'block_transactions': Column(np.int32),
+            'block_volume': Column(np.int64),
+            'tx_block': Column(np.int64),
+            'tx_amount': Column(np.int64),
+            'tx_sender': Column(np.int32), # マイニング報酬は-1
+            'tx_recipient': Column(np.int32),
+        }
+        self.block_hashes = []
+        self.tx_ends = []
+
+    def address_id(self, address: str) -> int:
+        i = self.ids.get(address)
+        if i is None:
+            i = self.ids[address] = len(self.addresses)
+            self.addresses.append(address)
+        return i
+
+    def truncate(self, blocks: int):
+        del self.block_hashes[blocks:]
+        del self.tx_ends[blocks:]
+        transactions = self.tx_ends[-1] if self.tx_ends else 0
+        for name, column in self.columns.items():
+            column.truncate(blocks if name.startswith('block_') else transactions)
+
+    def sync(self, blockchain: 'Blockchain'):
+        """
+        列をメインチェーンに合わせる
+        """
+        if np is None:
+            raise AnalyticsError('numpy is not installed')
+        if self.columns is None:
+            self.reset()
+        with blockchain.lock:
+            # メインチェーンから外れたブロックを切り詰める
+            first = blockchain.chain[0].index
+            start = self.columns['block_index'].values[0] if self.block_hashes else first
+            if start < first:
+                self.reset()
+                start = first
+            n = len(self.block_hashes)
+            while n and blockchain.hashes.get(self.block_hashes[n - 1]) != start + n - 1:
+                n -= 1
+            if n == 0:
+                self.reset()
+                start = first
+            elif n < len(self.block_hashes):
+                self.truncate(n)
+            blocks = blockchain.chain[start + n - first:]
+        index, timestamp, counts, volumes = [], [], [], []
+        tx_block, amount, sender, recipient = [], [], [], []
+        total = self.tx_ends[-1] if self.tx_ends else 0
+        for block in blocks:
+            transactions = block.transactions or ()
+            volume = 0
+            for t in transactions:
+                mining = t.sender == "mining"
+                tx_block.append(block.index)
+                amount.append(t.amount)
+                sender.append(-1 if mining else self.address_id(t.sender))
+                recipient.append(self.address_id(t.recipient))
+                if not mining:
+                    volume += t.amount
+            index.append(block.index)
+            timestamp.append(block.timestamp)
+            counts.append(len(transactions))
+            volumes.append(volume)
+            total += len(transactions)
+            self.block_hashes.append(block.digest())
+            self.tx_ends.append(total)
+        for name, values in (('block_index', index), ('block_timestamp', timestamp), ('block_transactions', counts),
+                             ('block_volume', volumes), ('tx_block', tx_block), ('tx_amount', amount),
+                             ('tx_sender', sender), ('tx_recipient', recipient)):
+            self.columns[name].extend(values)
+
+    def summary(self, blockchain: 'Blockchain', bucket: float = 3600.0, since: float = None, until: float = None, top: int = 10) -> dict:
+        """
+        集計結果を返す
+        :param bucket: float 時系列の区間の長さ(秒)
+        :param since: float この時刻以降のブロックだけを集計する
+        :param until: float この時刻より前のブロックだけを集計する
+        :param top: int 報酬・送金額の多いアドレスを何件返すか
+        """
+        with self.lock:
+            self.sync(blockchain)
+            c = {name: column.values for name, column in self.columns.items()}
+            # ブロックの時刻で絞り込む
+            mask = np.ones(len(c['block_index']), dtype=bool)
+            if since is not None:
+                mask &= c['block_timestamp'] >= since
+            if until is not None:
+                mask &= c['block_timestamp'] < until
+            block_index = c['block_index'][mask]
+            block_timestamp = c['block_timestamp'][mask]
+            block_transactions = c['block_transactions'][mask]
+            block_volume = c['block_volume'][mask]
+            # 添字で取り出してコピーし，ロックを外したあとに列が書き換わっても影響しないようにする
+            tx_mask = np.isin(c['tx_block'], block_index)
+            tx_amount = c['tx_amount'][tx_mask]
+            tx_sender = c['tx_sender'][tx_mask]
+            tx_recipient = c['tx_recipient'][tx_mask]
+            mining = tx_sender < 0
+            addresses = list(self.addresses)
+
+        def distribution(values):
+            if len(values) == 0:
+                return None
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            return {'mean': float(values.mean()), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+                    'min': float(values.min()), 'max': float(values.max())}
+
+        def ranking(ids, weights):
+            if len(ids) == 0:
+                return []
+            totals = np.bincount(ids, weights=weights, minlength=len(addresses))
+            counts = np.bincount(ids, minlength=len(addresses))
+            order = np.argsort(-totals, kind='stable')[:top]
+            return [{'address': addresses[i], 'count': int(counts[i]), 'amount': int(totals[i])} for i in order if counts[i]]
+
+        series = []
+        if len(block_timestamp):
+            slots = np.floor(block_timestamp / bucket).astype(np.int64)
+            keys, positions = np.unique(slots, return_inverse=True)
+            blocks = np.bincount(positions)
+            transactions = np.bincount(positions, weights=block_transactions)
+            volume = np.bincount(positions, weights=block_volume)
+            series = [{'start': float(k * bucket), 'blocks': int(b), 'transactions': int(t), 'volume': int(v)}
+                      for k, b, t, v in zip(keys, blocks, transactions, volume)]
+
+        return {
+            'blocks': int(len(block_index)),
+            'from_index': int(block_index[0]) if len(block_index) else None,
+            'to_index': int(block_index[-1]) if len(block_index) else None,
+            'transactions': int(np.count_nonzero(~mining)),
+            'volume': int(tx_amount[~mining].sum()),
+            'rewards': int(tx_amount[mining].sum()),
+            'addresses': len(addresses),
+            'block_interval': distribution(np.diff(block_timestamp)),
+            'transactions_per_block': distribution(block_transactions),
+            'amount': distribution(tx_amount[~mining]),
+            'top_miners': ranking(tx_recipient[mining], tx_amount[mining]),
+            'top_senders': ranking(tx_sender[~mining], tx_amount[~mining]),
+            'top_recipients': ranking(tx_recipient[~mining], tx_amount[~mining]),
+            'bucket': bucket,
+            'series': series,
+        }
@@ -0,0 +1,36 @@
+import os
+import threading
+
+class BlockArchive(object):
+    """
+    刈り込んだブロックを捨てる前にディスクへ書き出す
+    1行に1ブロックのJSON (NDJSON) で，blocks_per_fileブロックごとにファイルを分ける
+    同じindexのブロックが複数あるときは後から書いたものがメインチェーンのもの
+    """
+    def __init__(self, directory: str, blocks_per_file: int = 10000):
+        self.directory = directory
+        self.blocks_per_file = blocks_per_file
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+        os.makedirs(directory, exist_ok=True)
+
+    def path_of(self, index: int) -> str:
+        start = (index - 1) // self.blocks_per_file * self.blocks_per_file + 1
+        return os.path.join(self.directory, f'blocks-{start:010d}.ndjson')
+
+    def write(self, block: 'Block'):
+        path = self.path_of(block.index)
+        with self.lock:
+            if path != self.path:
+                self.close()
+                self.file = open(path, 'ab')
+                self.path = path
+            self.file.write(block.to_json() + b'\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.path = None
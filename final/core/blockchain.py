@@ -1,21 +1,47 @@
 from typing import List
+from collections import OrderedDict
+import threading
+from base64 import b64encode, b64decode
+from sys import intern
 import hashlib
 import json
 from time import time
 from uuid import uuid4
-import requests
 from urllib.parse import urlparse
 import copy
-from util import sign
-from dns import DNS
+from peers import PeerManager, PeerError
+from validation import ChainValidator
+from bloom import SeenFilter
+from mempool import Mempool
+from codec import BINARY_MIMETYPE, CodecError, encode_block, decode_blocks, transaction_size, validate_block, validate_transactions
 
 class Block(object):
+    # インスタンスごとの__dict__を持たないようにしてメモリを節約する
+    __slots__ = ('index', 'timestamp', 'transactions', 'proof', 'previous_hash', '_json', '_binary', '_hash')
+
     def __init__(self, index: int, timestamp: float, transactions: List['Transaction'], proof: int, previous_hash: str):
         self.index = index
         self.timestamp = timestamp
         self.transactions = transactions
         self.proof = proof
         self.previous_hash = previous_hash
+        # 追加したあとのブロックは変更されないので，変換結果をキャッシュする
+        self._json = None
+        self._binary = None
+        self._hash = None
+
+    @classmethod
+    def from_dict(cls, values: dict) -> 'Block':
+        """
+        JSONやバイナリ形式から読み込んだ辞書をBlockにする
+        足りない項目があればKeyErrorを返す
+        """
+        return cls(
+            values["index"],
+            values["timestamp"],
+            [Transaction.from_dict(t) for t in values["transactions"]],
+            values["proof"],
+            values["previous_hash"])
 
     def __iter__(self):
         """
@@ -23,45 +49,243 @@ class Block(object):
         """
         yield ("index", self.index)
         yield ("timestamp", self.timestamp)
-        yield ("transactions", list(map(lambda t: t.__dict__, self.transactions)))
+        yield ("transactions", list(map(dict, self.transactions)))
         yield ("proof", self.proof)
         yield ("previous_hash", self.previous_hash)
 
+    def to_json(self) -> bytes:
+        """
+        ブロックのJSON
+        ハッシュ値の計算と同じ形式(sort_keys=True)にしておく
+        """
+        if self._json is None:
+            self._json = json.dumps(dict(self), sort_keys=True).encode()
+        return self._json
+
+    def to_binary(self) -> bytes:
+        """
+        ブロックのバイナリ形式
+        """
+        if self._binary is None:
+            self._binary = encode_block(dict(self))
+        return self._binary
+
+    def digest(self) -> str:
+        """
+        ブロックのハッシュ値
+        """
+        if self._hash is None:
+            self._hash = hashlib.sha256(self.to_json()).hexdigest()
+        return self._hash
+
+    @property
+    def pruned(self) -> bool:
+        return self.transactions is None
+
+    def prune(self):
+        """
+        トランザクションを捨ててヘッダだけにする
+        ハッシュ値は捨てる前に計算して残す
+        """
+        self.digest()
+        self.transactions = None
+        self._json = None
+        self._binary = None
+
 class Transaction(object):
-    def __init__(self, sender: str, recipient: str, amount: int, timestamp: float, signature: str):
-        self.sender = sender
-        self.recipient = recipient
+    # アドレスはintern()して同じ文字列を共有し，署名はbase64ではなくbytesで持つ
+    __slots__ = ('sender', 'recipient', 'amount', 'timestamp', '_signature', '_txid')
+
+    def __init__(self, sender: str, recipient: str, amount: int, timestamp: float, signature: str, txid: str = None):
+        """
+        :param txid: str 計算済みのtxid (journalから読み直すときなど)
+        """
+        self.sender = intern(sender) if type(sender) is str else sender
+        self.recipient = intern(recipient) if type(recipient) is str else recipient
         self.amount = amount
         self.timestamp = timestamp
         self.signature = signature
+        self._txid = txid
+
+    @classmethod
+    def from_dict(cls, values: dict, txid: str = None) -> 'Transaction':
+        """
+        辞書をTransactionにする
+        バイナリ形式ではtimestamp, signatureが省略されることがあるので，なければNone
+        足りない項目があればKeyErrorを返す
+        """
+        return cls(values["sender"], values["recipient"], values["amount"], values.get("timestamp"), values.get("signature"), txid=txid)
+
+    @property
+    def signature(self) -> str:
+        if type(self._signature) is bytes:
+            return b64encode(self._signature).decode()
+        return self._signature
+
+    @signature.setter
+    def signature(self, signature: str):
+        # base64に戻したときに同じ文字列になるものだけbytesにする
+        try:
+            raw = b64decode(signature, validate=True)
+            if b64encode(raw).decode() == signature:
+                signature = raw
+        except (TypeError, ValueError):
+            pass
+        self._signature = signature
+        self._txid = None
+
+    def __iter__(self):
+        yield ("sender", self.sender)
+        yield ("recipient", self.recipient)
+        yield ("amount", self.amount)
+        yield ("timestamp", self.timestamp)
+        yield ("signature", self.signature)
+
+    def txid(self) -> str:
+        """
+        トランザクションのハッシュ値
+        """
+        if self._txid is None:
+            self._txid = hashlib.sha256(json.dumps(dict(self), sort_keys=True).encode()).hexdigest()
+        return self._txid
+
+    def size(self) -> int:
+        """
+        バイナリ形式にしたときの大きさ
+        ブロックの大きさの上限に使う
+        """
+        return transaction_size({'sender': self.sender, 'recipient': self.recipient, 'signature': self.signature})
+
+# PoWの難易度 (ハッシュ値の先頭に並ぶ0の数)
+DIFFICULTY = 4
+
+# 信頼できるブロックのハッシュ値 {index: hash}
+# これ以下のブロックはvalid_chainでPoWの検証を省略する
+CHECKPOINTS = {}
 
 class Blockchain(object):
-    def __init__(self):
+    def __init__(self, peers: PeerManager = None, checkpoints: dict = None, validator: ChainValidator = None, seen: SeenFilter = None,
+                 max_orphans: int = 256, max_side_blocks: int = 1024, clock=time, difficulty: int = DIFFICULTY,
+                 prune: int = None, archive=None):
+        """
+        :param clock: 現在時刻を返す関数．シミュレータでは仮想時計を使う
+        :param difficulty: int PoWの難易度
+        :param prune: int トランザクションまで持つ最近のブロック数．Noneなら全て持つ
+        :param archive: BlockArchive 刈り込む前のブロックの書き出し先
+        """
         self.chain = []
-        self.current_transactions = []
-        self.nodes = {}
+        # メインチェーンのブロックのハッシュ値 {hash: index}
+        self.hashes = {}
+        # メインチェーン以外の枝のブロック {hash: Block}
+        self.side_blocks = OrderedDict()
+        self.max_side_blocks = max_side_blocks
+        # 親がまだ届いていないブロック {hash: Block}, {親のhash: [hash]}
+        self.orphans = OrderedDict()
+        self.orphans_by_parent = {}
+        self.max_orphans = max_orphans
+        self.lock = threading.RLock()
+        self.clock = clock
+        self.difficulty = difficulty
+        self.current_transactions = Mempool()
+        self.peers = peers if peers is not None else PeerManager()
+        self.validator = validator or ChainValidator()
+        # 最近処理したトランザクションとブロック
+        self.seen = seen or SeenFilter()
+        self.checkpoints = dict(CHECKPOINTS)
+        self.checkpoints.update(checkpoints or {})
+        # base_indexのブロックまでの残高
+        # スナップショットから起動したときや，古いブロックを刈り込んだときに使う
+        self.base_balances = {}
+        self.base_index = 1
+        # 先頭からpruned_count個のブロックはヘッダだけを持つ
+        self.prune_depth = prune
+        self.pruned_count = 0
+        self.archive = archive
         self.new_block(
             previous_hash = 1,
             proof=100
         )
 
 
-    def new_block(self, proof: int, previous_hash: str = None):
+    def new_block(self, proof: int, previous_hash: str = None, reward: 'Transaction' = None,
+                  max_transactions: int = None, max_bytes: int = None):
         """
         新しいブロックを作成して追加する
+        未承認のトランザクションは古い順に上限まで取り込み，残りは次のブロックに回す
         :param proof: int
         :previous_hash: 以前のハッシュ値
+        :param reward: Transaction ブロックの最後に入れるマイニング報酬
+        :param max_transactions: int 報酬を含めたトランザクション数の上限
+        :param max_bytes: int 報酬を含めたトランザクションの大きさの上限
         """
-        block = Block (
-            len(self.chain) + 1,
-            time(),
-            self.current_transactions,
-            proof,
-            previous_hash or self.hash(self.chain[-1])
-        )
-        self.current_transactions = []
+        with self.lock:
+            if reward is not None:
+                max_transactions = None if max_transactions is None else max_transactions - 1
+                max_bytes = None if max_bytes is None else max_bytes - reward.size()
+            transactions = self.current_transactions.take(max_transactions, max_bytes)
+            if reward is not None:
+                transactions.append(reward)
+            block = Block (
+                self.last_block.index + 1 if self.chain else 1,
+                self.clock(),
+                transactions,
+                proof,
+                previous_hash or self.hash(self.chain[-1])
+            )
+            self.append_block(block)
+            self.current_transactions.compact()
+            return block
+
+    def append_block(self, block: 'Block'):
+        """
+        検証済みのブロックをメインチェーンの最後に追加する
+        """
+        block_hash = self.hash(block)
         self.chain.append(block)
-        return block
+        self.hashes[block_hash] = block.index
+        self.current_transactions.remove([t.txid() for t in block.transactions])
+        self.seen.add(f'block:{block_hash}')
+        self.prune()
+
+    def prune(self):
+        """
+        最近のprune_depth個より古いブロックのトランザクションを残高に畳み込んで捨てる
+        archiveがあれば捨てる前に書き出す
+        """
+        if self.prune_depth is None:
+            return
+        while self.pruned_count < len(self.chain) - self.prune_depth:
+            block = self.chain[self.pruned_count]
+            if block.index > self.base_index:
+                for t in block.transactions:
+                    if t.sender != "mining":
+                        self.base_balances[t.sender] = self.base_balances.get(t.sender, 0) - t.amount
+                    self.base_balances[t.recipient] = self.base_balances.get(t.recipient, 0) + t.amount
+                self.base_index = block.index
+            if self.archive is not None:
+                self.archive.write(block)
+            block.prune()
+            self.pruned_count += 1
+
+    @property
+    def full_chain(self) -> List['Block']:
+        """
+        トランザクションまで持っているブロック
+        """
+        return self.chain[self.pruned_count:]
+
+    def replace_chain(self, chain: List['Block']):
+        """
+        メインチェーンを置き換える
+        """
+        with self.lock:
+            self.chain = chain
+            self.hashes = {self.hash(block): block.index for block in chain}
+            self.side_blocks = OrderedDict()
+            self.pruned_count = 0
+            while self.pruned_count < len(chain) and chain[self.pruned_count].pruned:
+                self.pruned_count += 1
+            self.prune()
 
     def new_transaction(self, sender: str, recipient: str, amount: int, timestamp: float, signature: str) -> int:
         """
@@ -71,10 +295,197 @@ class Blockchain(object):
         :param amount: int
         :return: int 作成したトランザクションを含むブロックのアドレス
         """
-        self.current_transactions.append(
-            Transaction(sender, recipient, amount, timestamp, signature)
-        )
-        return self.last_block.index + 1
+        with self.lock:
+            self.current_transactions.append(
+                Transaction(sender, recipient, amount, timestamp, signature)
+            )
+            return self.last_block.index + 1
+
+    def new_transactions(self, transactions: List['Transaction']) -> int:
+        """
+        複数のトランザクションをまとめて追加する
+        :param transactions: List[Transaction]
+        :return: int 作成したトランザクションを含むブロックのアドレス
+        """
+        with self.lock:
+            self.current_transactions.extend(transactions)
+            return self.last_block.index + 1
+
+    def receive_transactions(self, values: list, max_bytes: int = None) -> int:
+        """
+        他のノードから届いた署名済みのトランザクションを検証して追加する
+        複数の経路から届いた処理済みのトランザクションは捨てる
+        失敗したらValueErrorを返す
+        :param values: List[dict]
+        :param max_bytes: int 1件のトランザクションの大きさの上限
+        :return: int 追加した数
+        """
+        transactions = validate_transactions(values, signed=True, max_bytes=max_bytes)
+        with self.lock:
+            # 処理済みとして記録するのは追加したあとにして，不正なリクエストで正しいものが捨てられないようにする
+            transactions = [t for t in transactions if not self.known_transaction(t)]
+            self.new_transactions([
+                Transaction.from_dict(t) for t in transactions
+            ])
+            for t in transactions:
+                self.seen_transaction(t)
+        return len(transactions)
+
+    def find_block(self, block_hash: str) -> 'Block':
+        """
+        メインチェーンか枝からハッシュ値でブロックを探す
+        持っていなければNone
+        """
+        index = self.hashes.get(block_hash)
+        if index is not None:
+            return self.get_block(index)
+        return self.side_blocks.get(block_hash)
+
+    def accept_block(self, block: 'Block') -> str:
+        """
+        他のノードから受け取ったブロックを1つ追加する
+        親が最後のブロックならメインチェーンに，それ以外の既知のブロックなら枝に追加し，
+        枝の方が長くなったらメインチェーンを切り替える
+        親がまだ届いていないブロックは孤立ブロックとして保持し，親が届いたら追加する
+        :return: str 'added', 'reorg', 'side', 'orphan', 'duplicate' or 'invalid'
+        """
+        # 孤立ブロックを追加した結果も含めて，チェーンへの影響が大きい方を返す
+        rank = {'side': 0, 'added': 1, 'reorg': 2}
+        with self.lock:
+            status = self._accept_block(block)
+            if status not in rank:
+                return status
+            # このブロックを親に持つ孤立ブロックを追加する
+            parents = [self.hash(block)]
+            while parents:
+                for child_hash in self.orphans_by_parent.pop(parents.pop(), []):
+                    child = self.orphans.pop(child_hash, None)
+                    if child is None:
+                        continue
+                    child_status = self._accept_block(child)
+                    if child_status in rank:
+                        parents.append(child_hash)
+                        status = max(status, child_status, key=rank.get)
+            return status
+
+    def _accept_block(self, block: 'Block') -> str:
+        block_hash = self.hash(block)
+        if block_hash in self.hashes or block_hash in self.side_blocks or block_hash in self.orphans:
+            return 'duplicate'
+        # 不正なトランザクションを含むブロックは，孤立ブロックとしても保持しない
+        try:
+            validate_block(dict(block))
+        except ValueError as err:
+            print(f'bad block: {err} at {block.index}')
+            return 'invalid'
+        parent = self.find_block(block.previous_hash)
+        if parent is None:
+            self.add_orphan(block)
+            return 'orphan'
+        if block.index != parent.index + 1 or not self.valid_proof(parent.proof, block.proof, self.difficulty):
+            print(f'bad block: invalid block at {block.index}')
+            return 'invalid'
+        if block.previous_hash == self.hash(self.last_block):
+            self.append_block(block)
+            return 'added'
+        self.side_blocks[block_hash] = block
+        while len(self.side_blocks) > self.max_side_blocks:
+            self.side_blocks.popitem(last=False)
+        self.seen.add(f'block:{block_hash}')
+        if block.index > self.height and self.reorganize(block):
+            return 'reorg'
+        return 'side'
+
+    def add_orphan(self, block: 'Block'):
+        """
+        孤立ブロックを保持する
+        上限を超えたら古いものから捨てる
+        """
+        block_hash = self.hash(block)
+        self.orphans[block_hash] = block
+        self.orphans_by_parent.setdefault(block.previous_hash, []).append(block_hash)
+        while len(self.orphans) > self.max_orphans:
+            old_hash, old = self.orphans.popitem(last=False)
+            siblings = self.orphans_by_parent.get(old.previous_hash, [])
+            if old_hash in siblings:
+                siblings.remove(old_hash)
+            if not siblings:
+                self.orphans_by_parent.pop(old.previous_hash, None)
+
+    def reorganize(self, tip: 'Block') -> bool:
+        """
+        tipで終わる枝をメインチェーンにする
+        外れたブロックは枝に移し，そのトランザクションは未承認に戻す
+        刈り込んだブロックより前で分かれた枝には切り替えない
+        :return: bool 切り替えたらtrue
+        """
+        branch = [tip]
+        while branch[-1].previous_hash not in self.hashes:
+            parent = self.side_blocks.get(branch[-1].previous_hash)
+            if parent is None:
+                # max_side_blocksを超えて祖先が捨てられた枝はたどれない
+                print(f'cannot reorganize: ancestor of {branch[-1].index} is no longer kept')
+                return False
+            branch.append(parent)
+        branch.reverse()
+        position = self.hashes[branch[0].previous_hash] - self.chain[0].index + 1
+        if position < self.pruned_count:
+            print(f'cannot reorganize: fork at {branch[0].index} is older than pruned blocks')
+            return False
+        detached = self.chain[position:]
+        self.chain = self.chain[:position]
+        for block in detached:
+            block_hash = self.hash(block)
+            del self.hashes[block_hash]
+            self.side_blocks[block_hash] = block
+        for block in branch:
+            self.side_blocks.pop(self.hash(block), None)
+            self.append_block(block)
+        confirmed = set(t.txid() for block in branch for t in block.transactions)
+        self.current_transactions.extend([
+            t for block in detached for t in block.transactions
+            if t.sender != "mining" and t.txid() not in confirmed
+        ])
+        print(f'reorganized: {len(detached)} blocks detached, {len(branch)} blocks attached')
+        return True
+
+    def receive_compact_block(self, compact: dict, node: str) -> str:
+        """
+        compact blockを自分のmempoolから組み立てて追加する
+        mempoolにないトランザクションだけをnodeに問い合わせる
+        リクエストの本文に書かれた任意のホストへ送らないように，問い合わせるのは登録済みのノードだけにする
+        失敗したらCompactBlockErrorかPeerErrorを返す
+        :return: str accept_blockの結果
+        """
+        from compact import CompactBlockError, rebuild, fill
+        transactions, missing = rebuild(compact, self.current_transactions)
+        received = []
+        if missing:
+            if node not in self.peers:
+                raise CompactBlockError(f'cannot get missing transactions from unknown node {node}')
+            index = compact['header']['index']
+            response = self.peers.post(node, f'/blocks/{index}/transactions', json={'positions': missing})
+            if response.status_code != 200:
+                raise CompactBlockError(f'cannot get transactions of block {index}')
+            received = response.json()['transactions']
+        return self.accept_block(fill(compact, transactions, missing, received))
+
+    def known_transaction(self, transaction) -> bool:
+        """
+        最近処理したトランザクションならtrue (記録はしない)
+        :param transaction: dict or Transaction
+        """
+        key = f'tx:{self.hash(transaction)}'
+        with self.lock:
+            return key in self.seen
+
+    def seen_transaction(self, transaction) -> bool:
+        """
+        最近処理したトランザクションならtrue
+        処理していなければ処理済みとして記録する
+        :param transaction: dict or Transaction
+        """
+        return self.seen.add(f'tx:{self.hash(transaction)}')
 
     def register_node(self, domain, port):
         """
@@ -84,28 +495,25 @@ class Blockchain(object):
         :param port
         """
         # 名前解決
+        from dns import DNS
         try:
             ip = DNS.domain_to_ip(domain)
         except:
             ip = domain
+        address = f'{ip}:{port}'
         try:
-            # uuidを取得
-            response = requests.get(f'http://{ip}:{port}/uuid')
-            if response.status_code == 200:
-                self.nodes[f'{ip}:{port}'] = {}
-                uuid = response.json()['uuid']
-                self.nodes[f'{ip}:{port}']['uuid'] = uuid
-            else:
-                raise Exception("GET uuid failed")
-            # publickeyを取得
-            response = requests.get(f'http://{ip}:{port}/publickey')
-            if response.status_code == 200:
-                key = response.json()['key']
-                self.nodes[f'{ip}:{port}']['key'] = key
-            else:
-                raise Exception("GET pubkey failed")
-        except:
+            uuid, key, pruned = self.peers.handshake(address)
+        except (PeerError, ValueError, KeyError) as err:
+            print(err)
             raise Exception("Cannot register node")
+        self.peers.add(address, uuid, key, pruned)
+
+    @property
+    def nodes(self) -> dict:
+        """
+        ノード一覧 {ip:port: {uuid, key}}
+        """
+        return self.peers.to_dict()
 
     def proof_of_work(self, last_proof: int) -> int:
         """
@@ -114,7 +522,7 @@ class Blockchain(object):
         :return:int 計算したproofの値
         """
         proof = 0
-        while self.valid_proof(last_proof, proof) is False:
+        while self.valid_proof(last_proof, proof, self.difficulty) is False:
             proof += 1
         return proof
 
@@ -124,77 +532,157 @@ class Blockchain(object):
         :param chain: List[Block]
         :return: bool
         """
-        last_block = chain[0]
-        current_index = 1
-        while current_index < len(chain):
-            block = chain[current_index]
-            print(f'{last_block}')
-            print(f'{block}')
-            print('\n----------------\n')
-            if block["previous_hash"] != self.hash(last_block):
-                print('bad block: invalid previous hash')
-                print(block["previous_hash"])
-                return False
-            if not self.valid_proof(last_block["proof"], block["proof"]):
-                print('bad block: invalid proof')
+        # チェックポイントと一致するか
+        trusted = 0
+        for block in chain:
+            expected = self.checkpoints.get(block["index"])
+            if expected is None:
+                continue
+            if self.hash(block) != expected:
+                print(f'bad block: checkpoint mismatch at {block["index"]}')
                 return False
-            last_block = block
-            current_index += 1
+            trusted = max(trusted, block["index"])
+        index, reason = self.validator.validate(chain, trusted, self.difficulty)
+        if index is not None:
+            print(f'bad block: {reason} at {index}')
+            return False
         return True
 
     def resolve_conflicts(self):
         """
         他のノードとのコンフリクトを解消する
         """
-        neighbours = self.nodes
         new_chain = None
-        max_length = len(self.chain)
+        max_length = self.height
         winner_node = ""
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
+        # 応答が速いノードから問い合わせ，バックオフ中のノードは飛ばす
+        # 全てのブロックを持っているノードを先に問い合わせる
+        for peer in sorted(self.peers.ordered(), key=lambda p: p.pruned):
+            try:
+                response = self.peers.get(peer.address, '/chain', headers={'Accept': BINARY_MIMETYPE}, stream=True)
+            except PeerError as err:
+                print(err)
+                continue
+            # 最後のブロックが同じチェーンはすでに検証しているので，本文を読まずに飛ばす
+            tip = response.headers.get('ETag', '').strip('"').replace('-bin', '')
+            if tip and f'block:{tip}' in self.seen:
+                response.close()
+                continue
             if response.status_code == 200:
-                length = response.json()['length']
-                chain = response.json()['chain']
-                if length > max_length and self.valid_chain(chain):
+                # 読めないチェーンや空のチェーンは飛ばす
+                try:
+                    if response.headers.get('Content-Type', '').startswith(BINARY_MIMETYPE):
+                        chain = decode_blocks(response.content)
+                    else:
+                        chain = response.json()['chain']
+                    if not chain:
+                        raise CodecError('empty chain')
+                    length = chain[-1]['index']
+                    longer = length > max_length
+                    if longer:
+                        if self.fork_point(chain) is None:
+                            # 自分のチェーンとつながらないものは，次回また問い合わせる
+                            continue
+                        longer = self.valid_chain(chain)
+                except (CodecError, ValueError, KeyError, TypeError) as err:
+                    print(f'{peer.address}: invalid chain: {err}')
+                    continue
+                # 検証まで終わったチェーンは，最後のブロックが変わるまで本文を読まない
+                if tip:
+                    self.seen.add(f'block:{tip}')
+                if longer:
                     max_length = length
                     new_chain = chain
-                    winner_node = node
+                    winner_node = peer.address
         if new_chain:
             print(f'{chain}')
-            self.chain = [
-                Block(
-                    chain["index"],
-                    chain["timestamp"],
-                    [Transaction(t["sender"], t["recipient"], t["amount"], t["timestamp"], t["signature"]) for t in chain["transactions"]],
-                    chain["proof"],
-                    chain["previous_hash"])
-                for chain in new_chain]
-            response = requests.get(f'http://{winner_node}/transactions')
+            blocks = [Block.from_dict(block) for block in new_chain]
+            with self.lock:
+                position = self.fork_point(new_chain)
+                if new_chain[0]["index"] == 1:
+                    self.base_balances = {}
+                    self.base_index = 1
+                self.replace_chain(self.chain[:position] + blocks)
+            try:
+                response = self.peers.get(winner_node, '/transactions')
+            except PeerError as err:
+                print(err)
+                return True
             if response.status_code == 200:
                 new_transactions = response.json()['transactions']
-                self.current_transactions = [
-                    Transaction(t["sender"], t["recipient"], t["amount"], t["timestamp"], t["signature"]) for t in new_transactions
-                ]
+                self.current_transactions.reset([
+                    Transaction.from_dict(t) for t in new_transactions
+                ])
             return True
         return False
 
+    def fork_point(self, chain: List["Block"]) -> int:
+        """
+        受け取ったチェーンが自分のチェーンのどこから始まるかを返す
+        ジェネシスブロックから始まるか，自分が持っているブロックから始まっている必要がある
+        :return: int 置き換えを始めるself.chainの位置．置き換えられなければNone
+        """
+        if chain[0]["index"] == 1:
+            return 0
+        position = chain[0]["index"] - self.chain[0].index
+        # 刈り込んだブロックは置き換えられない
+        if position < 0 or position >= len(self.chain) or position + 1 < self.pruned_count:
+            return None
+        if self.hash(chain[0]) != self.hash(self.chain[position]):
+            return None
+        return position
+
+    def balances(self) -> dict:
+        """
+        アドレスごとの残高を計算する
+        :return: dict {address: amount}
+        """
+        balances = dict(self.base_balances)
+        for block in self.chain[self.base_index - self.chain[0].index + 1:]:
+            for t in block.transactions:
+                if t.sender != "mining":
+                    balances[t.sender] = balances.get(t.sender, 0) - t.amount
+                balances[t.recipient] = balances.get(t.recipient, 0) + t.amount
+        return balances
+
     @staticmethod
     def hash(obj) -> str:
+        if isinstance(obj, Block):
+            return obj.digest()
         obj_string = json.dumps(dict(obj), sort_keys=True).encode()
         return hashlib.sha256(obj_string).hexdigest()
 
     @staticmethod
-    def valid_proof(last_proof: int, proof: int) -> bool:
+    def valid_proof(last_proof: int, proof: int, difficulty: int = DIFFICULTY) -> bool:
         """
         proofの計算を行い，正しければtrueを返す
         :param last_proof: int
         :param proof: int
+        :param difficulty: int ハッシュ値の先頭に並ぶ0の数
         :return bool
         """
         guess = f'{last_proof}{proof}'.encode()
         guess_hash = hashlib.sha256(guess).hexdigest()
         # return int(guess_hash[:10]) < 30000
-        return int(guess_hash[:4], 16) == 0
+        return guess_hash.startswith('0' * difficulty)
+    def get_block(self, index: int) -> 'Block':
+        """
+        indexのブロックを返す
+        持っていなければNone
+        """
+        position = index - self.chain[0].index
+        if position < 0 or position >= len(self.chain):
+            return None
+        return self.chain[position]
+
     @property
     def last_block(self) -> 'Block':
         return self.chain[-1]
+
+    @property
+    def height(self) -> int:
+        """
+        最後のブロックのindex
+        スナップショットから起動したときはlen(chain)と一致しない
+        """
+        return self.last_block.index
@@ -0,0 +1,78 @@
+import hashlib
+import math
+
+class BloomFilter(object):
+    """
+    偽陽性はあるが偽陰性はない集合
+    capacity件追加したときの偽陽性率がerror_rateになるようにビット数とハッシュ関数の数を決める
+    """
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # 1つのハッシュ値から2つの値を取り出してk個の位置を作る(double hashing)
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key: str) -> bool:
+        """
+        keyを追加する
+        :return: bool すでに追加されていたらtrue(偽陽性を含む)
+        """
+        bits = self.bits
+        seen = True
+        for p in self._positions(key):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                seen = False
+        if not seen:
+            self.count += 1
+        return seen
+
+class SeenFilter(object):
+    """
+    最近処理したトランザクションやブロックを覚えておくフィルタ
+    2世代のBloomFilterを持ち，新しい方がいっぱいになったら古い方を捨てる
+    メモリは常に2世代分で一定になる
+    """
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.current or key in self.previous
+
+    def add(self, key: str) -> bool:
+        """
+        keyを追加する
+        :return: bool 最近追加されていたらtrue
+        """
+        if key in self.previous:
+            self.current.add(key)
+            return True
+        seen = self.current.add(key)
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+        return seen
+
+    @property
+    def memory(self) -> int:
+        """
+        ビット配列のバイト数
+        """
+        return len(self.current.bits) + len(self.previous.bits)
@@ -0,0 +1,82 @@
+from typing import List
+import gzip
+from codec import encode_blocks
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(body)
+    return body
+
+def accepted_encoding(accept_encoding: str, enabled: bool = True) -> str:
+    """
+    Accept-Encodingから使う圧縮方式を選ぶ
+    zstdはzstandardがインストールされているときだけ使う
+    :return: 'zstd', 'gzip' or None
+    """
+    if not enabled or not accept_encoding:
+        return None
+    encodings = [e.split(';')[0].strip() for e in accept_encoding.split(',')]
+    if zstandard is not None and 'zstd' in encodings:
+        return 'zstd'
+    if 'gzip' in encodings:
+        return 'gzip'
+    return None
+
+class ChainCache(object):
+    """
+    /chainなどのレスポンスをチェーンの最後のブロックのハッシュ値ごとにキャッシュする
+    各ブロックのJSON・バイナリはBlock側でキャッシュしているので，
+    チェーンが伸びたときは連結し直すだけでよい
+    """
+    def __init__(self):
+        self.tip = None
+        self.entries = {}
+
+    def get(self, chain: List['Block'], key, build):
+        """
+        最後のブロックが変わっていなければキャッシュを返し，変わっていればbuildで作り直す
+        作り直している間にチェーンが伸びてもよいように，buildにはその時点のブロックを渡す
+        """
+        length = len(chain)
+        tip = (chain[length - 1].digest(), length)
+        if tip != self.tip:
+            self.tip = tip
+            self.entries = {}
+        entries = self.entries
+        body = entries.get(key)
+        if body is None:
+            body = build(chain[:length])
+            entries[key] = body
+        return body
+
+    def etag(self, chain: List['Block'], binary: bool = False) -> str:
+        """
+        最後のブロックのハッシュ値をETagにする
+        """
+        return chain[-1].digest() + ('-bin' if binary else '')
+
+    def json_array(self, chain: List['Block']) -> bytes:
+        """
+        ブロックのJSONを連結した配列
+        """
+        return self.get(chain, 'json', lambda blocks: b'[' + b','.join(b.to_json() for b in blocks) + b']')
+
+    def chain_json(self, chain: List['Block'], length: int, encoding: str = None) -> bytes:
+        """
+        {"chain": [...], "length": length}
+        """
+        def build(blocks):
+            body = b'{"chain":%s,"length":%d}' % (self.json_array(blocks), length)
+            return compress(body, encoding)
+        return self.get(chain, ('chain', encoding), build)
+
+    def chain_binary(self, chain: List['Block'], encoding: str = None) -> bytes:
+        def build(blocks):
+            return compress(encode_blocks([b.to_binary() for b in blocks]), encoding)
+        return self.get(chain, ('binary', encoding), build)
@@ -0,0 +1,203 @@
+import argparse
+import gzip
+import json
+import sys
+from typing import Iterable, List
+from blockchain import Blockchain, Block, DIFFICULTY
+from codec import BINARY_MIMETYPE, CodecError, encode_chain_header, read_blocks, validate_block
+
+# 書き出せる形式とContent-Type
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'binary': BINARY_MIMETYPE,
+}
+
+class ChainIOError(Exception):
+    pass
+
+def iter_chain(blocks: List['Block'], format: str = 'ndjson'):
+    """
+    チェーンを書き出す形式のbytesに少しずつ変換する
+    ndjson: 1行に1ブロックのJSON (刈り込んだブロックのアーカイブと同じ形式)
+    binary: /chainのバイナリ形式と同じ (先頭にブロック数)
+    """
+    if format == 'binary':
+        yield encode_chain_header(len(blocks))
+        for block in blocks:
+            yield block.to_binary()
+    elif format == 'ndjson':
+        for block in blocks:
+            yield block.to_json() + b'\n'
+    else:
+        raise ChainIOError(f'unknown format: {format}')
+
+def open_chain(path: str, mode: str = 'rb'):
+    """
+    .gzで終わるファイルはgzipで読み書きする． - は標準入出力
+    """
+    if path == '-':
+        return sys.stdin.buffer if 'r' in mode else sys.stdout.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def read_chain(stream) -> Iterable['Block']:
+    """
+    ストリームからブロックを1つずつ読み込む
+    先頭が { ならndjson，それ以外はバイナリ形式とみなす
+    """
+    try:
+        if stream.peek(1)[:1] == b'{':
+            for line in stream:
+                if line.strip():
+                    yield Block.from_dict(json.loads(line))
+        else:
+            for block in read_blocks(stream):
+                yield Block.from_dict(block)
+    except (CodecError, ValueError, KeyError, TypeError) as err:
+        raise ChainIOError(f'cannot read chain: {err}')
+
+class StreamValidator(object):
+    """
+    読み込んだ順にブロックを検証する
+    1つ前のブロックしか持たないので，チェーンの長さによらずメモリは一定
+    チェックポイント以下のブロックはPoWを検証せず，チェックポイントのハッシュ値で確かめる
+    """
+    def __init__(self, checkpoints: dict = None, difficulty: int = DIFFICULTY):
+        self.checkpoints = checkpoints or {}
+        self.trusted = max(self.checkpoints, default=0)
+        self.difficulty = difficulty
+        self.last = None
+        self.count = 0
+
+    def check(self, block: 'Block'):
+        """
+        不正なブロックならChainIOErrorを返す
+        """
+        try:
+            validate_block(dict(block))
+        except ValueError as err:
+            raise ChainIOError(f'bad block: {err} at {block.index}')
+        last = self.last
+        if last is None:
+            # 残高を計算し直すためにジェネシスブロックから読む必要がある
+            if block.index != 1:
+                raise ChainIOError(f'chain must start at the genesis block, not {block.index}')
+        else:
+            if block.index != last.index + 1:
+                raise ChainIOError(f'bad block: unexpected index {block.index} after {last.index}')
+            if block.previous_hash != last.digest():
+                raise ChainIOError(f'bad block: invalid previous hash at {block.index}')
+            if block.index > self.trusted and not Blockchain.valid_proof(last.proof, block.proof, self.difficulty):
+                raise ChainIOError(f'bad block: invalid proof at {block.index}')
+        expected = self.checkpoints.get(block.index)
+        if expected is not None and block.digest() != expected:
+            raise ChainIOError(f'bad block: checkpoint mismatch at {block.index}')
+        self.last = block
+        self.count += 1
+
+    def finish(self):
+        """
+        全て読み終わったあとに呼ぶ
+        PoWを省略したブロックがチェックポイントまでつながっているかを確かめる
+        """
+        if self.last is None:
+            raise ChainIOError('empty chain')
+        if self.last.index < self.trusted:
+            raise ChainIOError(f'chain ends at {self.last.index} before the checkpoint at {self.trusted}')
+
+def verify_chain(paths: List[str], checkpoints: dict = None, difficulty: int = DIFFICULTY) -> 'Block':
+    """
+    ファイルのチェーンを検証だけする
+    :return: Block 最後のブロック
+    """
+    validator = StreamValidator(checkpoints, difficulty)
+    for path in paths:
+        with open_chain(path) as stream:
+            for block in read_chain(stream):
+                validator.check(block)
+    validator.finish()
+    return validator.last
+
+def import_chain(blockchain: Blockchain, paths: List[str]) -> int:
+    """
+    ファイルのチェーンを1ブロックずつ検証しながら読み込み，メインチェーンを置き換える
+    複数のファイルはつなげて1つのチェーンとして読む (刈り込んだブロックのアーカイブ + 書き出したチェーンなど)
+    ブロックは読んだそばからノードのチェーンに積むので，刈り込みをしていれば古いブロックはヘッダだけになる
+    途中で不正なブロックがあればChainIOErrorを返し，メインチェーンは変えない
+    :return: int 読み込んだブロック数
+    """
+    # 別のBlockchainに積んでから，全て正しければ入れ替える
+    staging = Blockchain(
+        blockchain.peers,
+        checkpoints=blockchain.checkpoints,
+        validator=blockchain.validator,
+        seen=blockchain.seen,
+        clock=blockchain.clock,
+        difficulty=blockchain.difficulty,
+        prune=blockchain.prune_depth,
+        archive=blockchain.archive,
+    )
+    validator = StreamValidator(blockchain.checkpoints, blockchain.difficulty)
+    for path in paths:
+        with open_chain(path) as stream:
+            for block in read_chain(stream):
+                validator.check(block)
+                if block.index == 1:
+                    staging.replace_chain([block])
+                else:
+                    staging.append_block(block)
+    validator.finish()
+    with blockchain.lock:
+        blockchain.base_balances = staging.base_balances
+        blockchain.base_index = staging.base_index
+        blockchain.replace_chain(staging.chain)
+    return validator.count
+
+def export_chain(url: str, path: str, format: str = 'ndjson') -> int:
+    """
+    ノードの /chain/export をファイルに書き出す
+    :return: int 書き出したバイト数
+    """
+    import requests
+    try:
+        response = requests.get(f'{url.rstrip("/")}/chain/export', params={'format': format}, stream=True)
+        if response.status_code != 200:
+            raise ChainIOError(f'GET /chain/export failed: {response.status_code}')
+        size = 0
+        with open_chain(path, 'wb') as f:
+            for chunk in response.iter_content(1 << 16):
+                f.write(chunk)
+                size += len(chunk)
+    except requests.RequestException as err:
+        raise ChainIOError(f'GET /chain/export failed: {err}')
+    return size
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="export and verify chain files")
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser('export', help='download the chain of a node to a file')
+    export.add_argument('url', type=str, help='node as http://<ip>:<port>')
+    export.add_argument('path', type=str, help='output file (.gz to compress, - for stdout)')
+    export.add_argument('--format', choices=list(FORMATS), default='ndjson')
+    verify = commands.add_parser('verify', help='validate chain files without loading them into a node')
+    verify.add_argument('path', type=str, nargs='+', help='chain files read in order (- for stdin)')
+    verify.add_argument('--checkpoint', type=str, action='append', default=[], help='trusted block hash as <index>:<hash>')
+    verify.add_argument('--difficulty', type=int, default=DIFFICULTY)
+    args = parser.parse_args()
+    try:
+        if args.command == 'export':
+            size = export_chain(args.url, args.path, args.format)
+            print(f'wrote {size} bytes to {args.path}', file=sys.stderr)
+        elif args.command == 'verify':
+            checkpoints = {}
+            for checkpoint in args.checkpoint:
+                index, block_hash = checkpoint.split(':')
+                checkpoints[int(index)] = block_hash
+            tip = verify_chain(args.path, checkpoints, args.difficulty)
+            print(f'ok: {tip.index} blocks, tip {tip.digest()}')
+        else:
+            parser.print_help()
+    except (ChainIOError, OSError) as err:
+        print(err, file=sys.stderr)
+        exit(1)
@@ -0,0 +1,317 @@
+import math
+import struct
+from typing import List
+
+# バイナリ形式で送受信するときのContent-Type
+BINARY_MIMETYPE = 'application/octet-stream'
+
+_MAGIC_TRANSACTIONS = b'TXB1'
+_MAGIC_BLOCKS = b'BLK1'
+# magic(4byte) + 要素数(uint32)
+_HEADER = struct.Struct('!4sI')
+# amount(int64) + timestamp(double) + sender, recipient, signatureの長さ(uint16 * 3)
+_TRANSACTION = struct.Struct('!qdHHH')
+# index(uint64) + timestamp(double) + proof(uint64) + previous_hashの型(uint8) + previous_hashの長さ(uint16) + トランザクション数(uint32)
+_BLOCK = struct.Struct('!QdQBHI')
+
+_NAN = float('nan')
+
+# バイナリ形式で表せる範囲
+# sender, recipient, signatureはuint16の長さ，amountはint64
+MAX_FIELD_BYTES = 0xFFFF
+MIN_AMOUNT = -(1 << 63)
+MAX_AMOUNT = (1 << 63) - 1
+# index, proofはuint64
+MAX_UINT64 = (1 << 64) - 1
+
+class CodecError(ValueError):
+    pass
+
+def encode_transaction(t: dict) -> bytes:
+    """
+    トランザクション1件をバイナリ形式に変換する
+    timestamp, signatureがないものはNaNと空文字で埋める
+    バイナリ形式で表せない値はCodecErrorを返す
+    """
+    sender = str(t['sender']).encode()
+    recipient = str(t['recipient']).encode()
+    timestamp = t.get('timestamp')
+    signature = str(t.get('signature') or '').encode()
+    try:
+        fixed = _TRANSACTION.pack(
+            int(t['amount']),
+            _NAN if timestamp is None else float(timestamp),
+            len(sender), len(recipient), len(signature)
+        )
+    except (struct.error, TypeError, ValueError) as err:
+        raise CodecError(f'cannot encode transaction: {err}')
+    return b''.join([fixed, sender, recipient, signature])
+
+def transaction_size(t: dict) -> int:
+    """
+    バイナリ形式にしたときのトランザクションの大きさ
+    """
+    return (_TRANSACTION.size
+            + len(str(t['sender']).encode())
+            + len(str(t['recipient']).encode())
+            + len(str(t.get('signature') or '').encode()))
+
+def validate_transaction(values, signed: bool, max_bytes: int = None) -> dict:
+    """
+    トランザクションの形式を検証して正規化した辞書を返す
+    失敗したらValueErrorを返す
+    :param values: dict
+    :param signed: bool timestamp, signatureを必須とするか
+    :param max_bytes: int バイナリ形式にしたときの大きさの上限
+    :return: dict
+    """
+    if not isinstance(values, dict):
+        raise ValueError('transaction must be an object')
+    keys = ['sender', 'recipient', 'amount']
+    if signed:
+        keys += ['timestamp', 'signature']
+    missing = [k for k in keys if k not in values]
+    if missing:
+        raise ValueError(f'missing values: {", ".join(missing)}')
+    transaction = {k: values[k] for k in keys}
+    for k in ('sender', 'recipient'):
+        if not isinstance(transaction[k], str):
+            raise ValueError(f'{k} must be a string')
+    if signed:
+        # 署名済みのものは正規化するとtxidやブロックのハッシュ値が変わるので，型をそのまま検証する
+        if type(transaction['amount']) is not int:
+            raise ValueError('amount must be an integer')
+    else:
+        try:
+            transaction['amount'] = int(values['amount'])
+        except (TypeError, ValueError):
+            raise ValueError('amount must be an integer')
+    # バイナリ形式で送れない値は受け付けない (/chainや他のノードへの共有が失敗するため)
+    if not MIN_AMOUNT <= transaction['amount'] <= MAX_AMOUNT:
+        raise ValueError(f'amount must be in [{MIN_AMOUNT}, {MAX_AMOUNT}]')
+    if signed:
+        # バイナリ形式では時刻はdoubleで，空の署名は省略されるので，
+        # 整数の時刻(5が5.0になる)や空の署名はバイナリ形式で送るとハッシュ値が変わってしまう
+        timestamp = transaction['timestamp']
+        if type(timestamp) is not float or not math.isfinite(timestamp):
+            raise ValueError('timestamp must be a finite float')
+        if not isinstance(transaction['signature'], str) or not transaction['signature']:
+            raise ValueError('signature must be a non-empty string')
+    for k in ('sender', 'recipient', 'signature'):
+        if k in transaction and len(transaction[k].encode()) > MAX_FIELD_BYTES:
+            raise ValueError(f'{k} must be at most {MAX_FIELD_BYTES} bytes')
+    if max_bytes is not None and transaction_size(transaction) > max_bytes:
+        raise ValueError(f'transaction must be at most {max_bytes} bytes to fit in a block')
+    return transaction
+
+def validate_transactions(values, signed: bool, max_bytes: int = None):
+    """
+    トランザクションの配列をまとめて検証する
+    失敗したらValueErrorを返す
+    :return: List[dict]
+    """
+    transactions = []
+    for i, v in enumerate(values):
+        try:
+            transactions.append(validate_transaction(v, signed, max_bytes))
+        except ValueError as err:
+            raise ValueError(f'transaction {i}: {err}')
+    return transactions
+
+def validate_block(values):
+    """
+    他のノードから受け取ったブロックの形式と，全てのトランザクションを検証する
+    バイナリ形式で表せないブロックや，変換するとハッシュ値が変わるブロックは受け付けない
+    失敗したらValueErrorを返す
+    :param values: dict
+    """
+    if not isinstance(values, dict):
+        raise ValueError('block must be an object')
+    missing = [k for k in ('index', 'timestamp', 'transactions', 'proof', 'previous_hash') if k not in values]
+    if missing:
+        raise ValueError(f'missing values: {", ".join(missing)}')
+    for k in ('index', 'proof'):
+        if type(values[k]) is not int or not 0 <= values[k] <= MAX_UINT64:
+            raise ValueError(f'{k} must be an integer in [0, {MAX_UINT64}]')
+    if type(values['timestamp']) is not float or not math.isfinite(values['timestamp']):
+        raise ValueError('timestamp must be a finite float')
+    # ジェネシスブロックのprevious_hashは整数
+    previous_hash = values['previous_hash']
+    if type(previous_hash) is not str and type(previous_hash) is not int:
+        raise ValueError('previous_hash must be a string')
+    if len(str(previous_hash).encode()) > MAX_FIELD_BYTES:
+        raise ValueError(f'previous_hash must be at most {MAX_FIELD_BYTES} bytes')
+    if not isinstance(values['transactions'], list):
+        raise ValueError('transactions must be an array')
+    for i, t in enumerate(values['transactions']):
+        try:
+            validate_transaction(t, signed=True)
+        except ValueError as err:
+            raise ValueError(f'transaction {i}: {err}')
+
+def decode_transaction(view: memoryview, offset: int):
+    """
+    offsetの位置からトランザクション1件を読み込む
+    :return: (dict, 次のoffset)
+    """
+    try:
+        amount, timestamp, sender_len, recipient_len, signature_len = _TRANSACTION.unpack_from(view, offset)
+    except struct.error:
+        raise CodecError('truncated transaction')
+    offset += _TRANSACTION.size
+    end = offset + sender_len + recipient_len + signature_len
+    if end > len(view):
+        raise CodecError('truncated transaction')
+    sender = bytes(view[offset:offset + sender_len]).decode()
+    offset += sender_len
+    recipient = bytes(view[offset:offset + recipient_len]).decode()
+    offset += recipient_len
+    signature = bytes(view[offset:offset + signature_len]).decode()
+    offset += signature_len
+    transaction = {'sender': sender, 'recipient': recipient, 'amount': amount}
+    if timestamp == timestamp: # NaNでなければ
+        transaction['timestamp'] = timestamp
+    if signature:
+        transaction['signature'] = signature
+    return transaction, offset
+
+def encode_transactions(transactions: List[dict]) -> bytes:
+    """
+    トランザクションの配列をバイナリ形式に変換する
+    :param transactions: List[dict]
+    :return: bytes
+    """
+    chunks = [_HEADER.pack(_MAGIC_TRANSACTIONS, len(transactions))]
+    chunks.extend(map(encode_transaction, transactions))
+    return b''.join(chunks)
+
+def decode_transactions(data: bytes) -> List[dict]:
+    """
+    バイナリ形式のトランザクションの配列を辞書のリストに戻す
+    :param data: bytes
+    :return: List[dict]
+    """
+    view = memoryview(data)
+    count, offset = _read_header(view, _MAGIC_TRANSACTIONS)
+    transactions = []
+    for _ in range(count):
+        transaction, offset = decode_transaction(view, offset)
+        transactions.append(transaction)
+    return transactions
+
+def encode_block(block: dict) -> bytes:
+    """
+    ブロック1件をバイナリ形式に変換する
+    ジェネシスブロックのprevious_hashは整数なので型も記録する
+    """
+    previous_hash = block['previous_hash']
+    is_int = type(previous_hash) is int
+    previous_hash = str(previous_hash).encode()
+    try:
+        fixed = _BLOCK.pack(
+            block['index'], block['timestamp'], block['proof'],
+            is_int, len(previous_hash), len(block['transactions'])
+        )
+    except (struct.error, TypeError) as err:
+        raise CodecError(f'cannot encode block: {err}')
+    chunks = [fixed, previous_hash]
+    chunks.extend(map(encode_transaction, block['transactions']))
+    return b''.join(chunks)
+
+def decode_block(view: memoryview, offset: int):
+    """
+    offsetの位置からブロック1件を読み込む
+    :return: (dict, 次のoffset)
+    """
+    try:
+        index, timestamp, proof, is_int, hash_len, count = _BLOCK.unpack_from(view, offset)
+    except struct.error:
+        raise CodecError('truncated block')
+    offset += _BLOCK.size
+    if offset + hash_len > len(view):
+        raise CodecError('truncated block')
+    previous_hash = bytes(view[offset:offset + hash_len]).decode()
+    offset += hash_len
+    transactions = []
+    for _ in range(count):
+        transaction, offset = decode_transaction(view, offset)
+        transactions.append(transaction)
+    block = {
+        'index': index,
+        'timestamp': timestamp,
+        'transactions': transactions,
+        'proof': proof,
+        'previous_hash': int(previous_hash) if is_int else previous_hash,
+    }
+    return block, offset
+
+def encode_chain_header(count: int) -> bytes:
+    """
+    チェーンのバイナリ形式の先頭 (この後にcount個のブロックが続く)
+    """
+    return _HEADER.pack(_MAGIC_BLOCKS, count)
+
+def encode_blocks(fragments: List[bytes]) -> bytes:
+    """
+    encode_blockで変換したブロックを連結してチェーンのバイナリ形式にする
+    """
+    return encode_chain_header(len(fragments)) + b''.join(fragments)
+
+def decode_blocks(data: bytes) -> List[dict]:
+    """
+    バイナリ形式のチェーンを辞書のリストに戻す
+    """
+    view = memoryview(data)
+    count, offset = _read_header(view, _MAGIC_BLOCKS)
+    blocks = []
+    for _ in range(count):
+        block, offset = decode_block(view, offset)
+        blocks.append(block)
+    return blocks
+
+def _read_header(view: memoryview, magic: bytes):
+    try:
+        actual, count = _HEADER.unpack_from(view, 0)
+    except struct.error:
+        raise CodecError('truncated header')
+    if actual != magic:
+        raise CodecError('invalid magic')
+    return count, _HEADER.size
+
+def _read_exact(stream, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise CodecError('truncated block')
+    return data
+
+def read_block(stream) -> dict:
+    """
+    ファイルなどのストリームからブロック1件を読み込む
+    チェーン全体をメモリに載せずに1ブロックずつ読むときに使う
+    :return: dict 最後まで読んだらNone
+    """
+    head = stream.read(_BLOCK.size)
+    if not head:
+        return None
+    if len(head) != _BLOCK.size:
+        raise CodecError('truncated block')
+    _, _, _, _, hash_len, count = _BLOCK.unpack(head)
+    chunks = [head, _read_exact(stream, hash_len)]
+    for _ in range(count):
+        fixed = _read_exact(stream, _TRANSACTION.size)
+        _, _, sender_len, recipient_len, signature_len = _TRANSACTION.unpack(fixed)
+        chunks.append(fixed)
+        chunks.append(_read_exact(stream, sender_len + recipient_len + signature_len))
+    block, _ = decode_block(memoryview(b''.join(chunks)), 0)
+    return block
+
+def read_blocks(stream):
+    """
+    バイナリ形式のチェーンをストリームから1ブロックずつ読み込む
+    """
+    count, _ = _read_header(memoryview(_read_exact(stream, _HEADER.size)), _MAGIC_BLOCKS)
+    for _ in range(count):
+        block = read_block(stream)
+        if block is None:
+            raise CodecError('truncated chain')
+        yield block
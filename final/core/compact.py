@@ -0,0 +1,106 @@
+from typing import List
+from blockchain import Block, Transaction
+from mempool import Mempool, short_id
+from codec import validate_transaction
+
+class CompactBlockError(Exception):
+    pass
+
+def compact_block(block: Block) -> dict:
+    """
+    ブロックをヘッダと短縮txidだけのcompact blockにする
+    マイニング報酬のトランザクションは相手のmempoolにないので本体ごと入れる
+    """
+    short_ids = []
+    prefilled = []
+    for position, t in enumerate(block.transactions):
+        if t.sender == "mining":
+            prefilled.append({'position': position, 'transaction': dict(t)})
+            short_ids.append(None)
+        else:
+            short_ids.append(short_id(t.txid()))
+    return {
+        'hash': block.digest(),
+        'header': {
+            'index': block.index,
+            'timestamp': block.timestamp,
+            'proof': block.proof,
+            'previous_hash': block.previous_hash,
+        },
+        'short_ids': short_ids,
+        'prefilled': prefilled,
+    }
+
+def parse_message(values) -> tuple:
+    """
+    POST /blocks/compactの本文の形を検証する
+    失敗したらCompactBlockErrorを返す
+    :return: (compact block, 送信元のノード)
+    """
+    if not isinstance(values, dict):
+        raise CompactBlockError('message must be an object')
+    compact = values.get('block')
+    node = values.get('node')
+    if not isinstance(compact, dict) or not isinstance(node, str):
+        raise CompactBlockError('message must have block and node')
+    header = compact.get('header')
+    if not isinstance(compact.get('hash'), str) or not isinstance(header, dict):
+        raise CompactBlockError('invalid compact block: hash and header are required')
+    if not isinstance(header.get('index'), int) or not isinstance(header.get('proof'), int):
+        raise CompactBlockError('invalid compact block: index and proof must be integers')
+    if not isinstance(header.get('timestamp'), (int, float)) or 'previous_hash' not in header:
+        raise CompactBlockError('invalid compact block: timestamp and previous_hash are required')
+    if not isinstance(compact.get('short_ids'), list) or not isinstance(compact.get('prefilled'), list):
+        raise CompactBlockError('invalid compact block: short_ids and prefilled must be arrays')
+    return compact, node
+
+def rebuild(compact: dict, mempool: Mempool):
+    """
+    compact blockを自分のmempoolのトランザクションで組み立て直す
+    :return: (トランザクションのリスト, mempoolになかったトランザクションの位置)
+    """
+    try:
+        short_ids = compact['short_ids']
+        transactions = [None] * len(short_ids)
+        for p in compact['prefilled']:
+            t = p['transaction']
+            transactions[p['position']] = Transaction.from_dict(t)
+    except (KeyError, IndexError, TypeError):
+        raise CompactBlockError('invalid compact block')
+    table = mempool.short_ids()
+    missing = []
+    for position, key in enumerate(short_ids):
+        if transactions[position] is not None:
+            continue
+        transaction = table.get(key)
+        if transaction is None:
+            missing.append(position)
+        else:
+            transactions[position] = transaction
+    return transactions, missing
+
+def fill(compact: dict, transactions: List['Transaction'], missing: List[int], received: List[dict]) -> Block:
+    """
+    足りなかったトランザクションを埋めてブロックにする
+    組み立てたブロックのハッシュ値がcompact blockと一致しなければCompactBlockErrorを返す
+    """
+    if len(received) != len(missing):
+        raise CompactBlockError('missing transactions were not returned')
+    for position, t in zip(missing, received):
+        try:
+            transaction = Transaction.from_dict(validate_transaction(t, signed=True))
+        except ValueError as err:
+            raise CompactBlockError(f'invalid transaction at {position}: {err}')
+        if short_id(transaction.txid()) != compact['short_ids'][position]:
+            raise CompactBlockError(f'unexpected transaction at {position}')
+        transactions[position] = transaction
+    header = compact['header']
+    block = Block(
+        header["index"],
+        header["timestamp"],
+        transactions,
+        header["proof"],
+        header["previous_hash"])
+    if block.digest() != compact['hash']:
+        raise CompactBlockError('block hash mismatch')
+    return block
@@ -1,5 +1,24 @@
 import random
 import socket
+import struct
+import threading
+
+# レコードの種類
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_TXT = 16
+TYPE_AAAA = 28
+TYPE_SRV = 33
+CLASS_IN = 1
+
+_HEADER = struct.Struct('!HHHHHH') # id, flags, qdcount, ancount, nscount, arcount
+_QUESTION = struct.Struct('!HH') # type, class
+_RECORD = struct.Struct('!HHIH') # type, class, ttl, rdlength
+_SRV = struct.Struct('!HHH') # priority, weight, port
+_POINTER = struct.Struct('!H')
+
+class DNSError(Exception):
+    pass
 
 class DNSFlags():
     def __init__(self, qr, opcode, aa, tc, rd, ra, z, ad, cd, rcode):
@@ -13,92 +32,293 @@ class DNSFlags():
         self.ad = ad # 1bit
         self.cd = cd # 1bit
         self.rcode = rcode # 4bit
-    
-    def to_bytes(self):
-        result = bytearray()
-        result.append(
-            self.qr << 7 | 
-            (self.opcode >> 3 & 0x1) << 6 |
-            (self.opcode >> 2 & 0x1) << 5 |
-            (self.opcode >> 1 & 0x1) << 4 |
-            (self.opcode >> 0 & 0x1) << 3 |
-            self.aa << 2 |
-            self.tc << 1 |
-            self.rd << 0
-        )
-        result.append(
+
+    def to_int(self):
+        return (
+            self.qr << 15 |
+            (self.opcode & 0xf) << 11 |
+            self.aa << 10 |
+            self.tc << 9 |
+            self.rd << 8 |
             self.ra << 7 |
             self.z << 6 |
             self.ad << 5 |
             self.cd << 4 |
-            (self.rcode >> 3 & 0x1) << 3 |
-            (self.rcode >> 2 & 0x1) << 2 |
-            (self.rcode >> 1 & 0x1) << 1 |
-            (self.rcode >> 0 & 0x1) << 0
+            (self.rcode & 0xf)
+        )
+
+    def to_bytes(self):
+        return _POINTER.pack(self.to_int())
+
+    @classmethod
+    def from_int(cls, value):
+        return cls(
+            qr = value >> 15 & 0x1,
+            opcode = value >> 11 & 0xf,
+            aa = value >> 10 & 0x1,
+            tc = value >> 9 & 0x1,
+            rd = value >> 8 & 0x1,
+            ra = value >> 7 & 0x1,
+            z = value >> 6 & 0x1,
+            ad = value >> 5 & 0x1,
+            cd = value >> 4 & 0x1,
+            rcode = value & 0xf,
         )
-        return bytes(result)
 
 class DNSHeader():
-    def __init__(self, flags, qdcount, ancount, nscount, arcount):
-        self.id = random.randint(0, 10000)
+    def __init__(self, flags, qdcount, ancount, nscount, arcount, id=None):
+        self.id = random.randint(0, 0xffff) if id is None else id
         self.flags = flags
         self.qdcount = qdcount
         self.ancount = ancount
         self.nscount = nscount
         self.arcount = arcount
-    
+
     def to_bytes(self):
-        result = bytearray()
-        result.append(self.id >> 8 & 0xff)
-        result.append(self.id & 0xff)
-        for b in self.flags.to_bytes():
-            result.append(b)
-        result.append(self.qdcount >> 8 & 0xff)
-        result.append(self.qdcount & 0xff)
-        result.append(self.ancount >> 8 & 0xff)
-        result.append(self.ancount & 0xff)
-        result.append(self.nscount >> 8 & 0xff)
-        result.append(self.nscount & 0xff)
-        result.append(self.arcount >> 8 & 0xff)
-        result.append(self.arcount & 0xff)
-        return bytes(result)
+        return _HEADER.pack(self.id, self.flags.to_int(), self.qdcount, self.ancount, self.nscount, self.arcount)
+
+    @classmethod
+    def unpack_from(cls, view, offset=0):
+        try:
+            id, flags, qdcount, ancount, nscount, arcount = _HEADER.unpack_from(view, offset)
+        except struct.error:
+            raise DNSError('truncated header')
+        return cls(DNSFlags.from_int(flags), qdcount, ancount, nscount, arcount, id=id)
 
 class QuestionSection():
     def __init__(self, domain, dtype, dclass):
-        self.domains = domain.split(".")
+        self.domain = domain.rstrip('.')
+        self.domains = self.domain.split(".")
         self.dtype = dtype
         self.dclass = dclass
-    
+
     def to_bytes(self):
-        result = bytearray()
-        for domain in self.domains:
-            result.append(len(domain)) # ドメインの長さを格納
-            for b in bytes(domain.encode()):
-                result.append(b) # ドメインを追加
-        result.append(0) # 終端文字
-        result.append((self.dtype >> 8) & 0xff)
-        result.append(self.dtype & 0xff)
-        result.append((self.dclass >> 8) & 0xff)
-        result.append(self.dclass & 0xff)
-        return bytes(result)
+        writer = DNSWriter()
+        self.write(writer)
+        return writer.getvalue()
+
+    def write(self, writer):
+        writer.write_name(self.domain)
+        writer.write_struct(_QUESTION, self.dtype, self.dclass)
+
+class ResourceRecord():
+    """
+    応答のレコード
+    dataはAとAAAAならIPアドレス，CNAMEならドメイン，
+    SRVなら(priority, weight, port, target)，TXTなら文字列のリスト，それ以外はbytes
+    """
+    def __init__(self, name, rtype, rclass, ttl, data):
+        self.name = name.rstrip('.')
+        self.rtype = rtype
+        self.rclass = rclass
+        self.ttl = ttl
+        self.data = data
+
+    def write(self, writer):
+        writer.write_name(self.name)
+        start = writer.offset
+        writer.write_struct(_RECORD, self.rtype, self.rclass, self.ttl, 0)
+        if self.rtype == TYPE_A:
+            writer.write_bytes(socket.inet_pton(socket.AF_INET, self.data))
+        elif self.rtype == TYPE_AAAA:
+            writer.write_bytes(socket.inet_pton(socket.AF_INET6, self.data))
+        elif self.rtype == TYPE_CNAME:
+            writer.write_name(self.data)
+        elif self.rtype == TYPE_SRV:
+            priority, weight, port, target = self.data
+            writer.write_struct(_SRV, priority, weight, port)
+            # SRVのtargetは圧縮しない(RFC 2782)
+            writer.write_name(target, compress=False)
+        elif self.rtype == TYPE_TXT:
+            for text in self.data:
+                text = text.encode()
+                writer.write_bytes(bytes([len(text)]) + text)
+        else:
+            writer.write_bytes(self.data)
+        # rdlengthを後から埋める
+        _POINTER.pack_into(writer.buffer, start + _RECORD.size - 2, writer.offset - start - _RECORD.size)
+
+    @classmethod
+    def unpack_from(cls, view, offset):
+        name, offset = read_name(view, offset)
+        try:
+            rtype, rclass, ttl, length = _RECORD.unpack_from(view, offset)
+        except struct.error:
+            raise DNSError('truncated record')
+        offset += _RECORD.size
+        end = offset + length
+        if end > len(view):
+            raise DNSError('truncated record')
+        try:
+            if rtype == TYPE_A:
+                data = socket.inet_ntop(socket.AF_INET, view[offset:end])
+            elif rtype == TYPE_AAAA:
+                data = socket.inet_ntop(socket.AF_INET6, view[offset:end])
+            elif rtype == TYPE_CNAME:
+                data, _ = read_name(view, offset)
+            elif rtype == TYPE_SRV:
+                priority, weight, port = _SRV.unpack_from(view[:end], offset)
+                target, _ = read_name(view, offset + _SRV.size)
+                data = (priority, weight, port, target)
+            elif rtype == TYPE_TXT:
+                data = []
+                position = offset
+                while position < end:
+                    length = view[position]
+                    if position + 1 + length > end:
+                        raise DNSError('truncated txt record')
+                    data.append(bytes(view[position + 1:position + 1 + length]).decode())
+                    position += 1 + length
+            else:
+                data = bytes(view[offset:end])
+        except (ValueError, struct.error) as err:
+            # 長さが合わないアドレスやUTF-8でない文字列など
+            raise DNSError(f'invalid record data: {err}')
+        return cls(name, rtype, rclass, ttl, data), end
+
+class DNSWriter():
+    """
+    パケットを組み立てるためのバッファ
+    バッファは使い回し，ドメイン名は圧縮する
+    """
+    def __init__(self, size=512):
+        self.buffer = bytearray(size)
+        self.offset = 0
+        self.names = {}
+
+    def reset(self):
+        self.offset = 0
+        self.names = {}
+
+    def _reserve(self, size):
+        if self.offset + size > len(self.buffer):
+            self.buffer.extend(bytes(max(size, len(self.buffer))))
+
+    def write_struct(self, st, *values):
+        self._reserve(st.size)
+        st.pack_into(self.buffer, self.offset, *values)
+        self.offset += st.size
+
+    def write_bytes(self, data):
+        self._reserve(len(data))
+        self.buffer[self.offset:self.offset + len(data)] = data
+        self.offset += len(data)
+
+    def write_name(self, name, compress=True):
+        labels = [label for label in name.rstrip('.').split('.') if label]
+        for i in range(len(labels)):
+            suffix = '.'.join(labels[i:]).lower()
+            pointer = self.names.get(suffix)
+            if compress and pointer is not None:
+                self.write_struct(_POINTER, 0xc000 | pointer)
+                return
+            if self.offset < 0x3fff:
+                self.names.setdefault(suffix, self.offset)
+            label = labels[i].encode()
+            if len(label) > 63:
+                raise DNSError(f'label too long: {labels[i]}')
+            self._reserve(len(label) + 1)
+            self.buffer[self.offset] = len(label) # ドメインの長さを格納
+            self.buffer[self.offset + 1:self.offset + 1 + len(label)] = label # ドメインを追加
+            self.offset += len(label) + 1
+        self.write_bytes(b'\x00') # 終端文字
+
+    def getvalue(self):
+        return bytes(self.buffer[:self.offset])
+
+def read_name(view, offset):
+    """
+    offsetの位置からドメイン名を読み込む
+    圧縮されたドメイン名(ポインタ)にも対応する
+    :return: (ドメイン名, 次のoffset)
+    """
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        if offset >= len(view):
+            raise DNSError('truncated name')
+        length = view[offset]
+        if length & 0xc0 == 0xc0:
+            if offset + 1 >= len(view):
+                raise DNSError('truncated name')
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise DNSError('compression loop')
+            offset = _POINTER.unpack_from(view, offset)[0] & 0x3fff
+            continue
+        offset += 1
+        if length == 0:
+            break
+        if offset + length > len(view):
+            raise DNSError('truncated name')
+        try:
+            labels.append(bytes(view[offset:offset + length]).decode())
+        except UnicodeDecodeError:
+            raise DNSError('invalid name')
+        offset += length
+    return '.'.join(labels), end if end is not None else offset
 
 class DNS():
-    def __init__(self, header, sections, ip="127.0.0.1", port=53):
+    # 問い合わせ先のDNSサーバ
+    server = ("127.0.0.1", 53)
+
+    def __init__(self, header, sections, ip=None, port=None, answers=None, authorities=None, additionals=None):
         self.header = header
         self.sections = sections
-        self.address = (ip, port)
+        self.answers = answers or []
+        self.authorities = authorities or []
+        self.additionals = additionals or []
+        self.address = (ip or DNS.server[0], port or DNS.server[1])
 
-    def to_bytes(self):
-        result = bytearray()
-        for b in self.header.to_bytes():
-            result.append(b)
+    def to_bytes(self, writer=None):
+        writer = writer or DNSWriter()
+        writer.reset()
+        self.header.qdcount = len(self.sections)
+        self.header.ancount = len(self.answers)
+        self.header.nscount = len(self.authorities)
+        self.header.arcount = len(self.additionals)
+        writer.write_bytes(self.header.to_bytes())
         for section in self.sections:
-            for b in section.to_bytes():
-                result.append(b)
-        return bytes(result)
+            section.write(writer)
+        for record in self.answers + self.authorities + self.additionals:
+            record.write(writer)
+        return writer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        パケットを読み込む
+        """
+        view = memoryview(data)
+        header = DNSHeader.unpack_from(view)
+        offset = _HEADER.size
+        sections = []
+        for _ in range(header.qdcount):
+            domain, offset = read_name(view, offset)
+            try:
+                dtype, dclass = _QUESTION.unpack_from(view, offset)
+            except struct.error:
+                raise DNSError('truncated question')
+            offset += _QUESTION.size
+            sections.append(QuestionSection(domain, dtype, dclass))
+        records = []
+        for _ in range(header.ancount + header.nscount + header.arcount):
+            record, offset = ResourceRecord.unpack_from(view, offset)
+            records.append(record)
+        answers = records[:header.ancount]
+        authorities = records[header.ancount:header.ancount + header.nscount]
+        additionals = records[header.ancount + header.nscount:]
+        return cls(header, sections, answers=answers, authorities=authorities, additionals=additionals)
 
     @staticmethod
-    def domain_to_ip(domain):
+    def query(domain, dtype, server=None):
+        """
+        問い合わせを行い，応答を返す
+        失敗したらDNSErrorを返す
+        """
         # make packet
         flags = DNSFlags(
             qr = 0, # 問い合わせ=0, 応答=1
@@ -117,47 +337,83 @@ class DNS():
             qdcount = 1, # 問い合わせセクション数
             ancount = 0, nscount = 0, arcount = 0
         )
-        sections = []
-        sections.append(QuestionSection(
+        sections = [QuestionSection(
             domain = domain,
-            dtype = 1, # A record = 0x0001
-            dclass = 1, # IN = 0x0001
-        ))
-        dns = DNS(header, sections)
+            dtype = dtype,
+            dclass = CLASS_IN, # IN = 0x0001
+        )]
+        server = server or DNS.server
+        dns = DNS(header, sections, ip=server[0], port=server[1])
 
         # communicate
-        query = dns.to_bytes()
-        try:
-            data = communicate(query, dns.address)
-        except Exception as err:
-            raise err
-
-        # get answer
-        rcode = data[3] & 0xf
-        if rcode == 0:
-            answer = data[len(query)+12:len(query)+16]
-            return "%d.%d.%d.%d" % (answer[0], answer[1], answer[2], answer[3])
-        else:
-            raise Exception('error code %d: cannot resolve domain. ' % rcode) 
+        query = dns.to_bytes(_writer())
+        data = communicate(query, dns.address)
+        response = DNS.from_bytes(data)
+        if response.header.id != header.id:
+            raise DNSError('unexpected response id')
+        rcode = response.header.flags.rcode
+        if rcode != 0:
+            raise DNSError('error code %d: cannot resolve domain. ' % rcode)
+        return response
+
+    @staticmethod
+    def lookup(domain, dtype, server=None):
+        """
+        domainのdtypeのレコードを返す
+        CNAMEをたどる
+        :return: List[ResourceRecord]
+        """
+        response = DNS.query(domain, dtype, server)
+        name = domain.rstrip('.').lower()
+        for _ in range(8):
+            records = [r for r in response.answers if r.name.lower() == name and r.rtype == dtype]
+            if records:
+                return records
+            cname = [r for r in response.answers if r.name.lower() == name and r.rtype == TYPE_CNAME]
+            if not cname:
+                return []
+            name = cname[0].data.lower()
+        return []
+
+    @staticmethod
+    def domain_to_ip(domain):
+        records = DNS.lookup(domain, TYPE_A)
+        if not records:
+            raise DNSError('cannot resolve domain: no A record')
+        return records[0].data
+
     @staticmethod
     def ip_to_domain():
         pass
 
+_local = threading.local()
+
+def _writer():
+    # スレッドごとにバッファを使い回す
+    if not hasattr(_local, 'writer'):
+        _local.writer = DNSWriter()
+    return _local.writer
+
 def communicate(query, address):
     """
     クエリの送信と応答結果の受信
+    受信用のバッファはスレッドごとに使い回す
     :param query バイト配列
     :param address (送信先のアドレス, ポート番号)
-    :return 受信したバイト配列
+    :return 受信したバイト配列のmemoryview (次の呼び出しまで有効)
     """
-    BUFFER = 1024
+    BUFFER = 4096
+    if not hasattr(_local, 'buffer'):
+        _local.buffer = bytearray(BUFFER)
     client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) # internet, udp
     try:
         client.settimeout(2)
         client.sendto(query, address)
-        data, address = client.recvfrom(BUFFER)
-        client.close()
-        return data
+        length, address = client.recvfrom_into(_local.buffer)
+        return memoryview(_local.buffer)[:length]
     except socket.timeout:
+        raise DNSError('DNS timeout.')
+    except OSError as err:
+        raise DNSError(f'DNS error: {err}')
+    finally:
         client.close()
-        raise Exception('DNS timeout.')
\ No newline at end of file
@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+from typing import List
+from blockchain import Transaction
+
+class MempoolJournal(object):
+    """
+    未承認のトランザクションの追加と削除を追記していくファイル
+    再起動したときに読み直してmempoolを元に戻す
+
+    1行に1レコードで，
+        +txid {トランザクションのJSON}   追加
+        -txid txid ...                  削除
+        *                               全て削除
+    読み直すときにtxidを計算し直さなくて済むように，追加のレコードにはtxidも書く
+    書き込みはバッファにためて1つのスレッドでまとめてfsyncする (group commit)
+    fsyncしている間に届いたレコードは次のfsyncでまとめて書くので，fsyncの回数がスループットを決めない
+    compact()を呼ぶと，そのときのmempoolの中身だけを書いたファイルに置き換える
+    """
+    def __init__(self, path: str):
+        self.path = path
+        # バッファとシーケンス番号
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        # ファイルへの書き込み
+        # バッファを取り出してから書き終わるまで持ち，compactと順番が入れ替わらないようにする
+        self.io_lock = threading.Lock()
+        self.buffer = []
+        self.seq = 0 # バッファに入れたレコード数
+        self.durable = 0 # fsyncしたレコード数
+        # mempoolにあるトランザクションの追加のレコード {txid: bytes}
+        # compactのときはこれをつなげて書くだけにする
+        self.records = {}
+        self.compact_requested = False
+        self.file = None
+        self.thread = None
+        self.stopped = False
+        self.error = None
+        # 統計
+        self.syncs = 0
+        self.compactions = 0
+        self.max_batch = 0
+
+    def replay(self) -> List['Transaction']:
+        """
+        ファイルを先頭から読んでmempoolの中身を作り直す
+        書き込みの途中で落ちて壊れた最後の行は読み飛ばす
+        :return: List[Transaction] 追加した順
+        """
+        records = {}
+        try:
+            with open(self.path, 'rb') as f:
+                lines = f.read().split(b'\n')
+        except FileNotFoundError:
+            lines = []
+        # 最後の改行より後ろは書き込みの途中
+        for line in lines[:-1]:
+            op = line[:1]
+            if op == b'+':
+                records[line[1:line.index(b' ')].decode()] = line
+            elif op == b'-':
+                for txid in line[1:].decode().split():
+                    records.pop(txid, None)
+            elif op == b'*':
+                records = {}
+        # 削除されずに残ったものだけを，1つのJSONの配列にしてまとめてパースする
+        values = json.loads(b'[%s]' % b','.join(line[len(txid) + 2:] for txid, line in records.items()))
+        transactions = [
+            Transaction.from_dict(t, txid=txid)
+            for txid, t in zip(records, values)
+        ]
+        self.records = {txid: line + b'\n' for txid, line in records.items()}
+        return transactions
+
+    def attach(self, mempool: 'Mempool'):
+        """
+        mempoolの変更を記録し始める
+        今の中身でファイルを書き直してから，書き込み用のスレッドを起動する
+        """
+        # mempoolのlockを先に取り，追加と同じ順番でlockを取る
+        with mempool.lock:
+            with self.lock:
+                records = {}
+                for transaction in mempool:
+                    txid = transaction.txid()
+                    records[txid] = self.records.get(txid) or self.encode(transaction)
+                self.records = records
+            mempool.journal = self
+        with self.io_lock:
+            self._compact()
+        self.thread = threading.Thread(target=self.run, name='mempool-journal', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def encode(transaction: 'Transaction') -> bytes:
+        return b'+%s %s\n' % (transaction.txid().encode(), json.dumps(dict(transaction)).encode())
+
+    def _log(self, record: bytes):
+        """
+        lockを持って呼ぶ
+        """
+        self.buffer.append(record)
+        self.seq += 1
+        self.flushed.notify_all()
+
+    def add(self, transaction: 'Transaction'):
+        record = self.encode(transaction)
+        with self.lock:
+            self.records[transaction.txid()] = record
+            self._log(record)
+
+    def remove(self, txids: List[str]):
+        if not txids:
+            return
+        with self.lock:
+            for txid in txids:
+                self.records.pop(txid, None)
+            self._log(('-' + ' '.join(txids) + '\n').encode())
+
+    def clear(self):
+        with self.lock:
+            self.records = {}
+            self._log(b'*\n')
+
+    def compact(self):
+        """
+        次の書き込みのときにファイルを今のmempoolの中身だけにする
+        ブロックを作るたびに呼ぶ
+        """
+        with self.lock:
+            self.compact_requested = True
+            self.flushed.notify_all()
+
+    def sync(self, timeout: float = None) -> bool:
+        """
+        これまでに記録したレコードがfsyncされるまで待つ
+        :return: bool 書き込めたらtrue
+        """
+        with self.lock:
+            seq = self.seq
+            self.flushed.wait_for(lambda: self.durable >= seq or self.error is not None or self.stopped, timeout)
+            return self.durable >= seq
+
+    def _compact(self):
+        """
+        io_lockを持って呼ぶ
+        """
+        with self.lock:
+            # これまでのレコードはrecordsに反映されている
+            self.buffer = []
+            seq = self.seq
+            self.compact_requested = False
+            data = b''.join(self.records.values())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file is not None:
+            self.file.close()
+        os.replace(tmp, self.path)
+        self._sync_directory()
+        self.file = open(self.path, 'ab')
+        self.compactions += 1
+        with self.lock:
+            self.durable = max(self.durable, seq)
+            self.flushed.notify_all()
+
+    def _sync_directory(self):
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.flushed.wait_for(lambda: self.buffer or self.compact_requested or self.stopped)
+                if self.stopped and not self.buffer:
+                    return
+            try:
+                with self.io_lock:
+                    if self.compact_requested:
+                        self._compact()
+                        continue
+                    with self.lock:
+                        records = self.buffer
+                        self.buffer = []
+                        seq = self.seq
+                    self.file.write(b''.join(records))
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    self.syncs += 1
+                    self.max_batch = max(self.max_batch, len(records))
+                with self.lock:
+                    self.durable = max(self.durable, seq)
+                    self.flushed.notify_all()
+            except OSError as err:
+                print(f'cannot write the mempool journal: {err}')
+                with self.lock:
+                    self.error = err
+                    self.flushed.notify_all()
+                return
+
+    def close(self):
+        """
+        残っているレコードを書いてから止める
+        """
+        with self.lock:
+            self.stopped = True
+            self.flushed.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def metrics(self) -> dict:
+        return {
+            'records': self.seq,
+            'pending': self.seq - self.durable,
+            'syncs': self.syncs,
+            'max_batch': self.max_batch,
+            'compactions': self.compactions,
+            'bytes': self.file.tell() if self.file is not None else 0,
+        }
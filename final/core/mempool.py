@@ -0,0 +1,138 @@
+from typing import List
+import threading
+from collections import OrderedDict
+
+# compact blockで使う短縮txidの長さ(16進数の文字数)
+SHORT_ID_LENGTH = 12
+
+def short_id(txid: str) -> str:
+    return txid[:SHORT_ID_LENGTH]
+
+class Mempool(object):
+    """
+    未承認のトランザクション
+    追加した順番を保ったまま，txidで引けるようにする
+    journalがあれば追加と削除を記録する
+    受け付けのスレッドとブロックを作るスレッドから同時に使うので，読み書きはlockを取って行う
+    """
+    def __init__(self, transactions: List['Transaction'] = ()):
+        self.lock = threading.RLock()
+        self.transactions = OrderedDict()
+        # トランザクションの大きさの合計
+        self.bytes = 0
+        self.journal = None
+        self.extend(transactions)
+
+    def __len__(self) -> int:
+        return len(self.transactions)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.transactions.values()))
+
+    def __contains__(self, txid: str) -> bool:
+        return txid in self.transactions
+
+    def append(self, transaction: 'Transaction'):
+        txid = transaction.txid()
+        with self.lock:
+            if txid not in self.transactions:
+                self.bytes += transaction.size()
+                if self.journal is not None:
+                    self.journal.add(transaction)
+            self.transactions[txid] = transaction
+
+    def extend(self, transactions: List['Transaction']):
+        with self.lock:
+            for transaction in transactions:
+                self.append(transaction)
+
+    def get(self, txid: str) -> 'Transaction':
+        return self.transactions.get(txid)
+
+    def remove(self, txids: List[str]):
+        """
+        ブロックに取り込まれたトランザクションを取り除く
+        """
+        removed = []
+        with self.lock:
+            for txid in txids:
+                transaction = self.transactions.pop(txid, None)
+                if transaction is not None:
+                    self.bytes -= transaction.size()
+                    removed.append(txid)
+            if self.journal is not None:
+                self.journal.remove(removed)
+
+    def reset(self, transactions: List['Transaction'] = ()):
+        """
+        中身を入れ替える
+        """
+        with self.lock:
+            self.transactions = OrderedDict()
+            self.bytes = 0
+            if self.journal is not None:
+                self.journal.clear()
+            self.extend(transactions)
+
+    def sync(self, timeout: float = None) -> bool:
+        """
+        これまでの追加と削除がjournalに書き込まれるまで待つ
+        :return: bool 書き込めたか，journalがなければtrue
+        """
+        if self.journal is None:
+            return True
+        return self.journal.sync(timeout)
+
+    def compact(self):
+        """
+        journalを今の中身だけにする
+        """
+        if self.journal is not None:
+            self.journal.compact()
+
+    def take(self, max_count: int = None, max_bytes: int = None) -> List['Transaction']:
+        """
+        古い順にトランザクションを取り出す
+        上限を指定しなければ全て取り出して空にする
+        :param max_count: int 取り出す数の上限
+        :param max_bytes: int 取り出すトランザクションの大きさの合計の上限
+        :return: List[Transaction]
+        """
+        with self.lock:
+            if max_count is None and max_bytes is None:
+                transactions = list(self.transactions.values())
+                self.transactions = OrderedDict()
+                self.bytes = 0
+                if self.journal is not None:
+                    self.journal.clear()
+                return transactions
+            transactions = []
+            size = 0
+            for transaction in self.transactions.values():
+                if max_count is not None and len(transactions) >= max_count:
+                    break
+                if max_bytes is not None and size + transaction.size() > max_bytes:
+                    break
+                transactions.append(transaction)
+                size += transaction.size()
+            for transaction in transactions:
+                del self.transactions[transaction.txid()]
+            self.bytes -= size
+            if self.journal is not None:
+                self.journal.remove([t.txid() for t in transactions])
+            return transactions
+
+    def short_ids(self) -> dict:
+        """
+        短縮txidからトランザクションを引く辞書
+        短縮txidが衝突したものは持っていないものとして扱う
+        :return: dict {short_id: Transaction or None}
+        """
+        table = {}
+        with self.lock:
+            items = list(self.transactions.items())
+        for txid, transaction in items:
+            key = short_id(txid)
+            table[key] = None if key in table else transaction
+        return table
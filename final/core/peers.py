@@ -0,0 +1,363 @@
+from typing import List
+from collections import OrderedDict
+import random
+import threading
+from time import time
+
+class PeerError(Exception):
+    pass
+
+class HTTPTransport(object):
+    """
+    requestsで他のノードとHTTPで通信する
+    接続はSessionでkeep-aliveして使い回す
+    """
+    # 複数のノードへのリクエストをスレッドで並列に送ってよいか
+    parallel = True
+
+    def __init__(self, pool_size: int = 32):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self._session = None
+
+    @property
+    def session(self):
+        """
+        requestsは読み込みに時間がかかるので，初めて通信するときにimportしてSessionを作る
+        """
+        with self.lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                self._session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                self._session.mount('http://', adapter)
+            return self._session
+
+    def request(self, method: str, address: str, path: str, **kwargs) -> 'requests.Response':
+        """
+        接続できなかったらPeerErrorを返す
+        """
+        session = self.session
+        import requests
+        try:
+            return session.request(method, f'http://{address}{path}', **kwargs)
+        except requests.RequestException as err:
+            raise PeerError(f'{address}: {err}')
+
+class Peer(object):
+    def __init__(self, address: str, uuid: str, key: str, added_at: float = None, pruned: bool = False):
+        self.address = address
+        self.uuid = uuid
+        self.key = key
+        self.pruned = pruned # 古いブロックのトランザクションを持っていないノード
+        self.latency = None # 応答時間の指数移動平均(秒)
+        self.failures = 0 # 連続で失敗した回数
+        self.last_seen = None # 最後に応答があった時刻
+        self.retry_at = 0.0 # 次に通信してよい時刻
+        self.added_at = time() if added_at is None else added_at
+        self.cursor = 0.0 # このノードから前回取得したノード一覧の時刻
+
+    def healthy(self, now: float) -> bool:
+        """
+        通信してよい状態ならtrue
+        失敗が続いている間はバックオフが明けるまでfalse
+        """
+        return self.failures == 0 or now >= self.retry_at
+
+    def to_dict(self) -> dict:
+        return {'uuid': self.uuid, 'key': self.key}
+
+class PeerManager(object):
+    """
+    他のノードの一覧と通信状態を管理する
+    応答時間・失敗回数・最終応答時刻を記録し，
+    失敗したノードは指数バックオフの間は使わず，失敗が続けば削除する
+    通信はtransportに任せるので，シミュレータでは仮想のネットワークに差し替えられる
+    """
+    # 応答時間の移動平均の重み
+    LATENCY_WEIGHT = 0.3
+
+    # /nodesで1回に返すノード数
+    SAMPLE_SIZE = 64
+
+    def __init__(self, timeout: float = 3.0, max_failures: int = 5, backoff: float = 1.0, max_backoff: float = 60.0, pool_size: int = 32, max_peers: int = 256,
+                 transport=None, clock=time, evicted_backoff: float = 120.0):
+        """
+        :param transport: request(method, address, path, **kwargs)を持つ通信路．デフォルトはHTTPTransport
+        :param clock: 現在時刻を返す関数
+        :param evicted_backoff: float 削除したノードにハンドシェイクし直す間隔(秒)
+        """
+        self.peers = {}
+        # 削除したノードと次にハンドシェイクし直す時刻 {address: time}
+        # 一時的なネットワークの分断で削除し合ったノードが，二度とつながらなくならないようにする
+        self.evicted = OrderedDict()
+        self.evicted_backoff = evicted_backoff
+        self.timeout = timeout
+        self.max_peers = max_peers
+        self.max_failures = max_failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.transport = transport or HTTPTransport(pool_size)
+        self.clock = clock
+        # 並列に送るためのスレッドは作り直さずに使い回す
+        self._executor = None
+        self._local = threading.local()
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.peers
+
+    def __len__(self) -> int:
+        return len(self.peers)
+
+    def __iter__(self):
+        return iter(list(self.peers))
+
+    def has_host(self, host: str) -> bool:
+        """
+        hostで動いているノードが一覧にあるか
+        :param host: str IPアドレスまたはホスト名 (ポート番号は含まない)
+        """
+        return any(address.rsplit(':', 1)[0].strip('[]') == host for address in list(self.peers))
+
+    def add(self, address: str, uuid: str, key: str, pruned: bool = False) -> 'Peer':
+        """
+        ノードを追加する
+        一覧がいっぱいのときは通信できていないノードと入れ替え，
+        入れ替えられるノードがなければ追加せずにNoneを返す
+        """
+        with self.lock:
+            peer = self.peers.get(address)
+            if peer is not None:
+                peer.uuid = uuid
+                peer.key = key
+                peer.pruned = pruned
+                return peer
+            if len(self.peers) >= self.max_peers:
+                worst = max(self.peers.values(), key=lambda p: (p.failures, -(p.last_seen or 0.0)))
+                if worst.failures == 0:
+                    return None
+                del self.peers[worst.address]
+            peer = Peer(address, uuid, key, self.clock(), pruned)
+            self.peers[address] = peer
+            self.evicted.pop(address, None)
+            return peer
+
+    def remove(self, address: str):
+        with self.lock:
+            self.peers.pop(address, None)
+
+    def to_dict(self) -> dict:
+        """
+        ノード一覧を{ip:port: {uuid, key}}の形で返す
+        """
+        return {address: peer.to_dict() for address, peer in list(self.peers.items())}
+
+    def since(self, timestamp: float, limit: int = None):
+        """
+        timestamp以降に追加されたノードを最大limit件ランダムに選んで返す
+        切り詰めたときは送らなかったノードも次回また選ばれるように，cursorを進めずにtimestampのまま返す
+        :return: ({ip:port: {uuid, key}}, 次回sinceに指定するcursor, 件数を切り詰めたか)
+        """
+        limit = limit or self.SAMPLE_SIZE
+        cursor = self.clock()
+        peers = [peer for peer in list(self.peers.values()) if peer.added_at > timestamp]
+        truncated = len(peers) > limit
+        if truncated:
+            peers = random.sample(peers, limit)
+            cursor = timestamp
+        return {peer.address: peer.to_dict() for peer in peers}, cursor, truncated
+
+    def ordered(self) -> List['Peer']:
+        """
+        通信可能なノードを応答が速い順に返す
+        応答時間が未計測のノードは先に試す
+        """
+        now = self.clock()
+        peers = [peer for peer in list(self.peers.values()) if peer.healthy(now)]
+        return sorted(peers, key=lambda p: p.latency or 0.0)
+
+    def record_success(self, peer: 'Peer', elapsed: float):
+        if peer.latency is None:
+            peer.latency = elapsed
+        else:
+            peer.latency += self.LATENCY_WEIGHT * (elapsed - peer.latency)
+        peer.failures = 0
+        peer.retry_at = 0.0
+        peer.last_seen = self.clock()
+
+    def record_failure(self, peer: 'Peer'):
+        peer.failures += 1
+        if peer.failures >= self.max_failures:
+            print(f'evict node: {peer.address}')
+            self.remove(peer.address)
+            with self.lock:
+                self.evicted[peer.address] = self.clock() + self.evicted_backoff
+                self.evicted.move_to_end(peer.address)
+                while len(self.evicted) > self.max_peers:
+                    self.evicted.popitem(last=False)
+            return
+        delay = min(self.backoff * 2 ** (peer.failures - 1), self.max_backoff)
+        peer.retry_at = self.clock() + delay
+
+    def due_evicted(self) -> List[str]:
+        """
+        ハンドシェイクし直す時刻になった削除済みのノード
+        失敗したときのために，次に試す時刻をevicted_backoff秒後にしておく
+        """
+        now = self.clock()
+        with self.lock:
+            due = [address for address, retry_at in self.evicted.items() if retry_at <= now]
+            for address in due:
+                self.evicted[address] = now + self.evicted_backoff
+        return due
+
+    @property
+    def executor(self) -> 'ThreadPoolExecutor':
+        """
+        初めて並列に送るときにスレッドプールを作る
+        """
+        with self.lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pool_size, thread_name_prefix='peers', initializer=self._mark_worker)
+            return self._executor
+
+    def _mark_worker(self):
+        self._local.worker = True
+
+    def map(self, fn, items: list) -> list:
+        """
+        itemsのそれぞれにfnを適用する
+        transportが並列に使えるならスレッドで並列に行う
+        プールのスレッドの中から呼ばれたときは，空きを待ってデッドロックしないようにその場で順に行う
+        """
+        if not items:
+            return []
+        if not self.transport.parallel or len(items) == 1 or getattr(self._local, 'worker', False):
+            return list(map(fn, items))
+        return list(self.executor.map(fn, items))
+
+    def close(self):
+        """
+        スレッドプールを止める
+        """
+        with self.lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def request(self, method: str, address: str, path: str, **kwargs) -> 'requests.Response':
+        """
+        ノードにリクエストを送り，通信状態を記録する
+        接続できなかったらPeerErrorを返す
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        peer = self.peers.get(address)
+        start = self.clock()
+        try:
+            response = self.transport.request(method, address, path, **kwargs)
+        except PeerError:
+            if peer is not None:
+                self.record_failure(peer)
+            raise
+        if peer is not None:
+            self.record_success(peer, self.clock() - start)
+        return response
+
+    def get(self, address: str, path: str, **kwargs) -> 'requests.Response':
+        return self.request('GET', address, path, **kwargs)
+
+    def post(self, address: str, path: str, **kwargs) -> 'requests.Response':
+        return self.request('POST', address, path, **kwargs)
+
+    def handshake(self, address: str):
+        """
+        ノードのuuidと公開鍵，古いブロックを刈り込んでいるかを取得する
+        /handshakeがないノードには/uuidと/publickeyを並列に問い合わせる
+        失敗したらPeerErrorを返す
+        :return: (uuid, key, pruned)
+        """
+        response = self.get(address, '/handshake')
+        if response.status_code == 200:
+            values = response.json()
+            return values['uuid'], values['key'], values.get('pruned', False)
+        if response.status_code != 404:
+            raise PeerError(f'{address}: GET handshake failed')
+        uuid, key = self.map(lambda path: self.get(address, path), ['/uuid', '/publickey'])
+        if uuid.status_code != 200:
+            raise PeerError(f'{address}: GET uuid failed')
+        if key.status_code != 200:
+            raise PeerError(f'{address}: GET pubkey failed')
+        return uuid.json()['uuid'], key.json()['key'], False
+
+    def broadcast(self, method: str, path: str, **kwargs) -> List[str]:
+        """
+        通信可能な全ノードへ並列にリクエストを送る
+        応答が速いノードから順に送信する
+        :return: List[str] 失敗したノードのアドレス
+        """
+        peers = self.ordered()
+        if not peers:
+            return []
+        def send(peer):
+            try:
+                response = self.request(method, peer.address, path, **kwargs)
+                return response.status_code == 200
+            except PeerError as err:
+                print(err)
+                return False
+        results = self.map(send, peers)
+        return [peer.address for peer, ok in zip(peers, results) if not ok]
+
+    def discover(self, exclude: str = None) -> int:
+        """
+        他のノードが知っているノードを取得して登録する
+        各ノードには前回からの差分だけを問い合わせ，
+        未知のノードとのハンドシェイクは並列に行う
+        失敗が続いて削除したノードにも，evicted_backoff秒ごとにハンドシェイクし直す
+        :param exclude: 自分自身のアドレス
+        :return: int 追加したノード数
+        """
+        def fetch(peer):
+            cursor = peer.cursor
+            try:
+                response = self.get(peer.address, '/nodes', params={'since': cursor, 'limit': self.SAMPLE_SIZE})
+            except PeerError as err:
+                print(err)
+                return {}
+            if response.status_code != 200:
+                return {}
+            values = response.json()
+            if 'cursor' not in values:
+                # sinceに対応していないノードはノード一覧をそのまま返す
+                return values
+            peer.cursor = values['cursor']
+            return values['nodes']
+        retry = [address for address in self.due_evicted() if address not in self.peers]
+        results = self.map(fetch, self.ordered())
+        candidates = set()
+        for others in results:
+            candidates.update(address for address in others if address != exclude and address not in self.peers)
+        candidates.difference_update(retry)
+        # 一覧に空きがある分だけ問い合わせる
+        room = max(self.max_peers - len(self.peers) - len(retry), 0)
+        candidates = random.sample(sorted(candidates), min(room, len(candidates)))
+        return self.connect_all(retry + candidates)
+
+    def connect_all(self, addresses: List[str]) -> int:
+        """
+        ノードと並列にハンドシェイクして追加する
+        :return: int 追加したノード数
+        """
+        def connect(address):
+            try:
+                uuid, key, pruned = self.handshake(address)
+            except (PeerError, ValueError, KeyError) as err:
+                print(err)
+                return False
+            return self.add(address, uuid, key, pruned) is not None
+        return sum(self.map(connect, addresses))
@@ -0,0 +1,98 @@
+import threading
+from blockchain import Blockchain, Block
+
+def mine_block(blockchain: Blockchain, reward, max_transactions: int = None, max_bytes: int = None) -> Block:
+    """
+    PoWを行い，未承認のトランザクションを上限まで取り込んだブロックを追加する
+    PoWの間に他のノードのブロックで最後のブロックが変わったらやり直す
+    :param reward: 報酬のトランザクションを作る関数 () -> Transaction
+    :return: Block
+    """
+    while True:
+        last_block = blockchain.last_block
+        proof = blockchain.proof_of_work(last_block.proof)
+        with blockchain.lock:
+            if blockchain.last_block is not last_block:
+                continue
+            return blockchain.new_block(proof, reward=reward(), max_transactions=max_transactions, max_bytes=max_bytes)
+
+class BlockProducer(object):
+    """
+    未承認のトランザクションが一定数(または一定の大きさ)たまるか，
+    前のブロックから一定時間たったら自動でブロックを作る
+    """
+    def __init__(self, blockchain: Blockchain, reward, max_transactions: int = None, max_bytes: int = None,
+                 interval: float = None, on_block=None, poll: float = 1.0):
+        """
+        :param reward: 報酬のトランザクションを作る関数 () -> Transaction
+        :param max_transactions: int この数たまったらブロックを作る．ブロックに入れる数の上限にもなる
+        :param max_bytes: int この大きさたまったらブロックを作る．ブロックの大きさの上限にもなる
+        :param interval: float 前のブロックからこの秒数たったら，たまっている分でブロックを作る
+        :param on_block: ブロックを作ったあとに呼ぶ関数 (Block) -> None
+        """
+        self.blockchain = blockchain
+        self.reward = reward
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.on_block = on_block
+        self.poll = poll
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.produced = 0
+        self.thread = None
+
+    def ready(self) -> bool:
+        """
+        ブロックを作る条件を満たしているか
+        未承認のトランザクションがなければ作らない
+        """
+        mempool = self.blockchain.current_transactions
+        if len(mempool) == 0:
+            return False
+        if self.max_transactions is not None and len(mempool) >= self.max_transactions:
+            return True
+        if self.max_bytes is not None and mempool.bytes >= self.max_bytes:
+            return True
+        if self.interval is not None and self.blockchain.clock() - self.blockchain.last_block.timestamp >= self.interval:
+            return True
+        return False
+
+    def produce(self) -> Block:
+        block = mine_block(self.blockchain, self.reward, self.max_transactions, self.max_bytes)
+        self.produced += 1
+        if self.on_block is not None:
+            self.on_block(block)
+        return block
+
+    def notify(self):
+        """
+        トランザクションが追加されたときに呼び，条件をすぐに確かめる
+        """
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.poll)
+            self.wakeup.clear()
+            # 上限を超えてたまっている分は続けてブロックにする
+            while not self.stopped and self.ready():
+                try:
+                    block = self.produce()
+                except Exception as err:
+                    print(f'block production failed: {err}')
+                    break
+                if len(block.transactions) <= 1:
+                    # 報酬しか入らなかった (先頭のトランザクションが上限に入らない)
+                    # 条件を満たしたままなので，続けると報酬だけのブロックを作り続ける
+                    print('block production stalled: the oldest transaction does not fit in a block')
+                    break
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='block-producer', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
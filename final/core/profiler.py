@@ -0,0 +1,143 @@
+import os
+import sys
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from time import perf_counter, sleep, time
+
+def collapse(frame) -> str:
+    """
+    フレームのスタックを根元から ; でつないだ1行にする (flamegraph.plやspeedscopeの形式)
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+def format_collapsed(stacks: Counter) -> str:
+    """
+    スタックごとのサンプル数を "スタック 回数" の行にする
+    """
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+def sample(seconds: float, interval: float = 0.005) -> Counter:
+    """
+    呼び出したスレッド以外の全スレッドのスタックをseconds秒間，interval秒ごとに記録する
+    :return: Counter {スレッド名;スタック: サンプル数}
+    """
+    me = threading.get_ident()
+    names = {}
+    stacks = Counter()
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            if ident not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            stacks[f'{names.get(ident, ident)};{collapse(frame)}'] += 1
+        sleep(interval)
+    return stacks
+
+class RequestProfile(object):
+    def __init__(self, id: int, method: str, path: str):
+        self.id = id
+        self.method = method
+        self.path = path
+        self.timestamp = time()
+        self.start = perf_counter()
+        self.duration = None
+        # リクエストを受け付けたスレッド
+        self.origin = threading.get_ident()
+        self.threads = {self.origin}
+        self.stacks = Counter()
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'timestamp': self.timestamp,
+            'duration_ms': round(self.duration * 1000, 2),
+            'samples': sum(self.stacks.values()),
+        }
+
+class SlowRequestRecorder(object):
+    """
+    処理中のリクエストのスレッドだけをサンプリングし，
+    threshold秒より遅かったリクエストのプロファイルを最大keep件残す
+    """
+    def __init__(self, threshold: float, interval: float = 0.01, keep: int = 50):
+        self.threshold = threshold
+        self.interval = interval
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.active = set()
+        self.slow = OrderedDict()
+        self.count = 0
+        self.thread = None
+
+    def begin(self, method: str, path: str) -> RequestProfile:
+        """
+        リクエストの開始時に呼ぶ．呼んだスレッドをサンプリングの対象にする
+        """
+        with self.lock:
+            self.count += 1
+            record = RequestProfile(self.count, method, path)
+            self.active.add(record)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='slow-request-sampler', daemon=True)
+                self.thread.start()
+        return record
+
+    @contextmanager
+    def attach(self, record: RequestProfile):
+        """
+        リクエストの処理を別のスレッドで行う間，そのスレッドもサンプリングする
+        """
+        ident = threading.get_ident()
+        if record is not None:
+            record.threads.add(ident)
+        try:
+            yield
+        finally:
+            if record is not None:
+                record.threads.discard(ident)
+
+    def finish(self, record: RequestProfile) -> bool:
+        """
+        リクエストの終了時に呼ぶ
+        :return: bool 遅いリクエストとして残したらtrue
+        """
+        record.duration = perf_counter() - record.start
+        with self.lock:
+            self.active.discard(record)
+            if record.duration < self.threshold:
+                return False
+            self.slow[record.id] = record
+            while len(self.slow) > self.keep:
+                self.slow.popitem(last=False)
+        return True
+
+    def get(self, id: int) -> RequestProfile:
+        return self.slow.get(id)
+
+    def to_list(self) -> list:
+        return [record.to_dict() for record in reversed(list(self.slow.values()))]
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            with self.lock:
+                records = list(self.active)
+            if not records:
+                continue
+            frames = sys._current_frames()
+            for record in records:
+                for ident in tuple(record.threads):
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        record.stacks[collapse(frame)] += 1
@@ -0,0 +1,96 @@
+import threading
+from dns import DNS, DNSError, TYPE_A, TYPE_SRV, TYPE_TXT
+from peers import PeerManager
+
+# シード名に付けてSRVレコードを引くサービス名
+SRV_PREFIX = '_blockchain._tcp.'
+
+def resolve_seed(seed: str):
+    """
+    シード名からノードのアドレスを集める
+    _blockchain._tcp.<seed> のSRVレコードと，<seed> のTXTレコード(ip:port)を使う
+    :return: (List[ip:port], 最小のTTL)
+    """
+    addresses = []
+    ttls = []
+    try:
+        response = DNS.query(SRV_PREFIX + seed, TYPE_SRV)
+        # SRVのtargetのAレコードは追加セクションに入っていることが多い
+        known = {}
+        for record in response.additionals:
+            if record.rtype == TYPE_A:
+                known.setdefault(record.name.lower(), record.data)
+        for record in response.answers:
+            if record.rtype != TYPE_SRV:
+                continue
+            priority, weight, port, target = record.data
+            ip = known.get(target.lower())
+            if ip is None:
+                try:
+                    a = DNS.lookup(target, TYPE_A)
+                except DNSError as err:
+                    print(err)
+                    continue
+                if not a:
+                    continue
+                ip = a[0].data
+                ttls.append(a[0].ttl)
+            addresses.append(f'{ip}:{port}')
+            ttls.append(record.ttl)
+    except DNSError as err:
+        print(f'SRV lookup failed: {err}')
+    try:
+        for record in DNS.lookup(seed, TYPE_TXT):
+            for text in record.data:
+                for address in text.split():
+                    if ':' in address:
+                        addresses.append(address)
+            ttls.append(record.ttl)
+    except DNSError as err:
+        print(f'TXT lookup failed: {err}')
+    return list(dict.fromkeys(addresses)), min(ttls) if ttls else None
+
+class SeedDiscovery(object):
+    """
+    シード名からノード一覧を作り，TTLが切れるたびに更新する
+    """
+    def __init__(self, peers: PeerManager, seed: str, exclude: str = None, min_interval: float = 30.0, max_interval: float = 3600.0):
+        self.peers = peers
+        self.seed = seed
+        self.exclude = exclude
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timer = None
+
+    def refresh(self) -> int:
+        """
+        シード名を引き直し，知らないノードと並列にハンドシェイクする
+        次の更新はTTLが切れたときに行う
+        :return: int 追加したノード数
+        """
+        ttl = None
+        try:
+            addresses, ttl = resolve_seed(self.seed)
+            addresses = [a for a in addresses if a != self.exclude and a not in self.peers]
+            count = self.peers.connect_all(addresses)
+            print(f'seed {self.seed}: {count} nodes added')
+            return count
+        finally:
+            interval = self.min_interval if ttl is None else ttl
+            self.schedule(min(max(interval, self.min_interval), self.max_interval))
+
+    def schedule(self, interval: float):
+        self.timer = threading.Timer(interval, self.refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def start(self):
+        """
+        バックグラウンドで最初の問い合わせを行う
+        """
+        self.schedule(0)
+        return self
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
@@ -1,225 +1,855 @@
-import copy
 import json
 import argparse
+import hmac
+import threading
+from concurrent.futures import TimeoutError
+from functools import wraps
 from textwrap import dedent
 from time import time
 from uuid import uuid4
-from flask import Flask, jsonify, request
-import requests
+from flask import Flask, Response, copy_current_request_context, jsonify, request
 from base64 import b64decode, b64encode
 from flask_cors import CORS
-from blockchain import Blockchain, Transaction
-from util import sign, verify
+from blockchain import Blockchain, Block, Transaction
+from peers import PeerManager, PeerError
+from seed import SeedDiscovery
+from validation import ChainValidator
+from snapshot import SnapshotError, export_snapshot, import_snapshot, load_snapshot
+from util import Signer, verify
+from codec import BINARY_MIMETYPE, CodecError, encode_transactions, decode_transactions, decode_blocks, transaction_size, validate_transactions
+from cache import ChainCache, accepted_encoding
+from bloom import SeenFilter
+from compact import CompactBlockError, compact_block, parse_message
+from admission import Overloaded, RateLimiter, WorkQueue, retry_after_header
+from producer import BlockProducer, mine_block
+from archive import BlockArchive
+from analytics import AnalyticsError, ChainStats
+from profiler import SlowRequestRecorder, format_collapsed, sample
+from chainio import FORMATS, ChainIOError, import_chain, iter_chain
+from journal import MempoolJournal
+from sharding import ShardedMempool, ShardError
 
-parser = argparse.ArgumentParser(description="blockchain example")
-parser.add_argument('ip', type=str)
-parser.add_argument('port', type=int)
-parser.add_argument('--key', type=str, default="key.pem")
-args = parser.parse_args()
+# /admin/profileで一度にサンプリングできる最大秒数
+MAX_PROFILE_SECONDS = 60
+# 遅いリクエストのプロファイルを入れておくWSGI環境変数のキー
+PROFILE_KEY = 'blockchain.profile'
 
-app = Flask(__name__)
-# CORSを許可する
-CORS(app)
-node_identifier = str(uuid4()).replace('-', '')
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="blockchain example")
+    parser.add_argument('ip', type=str)
+    parser.add_argument('port', type=int)
+    parser.add_argument('--key', type=str, default="key.pem")
+    parser.add_argument('--dns', type=str, default=None, help='dns server used to resolve node names as <ip>:<port>')
+    parser.add_argument('--seed', type=str, default=None, help='domain whose SRV/TXT records list the nodes to connect to')
+    parser.add_argument('--peer-timeout', type=float, default=3.0, help='timeout of requests to other nodes (sec)')
+    parser.add_argument('--peer-max-failures', type=int, default=5, help='evict a node after this many consecutive failures')
+    parser.add_argument('--max-peers', type=int, default=256, help='max size of the address book')
+    parser.add_argument('--snapshot', type=str, default=None, help='bootstrap from a snapshot file or URL')
+    parser.add_argument('--trusted-key', type=str, action='append', default=[], help='public key file trusted to sign snapshots')
+    parser.add_argument('--import-chain', type=str, action='append', default=[],
+                        help='load the chain from exported ndjson/binary files (.gz ok) read in order')
+    parser.add_argument('--checkpoint', type=str, action='append', default=[], help='trusted block hash as <index>:<hash>')
+    parser.add_argument('--seen-capacity', type=int, default=100000, help='transactions/blocks remembered per generation of the seen filter')
+    parser.add_argument('--seen-error-rate', type=float, default=0.001, help='false positive rate of the seen filter')
+    parser.add_argument('--max-orphans', type=int, default=256, help='max blocks kept while waiting for their parent')
+    parser.add_argument('--no-compress', action='store_true', help='do not compress /chain responses')
+    parser.add_argument('--validation-workers', type=int, default=None, help='processes used to validate received chains (default: cpu count)')
+    parser.add_argument('--rate-limit', type=float, default=50.0, help='write requests per second allowed per client (0: unlimited)')
+    parser.add_argument('--rate-burst', type=float, default=100.0, help='burst size of the per-client rate limit')
+    parser.add_argument('--peer-rate-limit', type=float, default=500.0, help='write requests per second allowed per registered node (0: unlimited)')
+    parser.add_argument('--peer-rate-burst', type=float, default=1000.0, help='burst size of the per-node rate limit')
+    parser.add_argument('--intake-workers', type=int, default=4, help='threads handling transaction and block intake')
+    parser.add_argument('--intake-queue', type=int, default=64, help='max requests waiting for an intake worker')
+    parser.add_argument('--mine-queue', type=int, default=2, help='max /mine requests waiting for the miner')
+    parser.add_argument('--admission-timeout', type=float, default=30.0, help='give up waiting for a queued request after this many seconds')
+    parser.add_argument('--block-max-txs', type=int, default=1000, help='max transactions in a block (including the reward)')
+    parser.add_argument('--block-max-bytes', type=int, default=1000000, help='max size of the transactions in a block')
+    parser.add_argument('--auto-mine', action='store_true', help='mine a block when the limits above are reached or --block-interval passes')
+    parser.add_argument('--block-interval', type=float, default=60.0, help='max seconds between blocks with --auto-mine')
+    parser.add_argument('--prune', type=int, default=None, help='keep transactions of only this many recent blocks (default: keep all)')
+    parser.add_argument('--archive-dir', type=str, default=None, help='write pruned blocks to this directory as ndjson')
+    parser.add_argument('--journal', type=str, default=None, help='keep pending transactions in this file across restarts')
+    parser.add_argument('--shards', type=int, default=0, help='processes holding the mempool sharded by sender (0: in this process)')
+    parser.add_argument('--slow-ms', type=float, default=None, help='keep a sampled profile of requests slower than this (ms)')
+    parser.add_argument('--admin-token', type=str, default=None, help='X-Admin-Token required by /admin (default: only from localhost)')
+    return parser
 
-privatekey = open(args.key).read()
-publickey = open(args.key + '.pub').read()
-
-blockchain = Blockchain()
-
-@app.route('/uuid', methods=['GET'])
-def getUuid():
+def parse_args(argv: list = None) -> argparse.Namespace:
     """
-    GET /uuid
-    uuidを取得する
+    コマンドライン引数を設定にする
     """
-    return jsonify({'uuid': node_identifier}), 200
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.prune is not None and args.prune < 1:
+        parser.error('--prune must be at least 1')
+    if args.block_max_txs < 2:
+        # 報酬のトランザクションだけで埋まってしまう
+        parser.error('--block-max-txs must be at least 2')
+    if args.shards and args.journal:
+        parser.error('--journal cannot be used with --shards')
+    return args
 
-@app.route('/publickey', methods=['GET'])
-def getpubkey():
-    """
-    GET /publickey
-    公開鍵を取得する
+def default_config(**overrides) -> argparse.Namespace:
     """
-    return jsonify({'key': publickey}), 200
-
-@app.route('/transactions', methods=['GET'])
-def get_transactions():
-    return jsonify({'transactions': list(map(lambda t: t.__dict__, blockchain.current_transactions))}), 200
-
-@app.route('/transactions/add', methods=['POST'])
-def add_transactions():
-    values = request.get_json()
-    sender = values['sender']
-    recipient = values['recipient']
-    amount = int(values['amount'])
-    timestamp = values['timestamp']
-    signature = values['signature']
-    index = blockchain.new_transaction(sender, recipient, amount, timestamp, signature)
-    result = {'message': f'transaction append {index} into block'}
-    return jsonify(result), 200
-
-@app.route('/transactions/new', methods=['POST'])
-def new_transactions():
+    コマンドラインのデフォルト値にoverridesを上書きした設定
     """
-    POST /transactions/new
-    新しいトランザクションを追加する
-    {'sender': value, 'recipient': value, 'amount': value}
-    """
-    values = request.get_json()
-    timestamp = time()
-    signature = sign(privatekey, timestamp)
-    index = blockchain.new_transaction(values['sender'], values['recipient'], int(values['amount']), timestamp, signature)
-    # 他のノードへトランザクションを共有
-    transaction = {
-        'sender': values['sender'],
-        'recipient': values['recipient'],
-        'amount': int(values['amount']),
-        'timestamp': timestamp,
-        'signature': signature,
-    }
-    for node in blockchain.nodes:
-        response = requests.post(f'http://{node}/transactions/add', json=transaction)
-        if response.status_code != 200:
-            return 'Cannot send transaction', 500
-    result = {'message': f'transaction append {index} into block'}
-    return jsonify(result), 200
-
-@app.route('/nodes', methods=['GET'])
-def get_nodes():
+    args = build_parser().parse_args([str(overrides.get('ip', '127.0.0.1')), str(overrides.get('port', 5000))])
+    vars(args).update(overrides)
+    return args
+
+def overloaded(err: Overloaded, status: int):
+    response = jsonify({'message': f'error: {err}', 'retry_after': err.retry_after})
+    response.status_code = status
+    response.headers['Retry-After'] = retry_after_header(err.retry_after)
+    return response
+
+# 1リクエストで受け付けるトランザクションの最大数
+MAX_BATCH_SIZE = 10000
+# mempoolのシャードが落ちたときに再送を待ってもらう秒数 (起動し直したシャードは次のリクエストから使える)
+SHARD_RETRY_AFTER = 1.0
+
+def load_transactions():
     """
-    GET /nodes
-    ノード一覧を取得する
+    リクエストボディからトランザクションの配列を読み込む
+    JSON(オブジェクトまたは配列)とバイナリ形式に対応する
+    失敗したらValueErrorを返す
+    :return: List[dict]
     """
-    return jsonify(blockchain.nodes), 200
+    if request.mimetype == BINARY_MIMETYPE:
+        values = decode_transactions(request.get_data())
+    else:
+        values = request.get_json(silent=True)
+        if isinstance(values, dict):
+            values = [values]
+    if not isinstance(values, list):
+        raise ValueError('transactions must be an array')
+    if len(values) > MAX_BATCH_SIZE:
+        raise ValueError(f'too many transactions (max {MAX_BATCH_SIZE})')
+    return values
 
-@app.route('/nodes/register', methods=['POST'])
-def register_nodes():
+def create_app(config) -> Flask:
     """
-    POST /nodes/register
-    新しいノードを登録する
+    設定からノードを作り，APIのFlaskアプリケーションを返す
+    モジュールを読み込んだだけではノードを作らないので，ツールやテストからも使える
+    作ったノードは app.extensions['blockchain'], app.extensions['producer'] から取り出せる
+    鍵やスナップショット，チェーンのファイルを読み込めなければ例外を返す
+    :param config: argparse.Namespace または dict (指定しなかった項目はコマンドラインのデフォルト値)
+    :return: Flask
     """
-    values = request.get_json()
-    node = values.get('node')
-    if node is None:
-        return "error: invalid node", 400
+    args = default_config(**config) if isinstance(config, dict) else config
+    if args.prune is not None and args.prune < 1:
+        raise ValueError('prune must be at least 1')
+    if args.block_max_txs is not None and args.block_max_txs < 2:
+        raise ValueError('block_max_txs must be at least 2')
+    if args.shards and args.journal:
+        raise ValueError('journal cannot be used with shards')
+
+    app = Flask(__name__)
+    # CORSを許可する
+    CORS(app)
+    node_identifier = str(uuid4()).replace('-', '')
+    app.config['NODE_IDENTIFIER'] = node_identifier
+
+    # 秘密鍵は起動時に1度だけパースする
     try:
-        domain, port = node.split(':')
-        blockchain.register_node(domain, port)
+        signer = Signer.load(args.key)
+    except (OSError, ValueError) as err:
+        print(f'cannot load key: {err}')
+        raise
+    publickey = signer.publickey
+    # 報酬と一緒にブロックに入らないトランザクションは受け付けない
+    # いつまでも取り出されずに残り，自動マイニングが報酬だけのブロックを作り続けるため
+    signature = signer.sign(0.0)
+    max_transaction_bytes = None
+    if args.block_max_bytes is not None:
+        max_transaction_bytes = args.block_max_bytes - transaction_size({'sender': 'mining', 'recipient': node_identifier, 'signature': signature})
+        if max_transaction_bytes < transaction_size({'sender': '', 'recipient': '', 'signature': signature}):
+            raise ValueError('block_max_bytes is too small for the reward and a transaction')
+    # 署名する前のトランザクションは，自分の署名の分を引いた大きさまで
+    max_unsigned_bytes = None if max_transaction_bytes is None else max_transaction_bytes - len(signature.encode())
+
+    if args.dns:
+        from dns import DNS
+        dns_ip, dns_port = args.dns.split(':')
+        DNS.server = (dns_ip, int(dns_port))
+
+    checkpoints = {}
+    for checkpoint in args.checkpoint:
+        index, block_hash = checkpoint.split(':')
+        checkpoints[int(index)] = block_hash
+    blockchain = Blockchain(
+        PeerManager(timeout=args.peer_timeout, max_failures=args.peer_max_failures, max_peers=args.max_peers),
+        checkpoints=checkpoints,
+        validator=ChainValidator(workers=args.validation_workers),
+        seen=SeenFilter(args.seen_capacity, args.seen_error_rate),
+        max_orphans=args.max_orphans,
+        prune=args.prune,
+        archive=BlockArchive(args.archive_dir) if args.archive_dir else None,
+    )
+    if args.shards:
+        # 未承認のトランザクションの管理と署名をシャードのプロセスに任せる
+        blockchain.current_transactions = ShardedMempool(args.shards, args.key, args.seen_capacity, args.seen_error_rate)
+    if args.snapshot:
+        # スナップショットから起動する
+        try:
+            trusted_keys = [open(path).read() for path in args.trusted_key]
+            import_snapshot(blockchain, load_snapshot(args.snapshot), trusted_keys)
+            print(f'bootstrapped from snapshot at {blockchain.height}')
+        except (SnapshotError, OSError, ValueError) as err:
+            print(f'cannot load snapshot: {err}')
+            raise
+    if args.import_chain:
+        # 書き出したチェーンのファイルから起動する
+        try:
+            count = import_chain(blockchain, args.import_chain)
+            print(f'imported {count} blocks, height {blockchain.height}')
+        except (ChainIOError, OSError) as err:
+            print(f'cannot import chain: {err}')
+            raise
+    journal = None
+    if args.journal:
+        # 前回までの未承認のトランザクションを読み直す
+        journal = MempoolJournal(args.journal)
+        replayed = journal.replay()
+        blockchain.current_transactions.extend(replayed)
+        journal.attach(blockchain.current_transactions)
+        print(f'replayed {len(replayed)} transactions from {args.journal}')
+
+    # /chainのレスポンスのキャッシュ
+    chain_cache = ChainCache()
+    # /statsの集計用の列
+    chain_stats = ChainStats()
+
+    # 書き込み系のリクエストの流量制御
+    # 受け付けきれないときは待たせずに429/503を返し，読み込み系のリクエストを守る
+    rate_limiter = RateLimiter(args.rate_limit, args.rate_burst)
+    # 登録済みのノードからの共有はbroadcastでまとめて届くので別の高い上限にする
+    # /nodes/registerは誰でも呼べるので，制限をなくすと登録するだけで流量制限を外せてしまう
+    peer_rate_limiter = RateLimiter(args.peer_rate_limit, args.peer_rate_burst)
+    intake_queue = WorkQueue('intake', workers=args.intake_workers, maxsize=args.intake_queue)
+    # PoWは重いので1スレッドで順番に行う
+    mine_queue = WorkQueue('mine', workers=1, maxsize=args.mine_queue)
+
+    # 遅いリクエストのプロファイル (--slow-ms)
+    slow_requests = SlowRequestRecorder(args.slow_ms / 1000) if args.slow_ms else None
+    # /admin/profileは同時に1つだけ行う
+    profile_lock = threading.Lock()
+
+    @app.before_request
+    def begin_profile():
+        if slow_requests is not None and not request.path.startswith('/admin/'):
+            request.environ[PROFILE_KEY] = slow_requests.begin(request.method, request.path)
+
+    @app.teardown_request
+    def finish_profile(exc):
+        # copy_current_request_contextで別のスレッドに渡したコンテキストの終了では何もしない
+        record = request.environ.get(PROFILE_KEY)
+        if record is None or record.origin != threading.get_ident():
+            return
+        if slow_requests.finish(record):
+            print(f'slow request: {record.method} {record.path} {record.duration * 1000:.1f}ms (GET /admin/slow/{record.id})')
+
+    def profiled(view):
+        """
+        別のスレッドで処理する間も遅いリクエストのサンプリングを続ける
+        """
+        record = request.environ.get(PROFILE_KEY)
+        if record is None:
+            return view
+        @wraps(view)
+        def wrapper(*a, **kw):
+            with slow_requests.attach(record):
+                return view(*a, **kw)
+        return wrapper
+
+    def admitted(work_queue: WorkQueue):
+        """
+        クライアントごとの流量制限をかけ，処理をwork_queueのスレッドで行う
+        制限を超えたら429，キューがいっぱいなら503をRetry-After付きで返す
+        登録済みのノードからの共有はbroadcastが429を再送せず伝播が止まるので，より高い上限のバケットで制限する
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*a, **kw):
+                try:
+                    if blockchain.peers.has_host(request.remote_addr):
+                        peer_rate_limiter.check(request.remote_addr)
+                    else:
+                        rate_limiter.check(request.remote_addr)
+                except Overloaded as err:
+                    return overloaded(err, 429)
+                try:
+                    future = work_queue.submit(copy_current_request_context(profiled(view)), *a, **kw)
+                except Overloaded as err:
+                    return overloaded(err, 503)
+                try:
+                    return future.result(timeout=args.admission_timeout)
+                except TimeoutError:
+                    # まだ始まっていなければ取り消して503を返す
+                    if future.cancel():
+                        return overloaded(Overloaded(f'{work_queue.name} timed out', work_queue.retry_after()), 503)
+                    # 始まった処理は止められないので，終わるまで待って結果を返す
+                    # 503を返すと，処理は済んでいるのにクライアントが再送して二重にマイニング・署名してしまう
+                    return future.result()
+            return wrapper
+        return decorator
+
+    def append_transactions(values: list) -> int:
+        """
+        署名済みのトランザクションを検証して未承認のトランザクションに追加する
+        複数の経路から届いた処理済みのトランザクションは捨てる
+        --shardsのときは検証からシャードのプロセスで並列に行う
+        失敗したらValueErrorを返す
+        :param values: List[dict]
+        :return: int 追加した数
+        """
+        mempool = blockchain.current_transactions
+        if isinstance(mempool, ShardedMempool):
+            return mempool.add(values, max_transaction_bytes)
+        return blockchain.receive_transactions(values, max_transaction_bytes)
+
+    def sign_transactions(values: list) -> list:
+        """
+        トランザクションを検証し，署名して未承認のトランザクションに追加する
+        --shardsのときは検証と署名もシャードのプロセスで並列に行う
+        失敗したらValueErrorを返す
+        :param values: List[dict] sender, recipient, amount
+        :return: List[dict] timestamp, signatureを付けたもの
+        """
+        mempool = blockchain.current_transactions
+        if isinstance(mempool, ShardedMempool):
+            return mempool.sign(values, max_unsigned_bytes)
+        transactions = validate_transactions(values, signed=False, max_bytes=max_unsigned_bytes)
+        for t in transactions:
+            t['timestamp'] = time()
+            t['signature'] = signer.sign(t['timestamp'])
+        blockchain.new_transactions([
+            Transaction.from_dict(t) for t in transactions
+        ])
+        # 他のノードから戻ってきたものは処理しない
+        for t in transactions:
+            blockchain.seen_transaction(t)
+        return transactions
+
+    def accepted_transactions():
+        """
+        未承認のトランザクションを追加したあとに呼ぶ
+        自動マイニングに知らせ，再起動しても失われないようにjournalに書き込まれるまで待つ
+        :return: 書き込めなければエラーのレスポンス，書き込めたらNone
+        """
+        producer.notify()
+        if not blockchain.current_transactions.sync():
+            return 'error: cannot write the mempool journal', 500
+        return None
+
+    @app.route('/uuid', methods=['GET'])
+    def getUuid():
+        """
+        GET /uuid
+        uuidを取得する
+        """
+        return jsonify({'uuid': node_identifier}), 200
+
+    @app.route('/publickey', methods=['GET'])
+    def getpubkey():
+        """
+        GET /publickey
+        公開鍵を取得する
+        """
+        return jsonify({'key': publickey}), 200
+
+    @app.route('/handshake', methods=['GET'])
+    def handshake():
+        """
+        GET /handshake
+        uuidと公開鍵をまとめて取得する
+        古いブロックを刈り込んでいるノードはpruned=trueと，トランザクションを持っている最初のブロックを返す
+        """
         response = {
-            'message': 'new node registerd',
+            'uuid': node_identifier,
+            'key': publickey,
+            'pruned': args.prune is not None,
+            'base': blockchain.full_chain[0].index,
+        }
+        return jsonify(response), 200
+
+    @app.route('/transactions', methods=['GET'])
+    def get_transactions():
+        return jsonify({'transactions': list(map(dict, blockchain.current_transactions))}), 200
+
+    @app.route('/transactions/add', methods=['POST'])
+    @admitted(intake_queue)
+    def add_transactions():
+        """
+        POST /transactions/add
+        既存のトランザクションを追加する
+        1件のオブジェクト, 配列, バイナリ形式を受け付ける
+        """
+        try:
+            length = append_transactions(load_transactions())
+        except (CodecError, ValueError) as err:
+            return f'error: {err}', 400
+        except ShardError as err:
+            return overloaded(Overloaded(str(err), SHARD_RETRY_AFTER), 503)
+        index = blockchain.last_block.index + 1
+        error = accepted_transactions()
+        if error is not None:
+            return error
+        result = {
+            'message': f'transaction append {index} into block',
+            'length': length,
+        }
+        return jsonify(result), 200
+
+    @app.route('/transactions/new', methods=['POST'])
+    @admitted(intake_queue)
+    def new_transactions():
+        """
+        POST /transactions/new
+        新しいトランザクションを追加する
+        {'sender': value, 'recipient': value, 'amount': value}
+        """
+        try:
+            transaction, = sign_transactions([request.get_json(silent=True)])
+        except ValueError as err:
+            return f'error: {err}', 400
+        except ShardError as err:
+            return overloaded(Overloaded(str(err), SHARD_RETRY_AFTER), 503)
+        index = blockchain.last_block.index + 1
+        error = accepted_transactions()
+        if error is not None:
+            return error
+        # 他のノードへトランザクションを共有
+        failed = blockchain.peers.broadcast('POST', '/transactions/add', json=transaction)
+        result = {
+            'message': f'transaction append {index} into block',
+            'failed_nodes': failed,
+        }
+        return jsonify(result), 200
+
+    @app.route('/transactions/batch', methods=['POST'])
+    @admitted(intake_queue)
+    def batch_transactions():
+        """
+        POST /transactions/batch
+        新しいトランザクションをまとめて追加する
+        [{'sender': value, 'recipient': value, 'amount': value}, ...]
+        他のノードへはノードごとに1回のリクエストで共有する
+        """
+        try:
+            transactions = sign_transactions(load_transactions())
+        except (CodecError, ValueError) as err:
+            return f'error: {err}', 400
+        except ShardError as err:
+            return overloaded(Overloaded(str(err), SHARD_RETRY_AFTER), 503)
+        index = blockchain.last_block.index + 1
+        error = accepted_transactions()
+        if error is not None:
+            return error
+        # 他のノードへトランザクションをまとめて共有
+        failed = []
+        if len(blockchain.peers):
+            body = encode_transactions(transactions)
+            failed = blockchain.peers.broadcast('POST', '/transactions/add', data=body, headers={'Content-Type': BINARY_MIMETYPE})
+        result = {
+            'message': f'{len(transactions)} transactions append {index} into block',
+            'length': len(transactions),
+            'failed_nodes': failed,
+        }
+        return jsonify(result), 200
+
+    @app.route('/nodes', methods=['GET'])
+    def get_nodes():
+        """
+        GET /nodes
+        ノード一覧を取得する
+        GET /nodes?since=<timestamp>&limit=<n>
+        sinceより後に追加されたノードを最大limit件ランダムに返す
+        次回はcursorをsinceに指定すると差分だけを取得できる (切り詰めたときはcursorは進まない)
+        """
+        since = request.args.get('since', type=float)
+        if since is None:
+            return jsonify(blockchain.nodes), 200
+        limit = request.args.get('limit', type=int)
+        nodes, cursor, truncated = blockchain.peers.since(since, limit)
+        response = {
+            'nodes': nodes,
+            'cursor': cursor,
+            'truncated': truncated,
+        }
+        return jsonify(response), 200
+
+    @app.route('/nodes/register', methods=['POST'])
+    def register_nodes():
+        """
+        POST /nodes/register
+        新しいノードを登録する
+        """
+        values = request.get_json()
+        node = values.get('node')
+        if node is None:
+            return "error: invalid node", 400
+        try:
+            domain, port = node.split(':')
+            blockchain.register_node(domain, port)
+            response = {
+                'message': 'new node registerd',
+                'total_nodes': blockchain.nodes
+            }
+            return jsonify(response), 200
+        except Exception as err:
+            print(err)
+            return "error occured", 400
+
+    @app.route('/get_other_nodes', methods=['POST'])
+    def reflesh():
+        """
+        POST /get_other_nodes
+        ノード情報を更新する
+        他ノードからノードの情報を得る
+        """
+        count = blockchain.peers.discover(exclude=f'{args.ip}:{args.port}')
+        response = {
+            'message': '%d nodes added' % count,
             'total_nodes': blockchain.nodes
         }
         return jsonify(response), 200
-    except Exception as err:
-        print(err)
-        return "error occured", 400
 
-@app.route('/get_other_nodes', methods=['POST'])
-def reflesh():
-    """
-    POST /get_other_nodes
-    ノード情報を更新する
-    他ノードからノードの情報を得る
-    """
-    count = 0
-    oldNode = copy.deepcopy(blockchain.nodes)
-    for node in oldNode:
-        response = requests.get(f'http://{node}/nodes')
-        if response.status_code == 200:
-            others = response.json()
-            for other in others:
-                if f'{args.ip}:{args.port}' in other:
-                    continue
-                try:
-                    blockchain.register_node(f'http://{other}')
-                    count += 1
-                except Exception as err:
-                    print(err)
-                    return "error occured", 400
+
+    @app.route('/nodes/resolve', methods=['GET'])
+    def consensus():
+        """
+        GET /nodes/resolve
+        ノード間のブロックチェーンのコンフリクトを解消する
+        """
+        replaced = blockchain.resolve_conflicts()
+        chain = chain_cache.json_array(blockchain.full_chain)
+        if replaced:
+            body = b'{"message":"chain replaced","new_chain":%s}' % chain
         else:
-            return "cannot get other nodes", 500
-    response = {
-        'message': '%d nodes added' % count,
-        'total_nodes': blockchain.nodes
-    }
-    return jsonify(response), 200
+            body = b'{"message":"chain consensused","chain":%s}' % chain
+        return Response(body, mimetype='application/json'), 200
 
+    @app.route('/mine', methods=['GET'])
+    @admitted(mine_queue)
+    def mine():
+        """
+        GET /mine
+        マイニングをする
+        """
+        block = mine_block(blockchain, reward_transaction, args.block_max_txs, args.block_max_bytes)
+        # 他のノードへcompact blockを共有
+        announce_block(block)
+        response = {
+            'message': 'new block mining!!',
+            'index': block.index,
+            'transactions': list(map(dict, block.transactions)),
+            'proof': block.proof,
+            'previous_hash': block.previous_hash,
+        }
+        print(response['transactions'])
+        return jsonify(response), 200
 
-@app.route('/nodes/resolve', methods=['GET'])
-def consensus():
-    """
-    GET /nodes/resolve
-    ノード間のブロックチェーンのコンフリクトを解消する
-    """
-    replaced = blockchain.resolve_conflicts()
-    if replaced:
+    def reward_transaction() -> Transaction:
+        """
+        マイニング報酬のトランザクション
+        """
+        timestamp = time()
+        return Transaction("mining", node_identifier, 100, timestamp, signer.sign(timestamp))
+
+    def announce_block(block):
+        """
+        compact blockを他のノードへ送る
+        足りないトランザクションは自分に問い合わせてもらう
+        """
+        message = {'block': compact_block(block), 'node': f'{args.ip}:{args.port}'}
+        return blockchain.peers.broadcast('POST', '/blocks/compact', json=message)
+
+    # 未承認のトランザクションの量と時間でブロックを作る (--auto-mine)
+    producer = BlockProducer(
+        blockchain,
+        reward_transaction,
+        max_transactions=args.block_max_txs,
+        max_bytes=args.block_max_bytes,
+        interval=args.block_interval,
+        on_block=announce_block,
+    )
+
+    @app.route('/blocks/compact', methods=['POST'])
+    @admitted(intake_queue)
+    def receive_compact_block():
+        """
+        POST /blocks/compact
+        他のノードからcompact blockを受け取る
+        {'block': compact block, 'node': 送信元のノード}
+        """
+        try:
+            compact, node = parse_message(request.get_json(silent=True))
+        except CompactBlockError as err:
+            return f'error: {err}', 400
+        if f'block:{compact["hash"]}' in blockchain.seen:
+            return jsonify({'message': 'block already seen'}), 200
+        try:
+            status = blockchain.receive_compact_block(compact, node)
+        except (CompactBlockError, PeerError, KeyError, TypeError, ValueError) as err:
+            print(err)
+            return f'error: {err}', 400
+        if status in ('added', 'reorg'):
+            # メインチェーンが伸びたら自分のノード一覧にも共有する
+            announce_block(blockchain.last_block)
+        return jsonify({'message': f'block {status}', 'index': blockchain.height}), 200
+
+    @app.route('/blocks', methods=['POST'])
+    @admitted(intake_queue)
+    def receive_blocks():
+        """
+        POST /blocks
+        他のノードからブロックを受け取る
+        1件のオブジェクト, 配列, バイナリ形式を受け付け，順番が前後してもよい
+        親がまだ届いていないブロックは親が届くまで保持する
+        """
+        try:
+            if request.mimetype == BINARY_MIMETYPE:
+                values = decode_blocks(request.get_data())
+            else:
+                values = request.get_json(silent=True)
+                if isinstance(values, dict):
+                    values = [values]
+            if not isinstance(values, list):
+                raise ValueError('blocks must be an array')
+            blocks = [Block.from_dict(b) for b in values]
+        except (CodecError, ValueError, KeyError, TypeError) as err:
+            return f'error: invalid block: {err}', 400
+        tip = blockchain.hash(blockchain.last_block)
+        results = [blockchain.accept_block(block) for block in blocks]
+        if blockchain.hash(blockchain.last_block) != tip:
+            announce_block(blockchain.last_block)
         response = {
-            'message': 'chain replaced',
-            'new_chain': list(map(lambda c: dict(c), blockchain.chain))
+            'results': results,
+            'length': blockchain.height,
+            'orphans': len(blockchain.orphans),
         }
-    else:
+        return jsonify(response), 200
+
+    @app.route('/blocks/<int:index>/compact', methods=['GET'])
+    def get_compact_block(index):
+        """
+        GET /blocks/<index>/compact
+        ブロックをcompact blockの形で返す
+        """
+        block = blockchain.get_block(index)
+        if block is None:
+            return 'error: block not found', 404
+        if block.pruned:
+            return 'error: block pruned', 410
+        return jsonify(compact_block(block)), 200
+
+    @app.route('/blocks/<int:index>/transactions', methods=['POST'])
+    def get_block_transactions(index):
+        """
+        POST /blocks/<index>/transactions
+        ブロックの指定した位置のトランザクションを返す
+        {'positions': [0, 3, ...]}
+        """
+        block = blockchain.get_block(index)
+        if block is None:
+            return 'error: block not found', 404
+        if block.pruned:
+            return 'error: block pruned', 410
+        values = request.get_json(silent=True) or {}
+        try:
+            transactions = [dict(block.transactions[p]) for p in values.get('positions', [])]
+        except (IndexError, TypeError):
+            return 'error: invalid position', 400
+        return jsonify({'transactions': transactions}), 200
+
+    @app.route('/chain', methods=['GET'])
+    def full_chain():
+        """
+        GET /chain
+        ブロックチェーンを返す
+        Accept: application/octet-stream ならバイナリ形式で返す
+        最後のブロックのハッシュ値をETagにして，変わっていなければ304を返す
+        古いブロックを刈り込んでいるときはトランザクションを持っているブロックだけを返す
+        """
+        chain = blockchain.full_chain
+        binary = request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE
+        etag = chain_cache.etag(chain, binary)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        encoding = accepted_encoding(request.headers.get('Accept-Encoding'), not args.no_compress)
+        if binary:
+            response = Response(chain_cache.chain_binary(chain, encoding), mimetype=BINARY_MIMETYPE)
+        else:
+            response = Response(chain_cache.chain_json(chain, blockchain.height, encoding), mimetype='application/json')
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.vary.add('Accept')
+        response.vary.add('Accept-Encoding')
+        return response
+
+    @app.route('/chain/export', methods=['GET'])
+    def export_chain():
+        """
+        GET /chain/export?format=ndjson|binary
+        チェーンを1ブロックずつ書き出して返す
+        新しいノードは保存したファイルを --import-chain で読み込んで起動できる
+        古いブロックを刈り込んでいるときはトランザクションを持っているブロックだけを返す
+        """
+        format = request.args.get('format', 'ndjson')
+        if format not in FORMATS:
+            return jsonify({'message': f'unknown format: {format}'}), 400
+        chain = blockchain.full_chain
+        response = Response(iter_chain(chain, format), mimetype=FORMATS[format])
+        response.headers['Content-Disposition'] = f'attachment; filename=chain-{chain[-1].index}.{format}'
+        return response
+
+    @app.route('/snapshot', methods=['GET'])
+    def snapshot():
+        """
+        GET /snapshot
+        最後のブロックと残高・未承認トランザクションの署名付きスナップショットを返す
+        新しいノードは --snapshot でこれを読み込んで起動できる
+        """
+        return jsonify(export_snapshot(blockchain, signer)), 200
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """
+        GET /metrics
+        書き込み系のキューの深さと拒否した数を返す
+        """
         response = {
-            'message': 'chain consensused',
-            'chain': list(map(lambda c: dict(c), blockchain.chain))
+            'queues': {q.name: q.metrics() for q in (intake_queue, mine_queue)},
+            'rate_limit': rate_limiter.metrics(),
+            'peer_rate_limit': peer_rate_limiter.metrics(),
+            'length': blockchain.height,
+            'transactions': len(blockchain.current_transactions),
+            'orphans': len(blockchain.orphans),
+            'nodes': len(blockchain.peers),
+            'mempool_bytes': blockchain.current_transactions.bytes,
+            'blocks_produced': producer.produced,
+            'pruned_blocks': blockchain.pruned_count,
+            'journal': journal.metrics() if journal is not None else None,
+            'shards': blockchain.current_transactions.metrics() if args.shards else None,
         }
-    return jsonify(response), 200
+        return jsonify(response), 200
 
-@app.route('/mine', methods=['GET'])
-def mine():
-    """
-    GET /mine
-    マイニングをする
-    """
-    last_block = blockchain.last_block
-    last_proof = last_block.proof
-
-    # PoWを行う
-    proof = blockchain.proof_of_work(last_proof)
-    timestamp = time()
-    signature = sign(privatekey, timestamp)
-    # マイニング用のトランザクションを追加
-    blockchain.new_transaction(
-        sender = "mining",
-        recipient = node_identifier,
-        amount = 100,
-        timestamp = timestamp,
-        signature = signature,
-    )
-    block = blockchain.new_block(proof)
-    response = {
-        'message': 'new block mining!!',
-        'index': block.index,
-        'transactions': list(map(lambda t: t.__dict__, block.transactions)),
-        'proof': block.proof,
-        'previous_hash': block.previous_hash,
-    }
-    print(response['transactions'])
-    return jsonify(response), 200
-
-@app.route('/chain', methods=['GET'])
-def full_chain():
-    """
-    GET /chain
-    ブロックチェーンを返す
-    """
-    response = {
-        'chain': list(map(lambda c: dict(c), blockchain.chain)),
-        'length': len(blockchain.chain)
-    }
-    return jsonify(response), 200
-
-@app.route('/verify_signature', methods=['GET'])
-def verify_signature():
-    signature = request.args.get('signature')
-    sender_pubkey = request.args.get('publickey')
-    timestamp = request.args.get('timestamp')
-    result = verify(sender_pubkey, timestamp, signature)
-    if result:
-        return jsonify("Verified"), 200
-    else:
-        return jsonify("Not Verified"), 200
+    @app.route('/stats', methods=['GET'])
+    def stats():
+        """
+        GET /stats
+        ブロックとトランザクションの集計を返す
+        ?bucket=<秒>&since=<timestamp>&until=<timestamp>&top=<n>
+        numpyがインストールされていなければ501を返す
+        """
+        bucket = request.args.get('bucket', 3600.0, type=float)
+        top = request.args.get('top', 10, type=int)
+        if bucket <= 0 or top < 0:
+            return 'error: invalid bucket or top', 400
+        try:
+            response = chain_stats.summary(
+                blockchain,
+                bucket=bucket,
+                since=request.args.get('since', type=float),
+                until=request.args.get('until', type=float),
+                top=top,
+            )
+        except AnalyticsError as err:
+            return f'error: {err}', 501
+        return jsonify(response), 200
+
+    def admin_only(view):
+        """
+        --admin-tokenを指定したときはX-Admin-Tokenが一致するリクエストだけ，
+        それ以外はlocalhostからのリクエストだけを受け付ける
+        """
+        @wraps(view)
+        def wrapper(*a, **kw):
+            if args.admin_token:
+                allowed = hmac.compare_digest(request.headers.get('X-Admin-Token', ''), args.admin_token)
+            else:
+                allowed = request.remote_addr in ('127.0.0.1', '::1')
+            if not allowed:
+                return 'error: forbidden', 403
+            return view(*a, **kw)
+        return wrapper
+
+    @app.route('/admin/profile', methods=['POST'])
+    @admin_only
+    def profile():
+        """
+        POST /admin/profile?seconds=<n>&interval=<ms>
+        n秒間，全スレッドのスタックをサンプリングして返す
+        1行に "スレッド名;関数;...;関数 サンプル数" の形式 (flamegraph.plやspeedscopeでそのまま読める)
+        """
+        seconds = request.args.get('seconds', 10.0, type=float)
+        interval = request.args.get('interval', 5.0, type=float)
+        if not 0 < seconds <= MAX_PROFILE_SECONDS or interval <= 0:
+            return f'error: seconds must be in (0, {MAX_PROFILE_SECONDS}] and interval positive', 400
+        if not profile_lock.acquire(blocking=False):
+            return 'error: profiler is already running', 409
+        try:
+            stacks = sample(seconds, interval / 1000)
+        finally:
+            profile_lock.release()
+        return Response(format_collapsed(stacks), mimetype='text/plain')
+
+    @app.route('/admin/slow', methods=['GET'])
+    @admin_only
+    def slow():
+        """
+        GET /admin/slow
+        --slow-msより遅かったリクエストの一覧を新しい順に返す
+        """
+        if slow_requests is None:
+            return 'error: start the server with --slow-ms', 404
+        return jsonify({'threshold_ms': args.slow_ms, 'requests': slow_requests.to_list()}), 200
+
+    @app.route('/admin/slow/<int:id>', methods=['GET'])
+    @admin_only
+    def slow_profile(id):
+        """
+        GET /admin/slow/<id>
+        遅かったリクエストのスタックを/admin/profileと同じ形式で返す
+        """
+        record = slow_requests.get(id) if slow_requests is not None else None
+        if record is None:
+            return 'error: profile not found', 404
+        return Response(format_collapsed(record.stacks), mimetype='text/plain')
+
+    @app.route('/verify_signature', methods=['GET'])
+    def verify_signature():
+        signature = request.args.get('signature')
+        sender_pubkey = request.args.get('publickey')
+        timestamp = request.args.get('timestamp')
+        result = verify(sender_pubkey, timestamp, signature)
+        if result:
+            return jsonify("Verified"), 200
+        else:
+            return jsonify("Not Verified"), 200
+
+    app.extensions['blockchain'] = blockchain
+    app.extensions['producer'] = producer
+    return app
+
+def main(argv: list = None):
+    args = parse_args(argv)
+    try:
+        app = create_app(args)
+    except (SnapshotError, ChainIOError, OSError, ValueError):
+        exit(1)
+    blockchain = app.extensions['blockchain']
+    print(app.config['NODE_IDENTIFIER'])
+    if args.seed:
+        # シード名からノード一覧を作り，TTLごとに更新する
+        SeedDiscovery(blockchain.peers, args.seed, exclude=f'{args.ip}:{args.port}').start()
+    if args.auto_mine:
+        app.extensions['producer'].start()
+    app.run(host=args.ip, port=args.port)
 
 if __name__ == '__main__':
-    print(node_identifier)
-    app.run(host=args.ip, port=args.port)
\ No newline at end of file
+    main()
@@ -0,0 +1,428 @@
+import contextlib
+import hashlib
+import itertools
+import multiprocessing
+import threading
+from time import time
+from typing import List
+from mempool import Mempool
+
+def shard_of(sender: str, shards: int) -> int:
+    """
+    送信者のアドレスからシャードを決める
+    プロセスごとに値が変わるhash()ではなく，短いアドレスでも偏らないblake2bを使う
+    """
+    return int.from_bytes(hashlib.blake2b(str(sender).encode(), digest_size=8).digest(), 'big') % shards
+
+def sender_of(values) -> str:
+    """
+    検証する前のトランザクションの送信者
+    不正なものも，どこかのシャードで検証してエラーにする
+    """
+    return values.get('sender') if isinstance(values, dict) else None
+
+class ShardError(Exception):
+    pass
+
+def serve(conn, key: str, seen_capacity: int, seen_error_rate: float):
+    """
+    シャードのプロセスの本体
+    担当する送信者のトランザクションだけのmempoolを持ち，coordinatorからのコマンドを順に処理する
+    トランザクションの検証，txidの計算，受け取り済みかの確認もここで行う
+    add, signは検証して準備するだけで，commitが届いたら追加し，abortが届いたら捨てる
+    返事は (例外, 結果, トランザクション数, 大きさの合計)
+    """
+    from blockchain import Blockchain, Transaction
+    from bloom import SeenFilter
+    from codec import validate_transaction
+    mempool = Mempool()
+    # 送信者で分けているので，最近処理したトランザクションもシャードごとに覚えればよい
+    seen = SeenFilter(seen_capacity, seen_error_rate)
+    # txidとcoordinatorが付けた受付順
+    seqs = {}
+    signer = None
+    # add, signで準備して，commitを待っているトランザクション [(受付順, Transaction)]
+    pending = []
+
+    def append(seq, transaction):
+        txid = transaction.txid()
+        if txid not in mempool:
+            seqs[txid] = seq
+            mempool.append(transaction)
+
+    def peek(max_count, max_bytes):
+        """
+        Mempool.takeと同じ上限で，取り出さずに古い順に返す
+        """
+        transactions = []
+        size = 0
+        for txid, transaction in mempool.transactions.items():
+            if max_count is not None and len(transactions) >= max_count:
+                break
+            if max_bytes is not None and size + transaction.size() > max_bytes:
+                break
+            transactions.append((seqs[txid], transaction))
+            size += transaction.size()
+        return transactions
+
+    def validate(items, signed, max_bytes):
+        """
+        1つでも不正なものがあれば，このシャードには1つも追加しない
+        :return: List[(受付順, 正規化した辞書)]
+        """
+        transactions = []
+        for seq, position, values in items:
+            try:
+                transactions.append((seq, validate_transaction(values, signed, max_bytes)))
+            except ValueError as err:
+                raise ValueError(f'transaction {position}: {err}')
+        return transactions
+
+    while True:
+        try:
+            command, *params = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            result = None
+            if command == 'extend':
+                for seq, transaction in params[0]:
+                    append(seq, transaction)
+            elif command == 'add':
+                # 複数の経路から届いた処理済みのトランザクションは捨てる
+                transactions = validate(params[0], True, params[1])
+                pending = []
+                txids = set()
+                for seq, t in transactions:
+                    # 正規化した辞書のハッシュ値がそのままtxidになる
+                    txid = Blockchain.hash(t)
+                    if f'tx:{txid}' in seen or txid in txids:
+                        continue
+                    txids.add(txid)
+                    pending.append((seq, Transaction.from_dict(t, txid=txid)))
+                result = len(pending)
+            elif command == 'sign':
+                # 署名は重いのでシャードのプロセスで行う
+                transactions = validate(params[0], False, params[1])
+                if signer is None:
+                    from util import Signer
+                    signer = Signer.load(key)
+                pending = []
+                result = []
+                for seq, t in transactions:
+                    t['timestamp'] = time()
+                    t['signature'] = signer.sign(t['timestamp'])
+                    pending.append((seq, Transaction.from_dict(t, txid=Blockchain.hash(t))))
+                    result.append(t)
+            elif command == 'commit':
+                for seq, transaction in pending:
+                    append(seq, transaction)
+                    # 他のノードから戻ってきたものは処理しない
+                    seen.add(f'tx:{transaction.txid()}')
+                pending = []
+            elif command == 'abort':
+                pending = []
+            elif command == 'remove':
+                mempool.remove(params[0])
+                for txid in params[0]:
+                    seqs.pop(txid, None)
+            elif command == 'peek':
+                result = peek(*params)
+            elif command == 'all':
+                result = peek(None, None)
+            elif command == 'get':
+                result = mempool.get(params[0])
+            elif command == 'short_ids':
+                result = mempool.short_ids()
+            elif command == 'reset':
+                mempool.reset()
+                seqs = {}
+            elif command == 'close':
+                conn.send((None, None, 0, 0))
+                return
+            else:
+                raise ValueError(f'unknown command: {command}')
+            conn.send((None, result, len(mempool), mempool.bytes))
+        except Exception as err:
+            conn.send((err, None, len(mempool), mempool.bytes))
+
+class Shard(object):
+    """
+    シャードのプロセスとパイプ
+    プロセスが落ちたら同じロックのまま起動し直す
+    """
+    def __init__(self, name: str, args: tuple):
+        self.name = name
+        self.args = args
+        # 1つのパイプでは1つのコマンドずつやりとりする
+        self.lock = threading.Lock()
+        self.restarts = 0
+        self.start()
+
+    def start(self):
+        """
+        lockを持って呼ぶ (最初の起動以外)
+        """
+        # スレッドを持つプロセスからforkしないようにspawnで起動する
+        context = multiprocessing.get_context('spawn')
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=serve, args=(child,) + self.args, name=self.name, daemon=True)
+        self.process.start()
+        child.close()
+        # 最後の返事のときのトランザクション数と大きさの合計
+        self.length = 0
+        self.bytes = 0
+
+    def restart(self):
+        """
+        lockを持って呼ぶ
+        持っていたトランザクションは失われる
+        """
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.restarts += 1
+        self.start()
+
+class ShardedMempool(object):
+    """
+    未承認のトランザクションを送信者のアドレスで分けて，複数のプロセスに持たせる
+    トランザクションの検証，txidや大きさの計算，署名は各シャードのプロセスで並列に行う
+    coordinatorは送信者でシャードを決めて，受け取った辞書をそのまま渡すだけにする
+    ブロックを作るときは各シャードの古いものを集め，受け付けた順に並べ直して上限まで取り出す
+    Mempoolと同じように使える (journalには対応しない)
+    """
+    def __init__(self, shards: int, key: str = None, seen_capacity: int = 100000, seen_error_rate: float = 0.001):
+        """
+        :param shards: int プロセス数
+        :param key: str /transactions/new, /transactions/batchで署名する秘密鍵のファイル
+        :param seen_capacity: int 最近処理したトランザクションを覚えておく数 (シャード全体で)
+        """
+        args = (key, max(1, seen_capacity // shards), seen_error_rate)
+        self.shards = [Shard(f'mempool-shard-{i}', args) for i in range(shards)]
+        # 受け付けた順番
+        self.sequence = itertools.count()
+        self.sequence_lock = threading.Lock()
+        self.journal = None
+
+    @contextlib.contextmanager
+    def locked(self, shards: List[int]):
+        """
+        シャードのロックを取る
+        デッドロックしないように番号順に取る
+        """
+        order = sorted(shards)
+        for i in order:
+            self.shards[i].lock.acquire()
+        try:
+            yield
+        finally:
+            for i in order:
+                self.shards[i].lock.release()
+
+    def exchange(self, commands: dict) -> dict:
+        """
+        シャードのロックを持って呼ぶ
+        シャードにコマンドを送り，全ての返事を待つ
+        複数のシャードには先に全て送ってから返事を受け取るので，シャードは並列に処理する
+        落ちていたシャードは起動し直してShardErrorを返す (次の呼び出しからは使える)
+        :param commands: dict {シャードの番号: (コマンド, 引数...)}
+        :return: dict {シャードの番号: 結果}
+        """
+        order = sorted(commands)
+        dead = []
+        for i in order:
+            try:
+                self.shards[i].conn.send(commands[i])
+            except OSError:
+                dead.append(i)
+        results = {}
+        error = None
+        for i in order:
+            if i in dead:
+                continue
+            shard = self.shards[i]
+            try:
+                err, result, shard.length, shard.bytes = shard.conn.recv()
+            except (EOFError, OSError):
+                dead.append(i)
+                continue
+            error = error or err
+            results[i] = result
+        for i in dead:
+            print(f'mempool shard {i} died, restarting it')
+            self.shards[i].restart()
+        if dead:
+            raise ShardError(f'mempool shards {sorted(dead)} died and were restarted, their transactions are lost')
+        if error is not None:
+            raise error
+        return results
+
+    def call(self, commands: dict) -> dict:
+        """
+        シャードにコマンドを送り，全ての返事を待つ
+        :param commands: dict {シャードの番号: (コマンド, 引数...)}
+        :return: dict {シャードの番号: 結果}
+        """
+        with self.locked(commands):
+            return self.exchange(commands)
+
+    def prepare_and_commit(self, commands: dict) -> dict:
+        """
+        2相で追加する
+        全てのシャードで検証して準備できたときだけcommitし，1つでも失敗したら全てのシャードでabortする
+        commitまでロックを持ち続けるので，準備したものはシャードごとに1つだけでよい
+        commitの途中でシャードが落ちたときは，そのシャードの分だけが失われる
+        :param commands: dict {シャードの番号: ('add' または 'sign', 引数...)}
+        :return: dict {シャードの番号: 結果}
+        """
+        with self.locked(commands):
+            try:
+                results = self.exchange(commands)
+            except Exception:
+                # 起動し直したシャードは何も準備していないので，abortしても変わらない
+                try:
+                    self.exchange({i: ('abort',) for i in commands})
+                except ShardError as err:
+                    print(err)
+                raise
+            self.exchange({i: ('commit',) for i in commands})
+            return results
+
+    def broadcast(self, *command) -> dict:
+        return self.call({i: command for i in range(len(self.shards))})
+
+    def route(self, transactions: list, sender) -> dict:
+        """
+        受付順を付けてシャードごとに分ける
+        :return: dict {シャードの番号: [(受付順, トランザクション)]}
+        """
+        groups = {}
+        with self.sequence_lock:
+            for transaction in transactions:
+                i = shard_of(sender(transaction), len(self.shards))
+                groups.setdefault(i, []).append((next(self.sequence), transaction))
+        return groups
+
+    def __len__(self) -> int:
+        return sum(shard.length for shard in self.shards)
+
+    @property
+    def bytes(self) -> int:
+        return sum(shard.bytes for shard in self.shards)
+
+    def __iter__(self):
+        merged = [item for items in self.broadcast('all').values() for item in items]
+        merged.sort(key=lambda item: item[0])
+        return iter([transaction for _, transaction in merged])
+
+    def __contains__(self, txid: str) -> bool:
+        return self.get(txid) is not None
+
+    def append(self, transaction: 'Transaction'):
+        self.extend([transaction])
+
+    def extend(self, transactions: List['Transaction']):
+        groups = self.route(transactions, lambda t: t.sender)
+        if groups:
+            self.call({i: ('extend', items) for i, items in groups.items()})
+
+    def add(self, values: List[dict], max_bytes: int = None) -> int:
+        """
+        署名済みのトランザクションを検証して追加する
+        処理済みのトランザクションは捨てる
+        不正なものが1つでもあればValueErrorを返し，どのシャードにも追加しない
+        シャードが落ちていたらShardErrorを返す
+        :param values: List[dict] 検証する前の辞書
+        :param max_bytes: int トランザクション1つの大きさの上限
+        :return: int 追加した数
+        """
+        groups = self.route(list(enumerate(values)), lambda item: sender_of(item[1]))
+        if not groups:
+            return 0
+        results = self.prepare_and_commit({i: ('add', [(seq, position, t) for seq, (position, t) in items], max_bytes) for i, items in groups.items()})
+        return sum(results.values())
+
+    def sign(self, values: List[dict], max_bytes: int = None) -> List[dict]:
+        """
+        トランザクションを検証し，署名して追加する
+        不正なものが1つでもあればValueErrorを返し，どのシャードにも追加しない (再送しても二重に署名されない)
+        シャードが落ちていたらShardErrorを返す
+        :param values: List[dict] sender, recipient, amount
+        :param max_bytes: int 署名する前のトランザクション1つの大きさの上限
+        :return: List[dict] timestamp, signatureを付けたもの (引数と同じ順)
+        """
+        groups = self.route(list(enumerate(values)), lambda item: sender_of(item[1]))
+        if not groups:
+            return []
+        results = self.prepare_and_commit({i: ('sign', [(seq, position, t) for seq, (position, t) in items], max_bytes) for i, items in groups.items()})
+        signed = [None] * len(values)
+        for i, items in groups.items():
+            for (_, (position, _)), t in zip(items, results[i]):
+                signed[position] = t
+        return signed
+
+    def get(self, txid: str) -> 'Transaction':
+        for transaction in self.broadcast('get', txid).values():
+            if transaction is not None:
+                return transaction
+        return None
+
+    def remove(self, txids: List[str]):
+        txids = list(txids)
+        if txids:
+            self.broadcast('remove', txids)
+
+    def reset(self, transactions: List['Transaction'] = ()):
+        self.broadcast('reset')
+        self.extend(transactions)
+
+    def take(self, max_count: int = None, max_bytes: int = None) -> List['Transaction']:
+        """
+        Mempool.takeと同じく，受け付けた順に上限まで取り出す
+        各シャードから上限までの候補を集めて並べ直す (ブロックのテンプレート)
+        """
+        candidates = [item for items in self.broadcast('peek', max_count, max_bytes).values() for item in items]
+        candidates.sort(key=lambda item: item[0])
+        transactions = []
+        size = 0
+        for _, transaction in candidates:
+            if max_count is not None and len(transactions) >= max_count:
+                break
+            if max_bytes is not None and size + transaction.size() > max_bytes:
+                break
+            transactions.append(transaction)
+            size += transaction.size()
+        groups = {}
+        for transaction in transactions:
+            groups.setdefault(shard_of(transaction.sender, len(self.shards)), []).append(transaction.txid())
+        if groups:
+            self.call({i: ('remove', txids) for i, txids in groups.items()})
+        return transactions
+
+    def short_ids(self) -> dict:
+        table = {}
+        for shard_table in self.broadcast('short_ids').values():
+            for key, transaction in shard_table.items():
+                table[key] = None if key in table else transaction
+        return table
+
+    def sync(self, timeout: float = None) -> bool:
+        return True
+
+    def compact(self):
+        pass
+
+    def close(self):
+        for shard in self.shards:
+            with shard.lock:
+                try:
+                    shard.conn.send(('close',))
+                    shard.conn.recv()
+                except (EOFError, OSError):
+                    pass
+            shard.process.join()
+
+    def metrics(self) -> list:
+        return [{'transactions': shard.length, 'bytes': shard.bytes, 'alive': shard.process.is_alive(), 'restarts': shard.restarts} for shard in self.shards]
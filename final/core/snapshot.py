@@ -0,0 +1,97 @@
+from typing import List
+import hashlib
+import json
+from time import time
+from blockchain import Blockchain, Block, Transaction
+from util import Signer, verify
+
+SNAPSHOT_VERSION = 1
+
+class SnapshotError(Exception):
+    pass
+
+def digest(body: dict) -> str:
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+def export_snapshot(blockchain: Blockchain, signer: Signer) -> dict:
+    """
+    最後のブロックと残高・未承認トランザクションをまとめた署名付きスナップショットを作る
+    :return: dict {'snapshot': 本体, 'publickey': 公開鍵, 'signature': 署名}
+    """
+    tip = blockchain.last_block
+    body = {
+        'version': SNAPSHOT_VERSION,
+        'timestamp': time(),
+        'height': tip.index,
+        'tip': dict(tip),
+        'tip_hash': blockchain.hash(tip),
+        'balances': blockchain.balances(),
+        'mempool': list(map(dict, blockchain.current_transactions)),
+    }
+    return {
+        'snapshot': body,
+        'publickey': signer.publickey,
+        'signature': signer.sign(digest(body)),
+    }
+
+def verify_snapshot(snapshot: dict, trusted_keys: List[str] = None):
+    """
+    スナップショットの署名と最後のブロックのハッシュ値を検証する
+    trusted_keysを指定したときは，その公開鍵で署名されたものだけを受け付ける
+    失敗したらSnapshotErrorを返す
+    """
+    try:
+        body = snapshot['snapshot']
+        publickey = snapshot['publickey']
+        signature = snapshot['signature']
+    except (KeyError, TypeError):
+        raise SnapshotError('invalid snapshot format')
+    if body.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError(f'unsupported snapshot version {body.get("version")}')
+    if trusted_keys and publickey.strip() not in [k.strip() for k in trusted_keys]:
+        raise SnapshotError('snapshot is not signed by a trusted key')
+    if not verify(publickey, digest(body), signature):
+        raise SnapshotError('invalid snapshot signature')
+    if Blockchain.hash(body['tip']) != body['tip_hash']:
+        raise SnapshotError('tip hash mismatch')
+
+def import_snapshot(blockchain: Blockchain, snapshot: dict, trusted_keys: List[str] = None):
+    """
+    スナップショットを検証して，最後のブロックから始まるチェーンに置き換える
+    スナップショットに入っている公開鍵での署名は誰でも作れるので，
+    trusted_keysか，スナップショットの高さのチェックポイントのどちらかが必要
+    チェックポイントで確かめられるのは最後のブロックだけなので，
+    trusted_keysがないときは残高は検証せずに信じ，未承認のトランザクションは読み込まない
+    失敗したらSnapshotErrorを返す
+    """
+    verify_snapshot(snapshot, trusted_keys)
+    body = snapshot['snapshot']
+    expected = blockchain.checkpoints.get(body['height'])
+    if expected is not None and expected != body['tip_hash']:
+        raise SnapshotError(f'checkpoint mismatch at {body["height"]}')
+    if not trusted_keys and expected is None:
+        raise SnapshotError(f'untrusted snapshot: give a trusted key or a checkpoint at {body["height"]}')
+    tip = body['tip']
+    blockchain.replace_chain([Block.from_dict(tip)])
+    blockchain.base_balances = dict(body['balances'])
+    blockchain.base_index = tip["index"]
+    if not trusted_keys:
+        print('warning: balances in the snapshot are not verified by the checkpoint, mempool is not imported')
+        blockchain.current_transactions.reset()
+        return
+    blockchain.current_transactions.reset([
+        Transaction.from_dict(t) for t in body['mempool']
+    ])
+
+def load_snapshot(source: str) -> dict:
+    """
+    ファイルまたはURLからスナップショットを読み込む
+    """
+    if source.startswith('http://') or source.startswith('https://'):
+        import requests
+        response = requests.get(source)
+        if response.status_code != 200:
+            raise SnapshotError(f'GET snapshot failed: {response.status_code}')
+        return response.json()
+    with open(source) as f:
+        return json.load(f)
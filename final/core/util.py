@@ -1,29 +1,101 @@
 from base64 import b64encode, b64decode
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
-from Crypto.Hash import SHA256
+from functools import lru_cache
 import json
 
+@lru_cache(maxsize=16)
+def import_key(pem: str):
+  """
+  PEM文字列から鍵を読み込む
+  RSAで読めなければEd25519として読み込む
+  同じ鍵を何度もパースしないようにキャッシュする
+  pycryptodomeは読み込みに時間がかかるので，鍵を使うときに初めてimportする
+  """
+  from Crypto.PublicKey import RSA, ECC
+  try:
+    return RSA.importKey(pem)
+  except ValueError:
+    return ECC.import_key(pem)
+
+def key_scheme(key) -> str:
+  """
+  鍵の署名方式を返す
+  RSAとEd25519以外の鍵(P-256などのECC)はValueErrorを返す
+  :return: 'rsa' or 'ed25519'
+  """
+  from Crypto.PublicKey import RSA
+  if isinstance(key, RSA.RsaKey):
+    return 'rsa'
+  curve = getattr(key, 'curve', None)
+  if curve in ('Ed25519', 'ed25519'):
+    return 'ed25519'
+  raise ValueError(f'unsupported key: only RSA and Ed25519 keys can be used, not {curve}')
+
+class Signer():
+  """
+  パース済みの秘密鍵を保持して署名を行う
+  起動時に1度だけ作成して使い回す
+  """
+  def __init__(self, key):
+    self.key = key
+    self.scheme = key_scheme(key)
+    if self.scheme == 'rsa':
+      from Crypto.Signature import PKCS1_v1_5
+      self._signer = PKCS1_v1_5.new(key)
+    else:
+      # EdDSAはpycryptodome 3.15以降
+      from Crypto.Signature import eddsa
+      self._signer = eddsa.new(key, 'rfc8032')
+    self.publickey = key.public_key().export_key(format='PEM')
+    if isinstance(self.publickey, bytes):
+      self.publickey = self.publickey.decode()
+
+  @classmethod
+  def from_pem(cls, pem: str) -> 'Signer':
+    return cls(import_key(pem))
+
+  @classmethod
+  def load(cls, path: str) -> 'Signer':
+    """
+    ファイルから秘密鍵を読み込む
+    ファイルを読めなければOSError，使えない鍵ならValueErrorを返す
+    """
+    with open(path) as f:
+      return cls.from_pem(f.read())
+
+  def sign(self, timestamp: float) -> str:
+    from Crypto.Hash import SHA256
+    message = str(timestamp).encode()
+    if self.scheme == 'rsa':
+      signature = self._signer.sign(SHA256.new(message))
+    else:
+      signature = self._signer.sign(message)
+    return b64encode(signature).decode()
+
+@lru_cache(maxsize=16)
+def _signer(secret_key: str) -> Signer:
+  return Signer.from_pem(secret_key)
+
 def sign(secret_key: str, timestamp: float):
-  try: 
-    rsakey = RSA.importKey(secret_key)
-  except ValueError as err:
-    print(err)
-    sys.exit(1)
-  signer = PKCS1_v1_5.new(rsakey)
-  digest = SHA256.new()
-  digest.update(str(timestamp).encode())
-  sign = signer.sign(digest)
-  return b64encode(sign).decode()
+  return _signer(secret_key).sign(timestamp)
 
 def verify(pubkey, timestamp, signature_b64):
-  key = RSA.importKey(pubkey)
+  key = import_key(pubkey)
   signature = b64decode(signature_b64)
-  h = SHA256.new(str(timestamp).encode())
-  verifier = PKCS1_v1_5.new(key)
-  if verifier.verify(h, signature):
+  message = str(timestamp).encode()
+  if key_scheme(key) == 'rsa':
+    from Crypto.Signature import PKCS1_v1_5
+    from Crypto.Hash import SHA256
+    verified = PKCS1_v1_5.new(key).verify(SHA256.new(message), signature)
+  else:
+    from Crypto.Signature import eddsa
+    try:
+      eddsa.new(key, 'rfc8032').verify(message, signature)
+      verified = True
+    except ValueError:
+      verified = False
+  if verified:
     print('The signature is authentic')
     return True
   else:
     print('The signature is not authentic')
-    return False
\ No newline at end of file
+    return False
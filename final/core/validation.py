@@ -0,0 +1,105 @@
+from typing import List
+import os
+
+def check_link(last_block: dict, block: dict, trusted: int, difficulty: int = None):
+    """
+    ブロックが1つ前のブロックと正しくつながっているかを検証する
+    :param difficulty: int PoWの難易度．Noneならデフォルト
+    :return: str 不正な理由．正しければNone
+    """
+    from blockchain import Blockchain, DIFFICULTY
+    # 長さは最後のブロックのindexで比べるので，indexも連続している必要がある
+    if block["index"] != last_block["index"] + 1:
+        return 'unexpected index'
+    if block["previous_hash"] != Blockchain.hash(last_block):
+        return 'invalid previous hash'
+    # チェックポイント以下のブロックはPoWを検証しない
+    if block["index"] > trusted and not Blockchain.valid_proof(last_block["proof"], block["proof"], DIFFICULTY if difficulty is None else difficulty):
+        return 'invalid proof'
+    return None
+
+def check_chunk(blocks: List[dict], trusted: int, difficulty: int = None):
+    """
+    チャンク内のブロックを検証する
+    チャンクの先頭ブロックと1つ前のチャンクのつながりは呼び出し側で検証する
+    ブロックの形式とトランザクションは先頭ブロックも含めて検証する
+    :return: (最初の不正なブロックのindex, 理由, 最後のブロックのハッシュ値)
+    """
+    from blockchain import Blockchain
+    from codec import validate_block
+    for i, block in enumerate(blocks):
+        try:
+            validate_block(block)
+        except ValueError as err:
+            return block["index"], f'invalid block: {err}', None
+        if i > 0:
+            reason = check_link(blocks[i - 1], block, trusted, difficulty)
+            if reason is not None:
+                return block["index"], reason, None
+    return None, None, Blockchain.hash(blocks[-1])
+
+class ChainValidator(object):
+    """
+    チェーンをチャンクに分けてプロセスプールで並列に検証する
+    各ブロックの検証には自分と1つ前のブロックしか使わないので，
+    チャンクごとに独立して検証し，最後にチャンクの境界のつながりを検証する
+    """
+    def __init__(self, workers: int = None, chunk_size: int = 512, min_parallel: int = 2048):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.min_parallel = min_parallel # これより短いチェーンは1プロセスで検証する
+        self.executor = None
+
+    def validate(self, chain: List[dict], trusted: int = 0, difficulty: int = None):
+        """
+        チェーンを検証する
+        :param trusted: int このindex以下のブロックはPoWを検証しない
+        :param difficulty: int PoWの難易度．Noneならデフォルト
+        :return: (正しければNone, それ以外は最初の不正なブロックのindex, 理由)
+        """
+        if len(chain) < 2:
+            return None, None
+        if self.workers <= 1 or len(chain) < self.min_parallel:
+            index, reason, _ = check_chunk(chain, trusted, difficulty)
+            return index, reason
+        chunks = [chain[i:i + self.chunk_size] for i in range(0, len(chain), self.chunk_size)]
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            results = list(self.pool().map(check_chunk, chunks, [trusted] * len(chunks), [difficulty] * len(chunks)))
+        except BrokenProcessPool as err:
+            # ワーカーが落ちたプールは使えないので，次は作り直す．今回はこのプロセスで検証する
+            print(f'validation workers died: {err}')
+            self.executor.shutdown(wait=False)
+            self.executor = None
+            results = [check_chunk(chunk, trusted, difficulty) for chunk in chunks]
+        failures = [(index, reason) for index, reason, _ in results if index is not None]
+        # チャンクの境界のつながりを検証する
+        # 1つ前のチャンクに不正なブロックがあれば，境界より前で失敗しているので飛ばす
+        from blockchain import Blockchain, DIFFICULTY
+        for k in range(1, len(chunks)):
+            last_hash = results[k - 1][2]
+            if last_hash is None:
+                continue
+            last_block, block = chunks[k - 1][-1], chunks[k][0]
+            if block["index"] != last_block["index"] + 1:
+                failures.append((block["index"], 'unexpected index'))
+            elif block["previous_hash"] != last_hash:
+                failures.append((block["index"], 'invalid previous hash'))
+            elif block["index"] > trusted and not Blockchain.valid_proof(last_block["proof"], block["proof"], DIFFICULTY if difficulty is None else difficulty):
+                failures.append((block["index"], 'invalid proof'))
+        if not failures:
+            return None, None
+        return min(failures, key=lambda f: f[0])
+
+    def pool(self):
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_context
+            # スレッドを持つプロセスからforkしないようにspawnで起動する
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'))
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from dns import DNS, DNSFlags, DNSHeader, ResourceRecord, DNSError, TYPE_A, TYPE_AAAA, TYPE_CNAME, TYPE_SRV, TYPE_TXT, CLASS_IN
+
+TYPES = {'A': TYPE_A, 'AAAA': TYPE_AAAA, 'CNAME': TYPE_CNAME, 'SRV': TYPE_SRV, 'TXT': TYPE_TXT}
+
+class StubDNSServer():
+    """
+    テスト用のDNSサーバ
+    recordsに書いたレコードだけを返す
+    {"name": [{"type": "A", "data": "127.0.0.1", "ttl": 60}, ...]}
+    SRVのdataは[priority, weight, port, target]，TXTのdataは文字列のリスト
+    """
+    def __init__(self, records, ip='127.0.0.1', port=0):
+        self.records = {}
+        for name, values in records.items():
+            self.records[name.rstrip('.').lower()] = [
+                ResourceRecord(name, TYPES.get(v['type'], v['type']), CLASS_IN, v.get('ttl', 60),
+                               tuple(v['data']) if v['type'] == 'SRV' else v['data'])
+                for v in values
+            ]
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((ip, port))
+        self.address = self.socket.getsockname()
+        self.thread = None
+
+    def find(self, name, rtype):
+        records = self.records.get(name.lower(), [])
+        answers = [r for r in records if r.rtype == rtype]
+        if not answers:
+            # CNAMEをたどる
+            for r in records:
+                if r.rtype == TYPE_CNAME:
+                    return [r] + self.find(r.data, rtype)
+        return answers
+
+    def respond(self, data):
+        query = DNS.from_bytes(data)
+        question = query.sections[0]
+        answers = self.find(question.domain, question.dtype)
+        additionals = []
+        for r in answers:
+            if r.rtype == TYPE_SRV:
+                additionals += [a for a in self.find(r.data[3], TYPE_A) if a not in additionals]
+        rcode = 0 if question.domain.lower() in self.records else 3 # NXDOMAIN
+        flags = DNSFlags(qr=1, opcode=0, aa=1, tc=0, rd=query.header.flags.rd, ra=0, z=0, ad=0, cd=0, rcode=rcode)
+        header = DNSHeader(flags, 0, 0, 0, 0, id=query.header.id)
+        return DNS(header, query.sections, answers=answers, additionals=additionals).to_bytes()
+
+    def serve_forever(self):
+        while True:
+            try:
+                data, client = self.socket.recvfrom(4096)
+            except OSError:
+                return
+            try:
+                self.socket.sendto(self.respond(data), client)
+            except (DNSError, IndexError) as err:
+                print(err)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.socket.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="stub dns server for tests")
+    parser.add_argument('records', type=str, help='json file of records')
+    parser.add_argument('--ip', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5353)
+    args = parser.parse_args()
+    server = StubDNSServer(json.load(open(args.records)), args.ip, args.port)
+    print('listening on %s:%d' % server.address)
+    server.serve_forever()
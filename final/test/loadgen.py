@@ -0,0 +1,276 @@
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import time
+from urllib.parse import urlparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from util import Signer
+
+# 対応しているAPIとメソッド
+ENDPOINTS = {
+    '/transactions/new': 'POST',
+    '/transactions/add': 'POST',
+    '/chain': 'GET',
+    '/mine': 'GET',
+    '/nodes/resolve': 'GET',
+}
+
+class HTTPError(Exception):
+    pass
+
+class Connection():
+    """
+    keep-aliveで使い回すHTTP/1.1の接続
+    サーバが接続を閉じたら次のリクエストでつなぎ直す
+    """
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=b''):
+        """
+        :return: (ステータスコード, 本文)
+        """
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = (f'{method} {path} HTTP/1.1\r\n'
+                f'Host: {self.host}:{self.port}\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Content-Type: application/json\r\n'
+                'Connection: keep-alive\r\n\r\n')
+        self.writer.write(head.encode() + body)
+        try:
+            return await asyncio.wait_for(self.read_response(), self.timeout)
+        except BaseException:
+            self.close()
+            raise
+
+    async def read_response(self):
+        line = await self.reader.readline()
+        if not line:
+            raise HTTPError('connection closed')
+        version, status = line.split()[:2]
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self.read_chunked()
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            self.close()
+        connection = headers.get('connection', '').lower()
+        if connection == 'close' or (version == b'HTTP/1.0' and connection != 'keep-alive'):
+            self.close()
+        return int(status), body
+
+    async def read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await self.reader.readline()
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+def presign(signer, count):
+    """
+    /transactions/addで送るトランザクションの署名を先に作っておく
+    計測中に署名の計算で負荷をかける側が遅くならないようにする
+    :return: List[(timestamp, signature)]
+    """
+    signatures = []
+    for i in range(count):
+        timestamp = time.time() + i * 1e-6
+        signatures.append((timestamp, signer.sign(timestamp)))
+    return signatures
+
+def parse_mix(text):
+    """
+    '/transactions/new=60,/chain=40' を [(path, weight)] にする
+    """
+    mix = []
+    for item in text.split(','):
+        path, _, weight = item.partition('=')
+        if path not in ENDPOINTS:
+            raise ValueError(f'unknown endpoint: {path}')
+        mix.append((path, float(weight or 1)))
+    return mix
+
+def percentile(values, p):
+    if not values:
+        return None
+    k = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[k]
+
+class LoadGenerator():
+    def __init__(self, args):
+        url = urlparse(args.url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.random = random.Random(args.seed)
+        self.results = {path: {'latencies': [], 'errors': 0, 'status': {}} for path, _ in self.mix}
+        self.signatures = None
+        if any(path == '/transactions/add' for path, _ in self.mix):
+            self.signatures = presign(Signer.load(args.key), args.presign)
+        self.counter = itertools.count()
+
+    def next_request(self):
+        paths, weights = zip(*self.mix)
+        path = self.random.choices(paths, weights)[0]
+        body = b''
+        if path == '/transactions/new':
+            i = next(self.counter)
+            body = json.dumps({'sender': f'loadgen-{i % 1000}', 'recipient': f'loadgen-{(i + 1) % 1000}', 'amount': 1}).encode()
+        elif path == '/transactions/add':
+            # 署名はtimestampにしかかからないので使い回し，amountを変えて毎回別のトランザクションにする
+            # 同じものを送ると2回目からは受け取り済みとして捨てられ，検証や追加の負荷がかからない
+            i = next(self.counter)
+            timestamp, signature = self.signatures[i % len(self.signatures)]
+            body = json.dumps({
+                'sender': f'loadgen-{i % 1000}',
+                'recipient': f'loadgen-{(i + 1) % 1000}',
+                'amount': i,
+                'timestamp': timestamp,
+                'signature': signature,
+            }).encode()
+        return path, body
+
+    async def client(self, queue):
+        connection = Connection(self.host, self.port, self.args.timeout)
+        while True:
+            scheduled = await queue.get()
+            if scheduled is None:
+                connection.close()
+                return
+            path, body = self.next_request()
+            result = self.results[path]
+            # 目標RPSがあるときは送るはずだった時刻から計る (coordinated omissionを避ける)
+            start = scheduled or time.perf_counter()
+            try:
+                status, _ = await connection.request(ENDPOINTS[path], path, body)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, HTTPError, ValueError) as err:
+                status = type(err).__name__
+            result['status'][status] = result['status'].get(status, 0) + 1
+            if status == 200:
+                result['latencies'].append(time.perf_counter() - start)
+            else:
+                result['errors'] += 1
+
+    async def run(self):
+        args = self.args
+        queue = asyncio.Queue(maxsize=args.concurrency * 2)
+        clients = [asyncio.ensure_future(self.client(queue)) for _ in range(args.concurrency)]
+        start = time.perf_counter()
+        end = start + args.duration
+        sent = 0
+        while time.perf_counter() < end:
+            if args.rps > 0:
+                # 一定の間隔でリクエストを出す
+                scheduled = start + sent / args.rps
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await queue.put(scheduled)
+            else:
+                await queue.put(0.0)
+            sent += 1
+        for _ in clients:
+            await queue.put(None)
+        await asyncio.gather(*clients)
+        return time.perf_counter() - start
+
+    def report(self, elapsed):
+        total = {'requests': 0, 'errors': 0}
+        endpoints = {}
+        for path, result in self.results.items():
+            latencies = sorted(result['latencies'])
+            requests = len(latencies) + result['errors']
+            total['requests'] += requests
+            total['errors'] += result['errors']
+            endpoints[path] = {
+                'requests': requests,
+                'rps': requests / elapsed,
+                'error_rate': result['errors'] / requests if requests else 0.0,
+                'status': {str(k): v for k, v in result['status'].items()},
+                'p50_ms': ms(percentile(latencies, 50)),
+                'p95_ms': ms(percentile(latencies, 95)),
+                'p99_ms': ms(percentile(latencies, 99)),
+                'max_ms': ms(latencies[-1] if latencies else None),
+            }
+        total['rps'] = total['requests'] / elapsed
+        total['error_rate'] = total['errors'] / total['requests'] if total['requests'] else 0.0
+        return {'elapsed': elapsed, 'concurrency': self.args.concurrency, 'target_rps': self.args.rps,
+                'total': total, 'endpoints': endpoints}
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+def print_report(report):
+    total = report['total']
+    print(f'{total["requests"]} requests in {report["elapsed"]:.1f}s, '
+          f'{total["rps"]:.1f} req/s, error rate {total["error_rate"]:.2%}')
+    print(f'{"endpoint":<20}{"req":>8}{"req/s":>9}{"err%":>8}{"p50ms":>9}{"p95ms":>9}{"p99ms":>9}{"maxms":>9}  status')
+    for path, e in report['endpoints'].items():
+        cols = [e['p50_ms'], e['p95_ms'], e['p99_ms'], e['max_ms']]
+        cols = ''.join(f'{"-" if c is None else c:>9}' for c in cols)
+        print(f'{path:<20}{e["requests"]:>8}{e["rps"]:>9.1f}{e["error_rate"]:>8.2%}{cols}  {e["status"]}')
+
+def raise_file_limit():
+    """
+    同時接続数の分だけファイルディスクリプタを使えるようにする
+    """
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="load generator for the blockchain api")
+    parser.add_argument('--url', type=str, default='http://localhost:5000')
+    parser.add_argument('--mix', type=str, default='/transactions/new=50,/transactions/add=30,/chain=18,/mine=1,/nodes/resolve=1',
+                        help='request mix as <path>=<weight>,...')
+    parser.add_argument('--concurrency', type=int, default=100, help='concurrent keep-alive connections')
+    parser.add_argument('--rps', type=float, default=0, help='target requests per second (0: as fast as possible)')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to send requests')
+    parser.add_argument('--timeout', type=float, default=30.0, help='timeout of each request (sec)')
+    parser.add_argument('--key', type=str, default='key.pem', help='key used to pre-sign transactions for /transactions/add')
+    parser.add_argument('--presign', type=int, default=10000, help='number of pre-signed transactions')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args()
+    raise_file_limit()
+    try:
+        generator = LoadGenerator(args)
+    except (OSError, ValueError) as err:
+        parser.error(str(err))
+    elapsed = asyncio.run(generator.run())
+    report = generator.report(elapsed)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,389 @@
+import argparse
+import contextlib
+import heapq
+import io
+import json
+import os
+import random
+import sys
+from urllib.parse import urlparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from blockchain import Blockchain, Transaction
+from peers import PeerManager, PeerError
+from validation import ChainValidator
+from bloom import SeenFilter
+from compact import CompactBlockError, compact_block
+from producer import mine_block
+
+# 返事を待たずに送るリクエスト (届くのはlatency秒後)
+GOSSIP_PATHS = ('/transactions/add', '/blocks/compact')
+
+class VirtualClock():
+    """
+    シミュレータの仮想時計
+    イベントの処理中に返事を待つリクエストを送ると，その分だけ進む
+    """
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+class SimResponse():
+    """
+    requests.Responseの代わり
+    ノード間でオブジェクトを共有しないように本文はJSONの文字列で持つ
+    本文を読んだときにon_readを呼ぶ (ヘッダだけ見て閉じたものは通信量に数えない)
+    """
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = json.dumps(body).encode()
+        self.headers = {'Content-Type': 'application/json'}
+        self.headers.update(headers or {})
+        self.on_read = None
+
+    @property
+    def content(self):
+        if self.on_read is not None:
+            self.on_read(len(self.body))
+            self.on_read = None
+        return self.body
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        pass
+
+class SimTransport():
+    """
+    PeerManagerの通信路をシミュレータのネットワークに差し替える
+    """
+    parallel = False
+
+    def __init__(self, network, source):
+        self.network = network
+        self.source = source
+
+    def request(self, method, address, path, **kwargs):
+        return self.network.deliver(self.source, method, address, path, **kwargs)
+
+class SimNode():
+    """
+    シミュレータ上のノード
+    server.pyのうち，ノード間の通信で使うAPIだけを持つ
+    受け取ったトランザクションやブロックの検証はBlockchainのメソッドを使い，server.pyと同じ処理にする
+    """
+    def __init__(self, network, address, difficulty):
+        self.network = network
+        self.address = address
+        self.uuid = address.replace(':', '-')
+        self.key = f'key-{self.uuid}'
+        self.blockchain = Blockchain(
+            PeerManager(transport=SimTransport(network, address), clock=network.clock, timeout=network.timeout),
+            validator=ChainValidator(workers=1),
+            seen=SeenFilter(10000),
+            clock=network.clock,
+            difficulty=difficulty,
+        )
+
+    def handle(self, method, path, body=None, params=None):
+        blockchain = self.blockchain
+        params = params or {}
+        if method == 'GET' and path == '/handshake':
+            return SimResponse(200, {'uuid': self.uuid, 'key': self.key})
+        if method == 'GET' and path == '/nodes':
+            if 'since' not in params:
+                return SimResponse(200, blockchain.nodes)
+            limit = int(params['limit']) if 'limit' in params else None
+            nodes, cursor, truncated = blockchain.peers.since(float(params['since']), limit)
+            return SimResponse(200, {'nodes': nodes, 'cursor': cursor, 'truncated': truncated})
+        if method == 'GET' and path == '/chain':
+            chain = [dict(block) for block in blockchain.chain]
+            etag = f'"{blockchain.hash(blockchain.last_block)}"'
+            return SimResponse(200, {'chain': chain, 'length': blockchain.height}, {'ETag': etag})
+        if method == 'GET' and path == '/transactions':
+            return SimResponse(200, {'transactions': list(map(dict, blockchain.current_transactions))})
+        if method == 'POST' and path == '/transactions/add':
+            try:
+                length = blockchain.receive_transactions(body if isinstance(body, list) else [body])
+            except ValueError as err:
+                return SimResponse(400, {'message': str(err)})
+            return SimResponse(200, {'length': length})
+        if method == 'POST' and path == '/blocks/compact':
+            compact = body['block']
+            if f'block:{compact["hash"]}' in blockchain.seen:
+                return SimResponse(200, {'message': 'block already seen'})
+            try:
+                status = blockchain.receive_compact_block(compact, body['node'])
+            except (CompactBlockError, PeerError) as err:
+                return SimResponse(400, {'message': str(err)})
+            if status != 'invalid':
+                self.network.observe(self, compact['hash'])
+            if status in ('added', 'reorg'):
+                self.announce(blockchain.last_block)
+            return SimResponse(200, {'message': f'block {status}'})
+        if method == 'POST' and path.startswith('/blocks/') and path.endswith('/transactions'):
+            block = blockchain.get_block(int(path.split('/')[2]))
+            if block is None:
+                return SimResponse(404)
+            return SimResponse(200, {'transactions': [dict(block.transactions[p]) for p in body['positions']]})
+        return SimResponse(404)
+
+    def announce(self, block):
+        message = {'block': compact_block(block), 'node': self.address}
+        return self.blockchain.peers.broadcast('POST', '/blocks/compact', json=message)
+
+    def new_transaction(self, recipient, amount):
+        """
+        /transactions/newと同じく，トランザクションを作って隣のノードへ送る
+        """
+        timestamp = self.network.clock()
+        transaction = Transaction(self.uuid, recipient, amount, timestamp, f'sig-{self.uuid}-{timestamp}')
+        self.blockchain.new_transactions([transaction])
+        self.blockchain.seen_transaction(transaction)
+        self.blockchain.peers.broadcast('POST', '/transactions/add', json=dict(transaction))
+
+    def mine(self):
+        def reward():
+            timestamp = self.network.clock()
+            return Transaction('mining', self.uuid, 100, timestamp, f'sig-{self.uuid}-{timestamp}')
+        block = mine_block(self.blockchain, reward)
+        self.network.mined(self, block)
+        self.announce(block)
+        return block
+
+    def discover(self):
+        """
+        /get_other_nodesと同じく，隣のノードが知っているノードと，削除したノードにハンドシェイクする
+        """
+        return self.blockchain.peers.discover(exclude=self.address)
+
+    def resolve(self):
+        if self.blockchain.resolve_conflicts():
+            for block in self.blockchain.chain:
+                self.network.observe(self, self.blockchain.hash(block))
+
+class Network():
+    """
+    1つのプロセスの中でN個のノードを動かすイベント駆動のシミュレータ
+    遅延・パケットロス・ネットワーク分断を指定できる
+    """
+    def __init__(self, n, degree=8, latency=(0.05, 0.2), loss=0.0, timeout=3.0, difficulty=1, seed=None):
+        self.random = random.Random(seed)
+        self.clock = VirtualClock()
+        self.latency = latency
+        self.loss = loss
+        self.timeout = timeout
+        self.events = []
+        self.sequence = 0
+        self.groups = None
+        # 計測値
+        self.traffic = {}
+        self.messages = 0
+        self.dropped = 0
+        self.blocks = {} # {hash: (採掘した時刻, 採掘したノード)}
+        self.arrivals = {} # {hash: {address: 届いた時刻}}
+        self.nodes = {}
+        for i in range(n):
+            address = f'10.0.{i // 256}.{i % 256}:5000'
+            self.nodes[address] = SimNode(self, address, difficulty)
+        # ランダムにdegree本ずつ双方向につなぐ
+        addresses = list(self.nodes)
+        for address in addresses:
+            for other in self.random.sample(addresses, min(degree, n - 1) + 1):
+                if other != address:
+                    self.connect(address, other)
+
+    def connect(self, a, b):
+        for x, y in ((a, b), (b, a)):
+            node = self.nodes[y]
+            self.nodes[x].blockchain.peers.add(y, node.uuid, node.key)
+
+    def partition(self, groups):
+        """
+        groupsに分けたノードどうしの通信をできなくする
+        """
+        self.groups = {address: k for k, group in enumerate(groups) for address in group}
+
+    def heal(self):
+        self.groups = None
+
+    def reachable(self, a, b):
+        return self.groups is None or self.groups.get(a) == self.groups.get(b)
+
+    def delay(self):
+        low, high = self.latency
+        return self.random.uniform(low, high)
+
+    def schedule(self, delay, fn, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.clock() + delay, self.sequence, fn, args))
+
+    def run(self, until):
+        """
+        until秒までイベントを順に処理する
+        """
+        while self.events and self.events[0][0] <= until:
+            at, _, fn, args = heapq.heappop(self.events)
+            self.clock.now = at
+            fn(*args)
+        self.clock.now = until
+
+    def deliver(self, source, method, address, path, json=None, data=None, params=None, **kwargs):
+        """
+        ノードへのリクエストを届ける
+        GOSSIP_PATHSへのPOSTはlatency秒後に届け，すぐに成功を返す
+        それ以外は往復の遅延だけ時計を進めて返事を返す
+        """
+        path, query = self.split(path, params)
+        node = self.nodes.get(address)
+        if node is None or not self.reachable(source, address) or self.random.random() < self.loss:
+            self.dropped += 1
+            raise PeerError(f'{address}: unreachable')
+        self.messages += 1
+        size = len(data) if data is not None else len(dumps(json))
+        self.count(path, size)
+        if method == 'POST' and path in GOSSIP_PATHS:
+            self.schedule(self.delay(), node.handle, method, path, json, query)
+            return SimResponse(200, {'message': 'queued'})
+        self.clock.advance(self.delay())
+        response = node.handle(method, path, json, query)
+        self.clock.advance(self.delay())
+        response.on_read = lambda size: self.count(path, size)
+        return response
+
+    @staticmethod
+    def split(path, params):
+        url = urlparse(path)
+        query = dict(p.split('=', 1) for p in url.query.split('&') if p)
+        query.update(params or {})
+        return url.path, query
+
+    def count(self, path, size):
+        key = '/blocks/<index>/transactions' if path.endswith('/transactions') and path.startswith('/blocks/') else path
+        self.traffic[key] = self.traffic.get(key, 0) + size
+
+    def mined(self, node, block):
+        block_hash = node.blockchain.hash(block)
+        self.blocks[block_hash] = (self.clock(), node.address)
+        self.observe(node, block_hash)
+
+    def observe(self, node, block_hash):
+        self.arrivals.setdefault(block_hash, {}).setdefault(node.address, self.clock())
+
+    def metrics(self):
+        """
+        伝播時間・フォーク率・同期にかかった通信量
+        """
+        n = len(self.nodes)
+        best = max(self.nodes.values(), key=lambda node: node.blockchain.height).blockchain
+        main = set(best.hashes)
+        stale = [h for h in self.blocks if h not in main]
+        delays = {50: [], 90: [], 100: []}
+        for block_hash, (mined_at, _) in self.blocks.items():
+            times = sorted(self.arrivals.get(block_hash, {}).values())
+            for p in delays:
+                k = -(-n * p // 100)
+                if len(times) >= k:
+                    delays[p].append(times[k - 1] - mined_at)
+        heights = [node.blockchain.height for node in self.nodes.values()]
+        return {
+            'nodes': n,
+            'time': self.clock(),
+            'blocks_mined': len(self.blocks),
+            'height': best.height,
+            'stale_blocks': len(stale),
+            'fork_rate': len(stale) / len(self.blocks) if self.blocks else 0.0,
+            'in_sync': sum(1 for node in self.nodes.values() if node.blockchain.last_block.digest() == best.last_block.digest()),
+            'min_height': min(heights),
+            'propagation': {f'p{p}_nodes': summary(values) for p, values in delays.items()},
+            'messages': self.messages,
+            'dropped': self.dropped,
+            'bytes': sum(self.traffic.values()),
+            'traffic': self.traffic,
+        }
+
+def dumps(body):
+    return json.dumps(body).encode() if body is not None else b''
+
+def summary(values):
+    """
+    ブロックごとの伝播時間の平均と分位点
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        'blocks': len(values),
+        'mean': sum(values) / len(values),
+        'p50': values[len(values) // 2],
+        'p90': values[min(len(values) - 1, len(values) * 9 // 10)],
+        'max': values[-1],
+    }
+
+def simulate(args):
+    network = Network(args.nodes, args.degree, (args.latency_min, args.latency_max), args.loss,
+                      difficulty=args.difficulty, seed=args.seed)
+    addresses = list(network.nodes)
+    rng = network.random
+
+    # トランザクションとマイニングはポアソン過程で起こす
+    def transaction():
+        node = network.nodes[rng.choice(addresses)]
+        node.new_transaction(rng.choice(addresses), rng.randint(1, 100))
+        network.schedule(rng.expovariate(args.tx_rate), transaction)
+    def mine():
+        network.nodes[rng.choice(addresses)].mine()
+        network.schedule(rng.expovariate(1 / args.block_interval), mine)
+    def resolve(address):
+        network.nodes[address].resolve()
+        network.schedule(args.resolve_interval, resolve, address)
+    def discover(address):
+        network.nodes[address].discover()
+        network.schedule(args.discover_interval, discover, address)
+    if args.tx_rate > 0:
+        network.schedule(rng.expovariate(args.tx_rate), transaction)
+    network.schedule(rng.expovariate(1 / args.block_interval), mine)
+    if args.resolve_interval > 0:
+        for address in addresses:
+            network.schedule(rng.uniform(0, args.resolve_interval), resolve, address)
+    if args.discover_interval > 0:
+        for address in addresses:
+            network.schedule(rng.uniform(0, args.discover_interval), discover, address)
+    if args.partition_at is not None:
+        half = len(addresses) // 2
+        network.schedule(args.partition_at, network.partition, [addresses[:half], addresses[half:]])
+        if args.heal_at is not None:
+            network.schedule(args.heal_at, network.heal)
+    network.run(args.duration)
+    return network.metrics()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="in-process blockchain network simulator")
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--degree', type=int, default=8, help='peers each node connects to')
+    parser.add_argument('--duration', type=float, default=600.0, help='virtual seconds to simulate')
+    parser.add_argument('--block-interval', type=float, default=10.0, help='mean seconds between blocks in the whole network')
+    parser.add_argument('--tx-rate', type=float, default=5.0, help='transactions per second in the whole network')
+    parser.add_argument('--resolve-interval', type=float, default=60.0, help='seconds between /nodes/resolve of each node (0: never)')
+    parser.add_argument('--discover-interval', type=float, default=30.0, help='seconds between /get_other_nodes of each node (0: never)')
+    parser.add_argument('--latency-min', type=float, default=0.05)
+    parser.add_argument('--latency-max', type=float, default=0.2)
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that a request is lost')
+    parser.add_argument('--partition-at', type=float, default=None, help='split the network in two at this time')
+    parser.add_argument('--heal-at', type=float, default=None, help='reconnect the network at this time')
+    parser.add_argument('--difficulty', type=int, default=1, help='leading zeros of the proof of work')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the nodes')
+    args = parser.parse_args()
+    if args.verbose:
+        metrics = simulate(args)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            metrics = simulate(args)
+    print(json.dumps(metrics, indent=2))
@@ -0,0 +1,172 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from blockchain import Blockchain, Block, Transaction
+
+DIFFICULTY = 1
+
+def mine(parent: Block, transactions=(), timestamp: float = 0.0) -> Block:
+    """
+    parentにつながるブロックを作る (チェーンには追加しない)
+    """
+    proof = 0
+    while not Blockchain.valid_proof(parent.proof, proof, DIFFICULTY):
+        proof += 1
+    return Block(parent.index + 1, timestamp, list(transactions), proof, parent.digest())
+
+def transaction(n: int) -> Transaction:
+    return Transaction(f'sender-{n}', f'recipient-{n}', n, float(n), f'sig-{n}')
+
+class FromDictTest(unittest.TestCase):
+    def test_round_trip(self):
+        block = Block(2, 1.5, [transaction(1), transaction(2)], 7, 'abc')
+        copied = Block.from_dict(dict(block))
+        self.assertEqual(copied.digest(), block.digest())
+        self.assertEqual([t.txid() for t in copied.transactions], [t.txid() for t in block.transactions])
+
+    def test_optional_fields(self):
+        t = Transaction.from_dict({'sender': 'a', 'recipient': 'b', 'amount': 1})
+        self.assertIsNone(t.timestamp)
+        self.assertIsNone(t.signature)
+
+    def test_missing_field(self):
+        with self.assertRaises(KeyError):
+            Block.from_dict({'index': 2, 'timestamp': 0.0, 'proof': 1, 'previous_hash': 'abc'})
+
+class AcceptBlockTest(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain(difficulty=DIFFICULTY, max_orphans=4)
+        self.genesis = self.blockchain.last_block
+
+    def test_append(self):
+        block = mine(self.genesis)
+        self.assertEqual(self.blockchain.accept_block(block), 'added')
+        self.assertEqual(self.blockchain.accept_block(block), 'duplicate')
+        self.assertEqual(self.blockchain.height, 2)
+
+    def test_invalid_index(self):
+        block = mine(self.genesis)
+        block.index = 10
+        self.assertEqual(self.blockchain.accept_block(block), 'invalid')
+        self.assertEqual(self.blockchain.height, 1)
+
+    def test_invalid_transaction(self):
+        bad = Transaction('sender', 'recipient', 'lots', 1.0, 'sig')
+        block = mine(self.genesis, [transaction(1), bad])
+        self.assertEqual(self.blockchain.accept_block(block), 'invalid')
+        # 親が届いていなくても孤立ブロックとして保持しない
+        self.assertEqual(self.blockchain.accept_block(mine(mine(self.genesis), [bad])), 'invalid')
+        self.assertEqual(len(self.blockchain.orphans), 0)
+        self.assertEqual(self.blockchain.height, 1)
+
+    def test_integer_timestamp(self):
+        # バイナリ形式にするとハッシュ値が変わる
+        block = mine(self.genesis)
+        block.timestamp = 5
+        self.assertEqual(self.blockchain.accept_block(block), 'invalid')
+
+    def test_valid_chain_checks_transactions(self):
+        good = mine(self.genesis, [transaction(1)], timestamp=1.0)
+        chain = [dict(self.genesis), dict(good)]
+        self.assertTrue(self.blockchain.valid_chain(chain))
+        chain[1]['transactions'][0]['amount'] = 'lots'
+        self.assertFalse(self.blockchain.valid_chain(chain))
+
+    def test_orphans_are_attached_when_parent_arrives(self):
+        first = mine(self.genesis)
+        second = mine(first)
+        third = mine(second)
+        self.assertEqual(self.blockchain.accept_block(third), 'orphan')
+        self.assertEqual(self.blockchain.accept_block(second), 'orphan')
+        self.assertEqual(len(self.blockchain.orphans), 2)
+        self.assertEqual(self.blockchain.accept_block(first), 'added')
+        self.assertEqual(self.blockchain.height, 4)
+        self.assertEqual(self.blockchain.last_block.digest(), third.digest())
+        self.assertEqual(len(self.blockchain.orphans), 0)
+        self.assertEqual(self.blockchain.orphans_by_parent, {})
+
+    def test_orphan_limit(self):
+        parent = self.genesis
+        blocks = []
+        for _ in range(6):
+            parent = mine(parent)
+            blocks.append(parent)
+        for block in blocks[1:]:
+            self.assertEqual(self.blockchain.accept_block(block), 'orphan')
+        # 古いものから捨てられる
+        self.assertEqual(len(self.blockchain.orphans), 4)
+        self.assertNotIn(blocks[1].digest(), self.blockchain.orphans)
+
+    def test_reorganize_to_longer_branch(self):
+        pending = transaction(1)
+        confirmed = transaction(2)
+        main = mine(self.genesis, [pending, confirmed], timestamp=1.0)
+        self.assertEqual(self.blockchain.accept_block(main), 'added')
+        side = mine(self.genesis, [confirmed], timestamp=2.0)
+        self.assertEqual(self.blockchain.accept_block(side), 'side')
+        self.assertEqual(self.blockchain.last_block.digest(), main.digest())
+        tip = mine(side, timestamp=3.0)
+        self.assertEqual(self.blockchain.accept_block(tip), 'reorg')
+        self.assertEqual([b.digest() for b in self.blockchain.chain], [self.genesis.digest(), side.digest(), tip.digest()])
+        self.assertIn(main.digest(), self.blockchain.side_blocks)
+        # 外れたブロックだけにあったトランザクションは未承認に戻る
+        self.assertEqual([t.txid() for t in self.blockchain.current_transactions], [pending.txid()])
+
+    def test_child_of_evicted_side_block(self):
+        self.blockchain.max_side_blocks = 1
+        self.blockchain.accept_block(mine(self.genesis, timestamp=1.0))
+        side = mine(self.genesis, timestamp=2.0)
+        self.assertEqual(self.blockchain.accept_block(side), 'side')
+        # 兄弟の枝を受け取ってsideが捨てられる
+        other = mine(self.genesis, timestamp=3.0)
+        self.assertEqual(self.blockchain.accept_block(other), 'side')
+        self.assertNotIn(side.digest(), self.blockchain.side_blocks)
+        # sideの子は孤立ブロックになり，チェーンは変わらない
+        child = mine(side, timestamp=4.0)
+        self.assertEqual(self.blockchain.accept_block(child), 'orphan')
+        self.assertEqual(self.blockchain.height, 2)
+
+    def test_reorganize_with_evicted_grandparent(self):
+        self.blockchain.max_side_blocks = 2
+        self.blockchain.accept_block(mine(self.genesis, timestamp=1.0))
+        side = mine(self.genesis, timestamp=2.0)
+        child = mine(side, timestamp=3.0)
+        self.blockchain.side_blocks[side.digest()] = side
+        self.blockchain.side_blocks[child.digest()] = child
+        # 枝の途中の祖先が捨てられていても例外にならない
+        del self.blockchain.side_blocks[side.digest()]
+        grandchild = mine(child, timestamp=4.0)
+        self.assertEqual(self.blockchain.accept_block(grandchild), 'side')
+        self.assertEqual(self.blockchain.height, 2)
+
+class MempoolTest(unittest.TestCase):
+    def test_take_while_adding(self):
+        # 受け付けのスレッドが追加している間にブロックを作っても壊れない
+        blockchain = Blockchain(difficulty=DIFFICULTY)
+        errors = []
+        def add(offset):
+            try:
+                for n in range(2000):
+                    blockchain.new_transactions([transaction(offset + n)])
+            except Exception as err:
+                errors.append(err)
+        threads = [threading.Thread(target=add, args=(i * 10000,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        taken = []
+        while any(thread.is_alive() for thread in threads):
+            taken += blockchain.current_transactions.take(max_count=50, max_bytes=1 << 20)
+        for thread in threads:
+            thread.join()
+        taken += blockchain.current_transactions.take()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(taken), 8000)
+        self.assertEqual(len(set(t.txid() for t in taken)), 8000)
+        self.assertEqual(blockchain.current_transactions.bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
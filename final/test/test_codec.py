@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from blockchain import Blockchain, Block, Transaction
+from codec import decode_blocks, decode_transactions, encode_block, encode_blocks, encode_transactions, validate_transaction
+
+DIFFICULTY = 1
+
+def values(**overrides) -> dict:
+    transaction = {'sender': 'alice', 'recipient': 'bob', 'amount': 5, 'timestamp': 1.5, 'signature': 'c2ln'}
+    transaction.update(overrides)
+    return transaction
+
+class RoundTripTest(unittest.TestCase):
+    def test_block(self):
+        blockchain = Blockchain(difficulty=DIFFICULTY)
+        blockchain.new_transactions([Transaction.from_dict(values(amount=n, timestamp=float(n))) for n in range(3)])
+        blockchain.new_block(blockchain.proof_of_work(blockchain.last_block.proof))
+        data = encode_blocks([encode_block(dict(block)) for block in blockchain.chain])
+        decoded = decode_blocks(data)
+        # ジェネシスブロックも含めてハッシュ値が変わらない
+        for block, values_ in zip(blockchain.chain, decoded):
+            self.assertEqual(Blockchain.hash(values_), block.digest())
+            self.assertEqual(Block.from_dict(values_).digest(), block.digest())
+
+    def test_transactions(self):
+        transactions = [values(amount=n) for n in range(3)]
+        self.assertEqual(decode_transactions(encode_transactions(transactions)), transactions)
+
+class ValidateTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(validate_transaction(values(), signed=True), values())
+
+    def test_unsigned_amount_is_normalised(self):
+        self.assertEqual(validate_transaction({'sender': 'a', 'recipient': 'b', 'amount': '5'}, signed=False)['amount'], 5)
+
+    def test_changed_by_binary(self):
+        # バイナリ形式を通すとハッシュ値が変わるものは受け付けない
+        for bad in [values(timestamp=5), values(timestamp=True), values(timestamp=float('nan')),
+                    values(signature=''), values(signature=None), values(amount='5'), values(amount=5.0),
+                    values(sender=5)]:
+            with self.assertRaises(ValueError):
+                validate_transaction(bad, signed=True)
+
+    def test_binary_range(self):
+        with self.assertRaises(ValueError):
+            validate_transaction(values(amount=1 << 63), signed=True)
+        with self.assertRaises(ValueError):
+            validate_transaction(values(sender='a' * 0x10000), signed=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import struct
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from dns import DNS, DNSError, TYPE_A, TYPE_AAAA, TYPE_SRV, TYPE_TXT
+from dns_server import StubDNSServer
+
+RECORDS = {
+    'seed.example': [
+        {'type': 'A', 'data': '127.0.0.1'},
+        {'type': 'A', 'data': '127.0.0.2'},
+        {'type': 'AAAA', 'data': '::1'},
+        {'type': 'TXT', 'data': ['hello', 'world']},
+    ],
+    '_node._tcp.seed.example': [{'type': 'SRV', 'data': [10, 5, 5000, 'node.seed.example']}],
+    'node.seed.example': [{'type': 'A', 'data': '127.0.0.3'}],
+    'alias.example': [{'type': 'CNAME', 'data': 'node.seed.example'}],
+}
+
+def response(rtype: int, rdata: bytes) -> bytes:
+    """
+    seed.exampleのレコードを1つだけ持つ応答パケットを作る
+    """
+    name = b'\x04seed\x07example\x00'
+    header = struct.pack('!HHHHHH', 1, 0x8400, 0, 1, 0, 0)
+    return header + name + struct.pack('!HHIH', rtype, 1, 60, len(rdata)) + rdata
+
+class RoundTripTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubDNSServer(RECORDS).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_a(self):
+        records = DNS.lookup('seed.example', TYPE_A, self.server.address)
+        self.assertEqual([r.data for r in records], ['127.0.0.1', '127.0.0.2'])
+
+    def test_aaaa(self):
+        records = DNS.lookup('seed.example', TYPE_AAAA, self.server.address)
+        self.assertEqual([r.data for r in records], ['::1'])
+
+    def test_txt(self):
+        records = DNS.lookup('seed.example', TYPE_TXT, self.server.address)
+        self.assertEqual(records[0].data, ['hello', 'world'])
+
+    def test_srv(self):
+        response = DNS.query('_node._tcp.seed.example', TYPE_SRV, self.server.address)
+        self.assertEqual(response.answers[0].data, (10, 5, 5000, 'node.seed.example'))
+        # 対象のAレコードは追加セクションに入る
+        self.assertEqual([r.data for r in response.additionals], ['127.0.0.3'])
+
+    def test_cname(self):
+        records = DNS.lookup('alias.example', TYPE_A, self.server.address)
+        self.assertEqual([r.data for r in records], ['127.0.0.3'])
+
+    def test_nxdomain(self):
+        with self.assertRaises(DNSError):
+            DNS.query('missing.example', TYPE_A, self.server.address)
+
+class MalformedTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEqual(DNS.from_bytes(response(TYPE_A, bytes([127, 0, 0, 1]))).answers[0].data, '127.0.0.1')
+
+    def test_short_address(self):
+        with self.assertRaises(DNSError):
+            DNS.from_bytes(response(TYPE_A, b'\x7f\x00\x00'))
+        with self.assertRaises(DNSError):
+            DNS.from_bytes(response(TYPE_AAAA, bytes(15)))
+
+    def test_short_srv(self):
+        with self.assertRaises(DNSError):
+            DNS.from_bytes(response(TYPE_SRV, b'\x00\x0a\x00'))
+
+    def test_txt_overrun(self):
+        with self.assertRaises(DNSError):
+            DNS.from_bytes(response(TYPE_TXT, b'\x09abc'))
+
+    def test_invalid_utf8(self):
+        with self.assertRaises(DNSError):
+            DNS.from_bytes(response(TYPE_TXT, b'\x02\xff\xfe'))
+        packet = bytearray(response(TYPE_A, bytes(4)))
+        packet[13] = 0xff
+        with self.assertRaises(DNSError):
+            DNS.from_bytes(bytes(packet))
+
+    def test_truncated(self):
+        packet = response(TYPE_A, bytes(4))
+        for length in range(len(packet)):
+            with self.assertRaises(DNSError):
+                DNS.from_bytes(packet[:length])
+
+    def test_compression_loop(self):
+        header = struct.pack('!HHHHHH', 1, 0x8400, 0, 1, 0, 0)
+        with self.assertRaises(DNSError):
+            DNS.from_bytes(header + b'\xc0\x0c' + struct.pack('!HHIH', TYPE_A, 1, 60, 4) + bytes(4))
+
+if __name__ == '__main__':
+    unittest.main()
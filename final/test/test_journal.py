@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from blockchain import Transaction
+from journal import MempoolJournal
+from mempool import Mempool
+
+def transaction(n: int) -> Transaction:
+    return Transaction(f'sender-{n}', f'recipient-{n}', n, float(n), f'sig-{n}')
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'mempool.journal')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, transactions, removed=()):
+        """
+        トランザクションを追加・削除してjournalに書き込み，閉じる
+        """
+        journal = MempoolJournal(self.path)
+        mempool = Mempool(journal.replay())
+        journal.attach(mempool)
+        mempool.extend(transactions)
+        mempool.remove([t.txid() for t in removed])
+        self.assertTrue(mempool.sync(timeout=5))
+        journal.close()
+
+    def replay(self):
+        return [t.txid() for t in MempoolJournal(self.path).replay()]
+
+    def test_missing_file(self):
+        self.assertEqual(self.replay(), [])
+
+    def test_add_and_remove(self):
+        transactions = [transaction(n) for n in range(4)]
+        self.write(transactions, removed=transactions[1:2])
+        self.assertEqual(self.replay(), [t.txid() for t in transactions if t is not transactions[1]])
+
+    def test_torn_last_line(self):
+        transactions = [transaction(n) for n in range(3)]
+        self.write(transactions)
+        # 追加のレコードを書いている途中で落ちた
+        record = MempoolJournal.encode(transaction(3))
+        with open(self.path, 'ab') as f:
+            f.write(record[:len(record) // 2])
+        self.assertEqual(self.replay(), [t.txid() for t in transactions])
+
+    def test_torn_remove(self):
+        transactions = [transaction(n) for n in range(3)]
+        self.write(transactions)
+        # 削除のレコードが途中までしか書かれていなければ削除しない
+        with open(self.path, 'ab') as f:
+            f.write(('-' + transactions[0].txid()).encode())
+        self.assertEqual(self.replay(), [t.txid() for t in transactions])
+
+    def test_attach_drops_torn_line(self):
+        self.write([transaction(0)])
+        with open(self.path, 'ab') as f:
+            f.write(b'+abc {"sender": ')
+        # 読み直したあとの書き込みが壊れた行につながらない
+        self.write([transaction(1)])
+        self.assertEqual(self.replay(), [transaction(0).txid(), transaction(1).txid()])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from peers import PeerManager, PeerError
+
+class Response():
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        return self.body
+
+class FakeTransport():
+    """
+    down に入っているノードには接続できない
+    """
+    parallel = False
+
+    def __init__(self):
+        self.down = set()
+
+    def request(self, method, address, path, **kwargs):
+        if address in self.down:
+            raise PeerError(f'{address}: unreachable')
+        if path == '/handshake':
+            return Response(200, {'uuid': address, 'key': 'key'})
+        if path == '/nodes':
+            return Response(200, {'nodes': {}, 'cursor': 0.0, 'truncated': False})
+        return Response(200, {})
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.transport = FakeTransport()
+        self.peers = PeerManager(max_failures=2, transport=self.transport, clock=lambda: self.now, evicted_backoff=100.0)
+        self.assertEqual(self.peers.connect_all(['a:1', 'b:1']), 2)
+
+    def evict(self, address):
+        self.transport.down.add(address)
+        for _ in range(self.peers.max_failures):
+            self.now += self.peers.max_backoff
+            self.peers.broadcast('POST', '/transactions/add')
+
+    def test_evicted_after_failures(self):
+        self.evict('a:1')
+        self.assertNotIn('a:1', self.peers)
+        self.assertIn('b:1', self.peers)
+
+    def test_retried_after_backoff(self):
+        self.evict('a:1')
+        self.transport.down.clear()
+        # 間隔があくまでは問い合わせない
+        self.assertEqual(self.peers.discover(), 0)
+        self.now += 100.0
+        self.assertEqual(self.peers.discover(), 1)
+        self.assertIn('a:1', self.peers)
+        self.assertNotIn('a:1', self.peers.evicted)
+
+    def test_failed_retry_waits_again(self):
+        self.evict('a:1')
+        self.now += 100.0
+        self.assertEqual(self.peers.discover(), 0)
+        self.transport.down.clear()
+        self.assertEqual(self.peers.discover(), 0)
+        self.now += 100.0
+        self.assertEqual(self.peers.discover(), 1)
+
+    def test_retried_without_neighbours(self):
+        # 全てのノードを削除していても，つながり直せる
+        self.evict('a:1')
+        self.evict('b:1')
+        self.assertEqual(len(self.peers), 0)
+        self.transport.down.clear()
+        self.now += 100.0
+        self.assertEqual(self.peers.discover(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
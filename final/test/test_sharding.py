@@ -0,0 +1,65 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from sharding import ShardedMempool, ShardError, shard_of
+
+SHARDS = 2
+
+def transaction(n: int, sender: str = None) -> dict:
+    return {'sender': sender or f'sender-{n}', 'recipient': f'recipient-{n}', 'amount': n, 'timestamp': float(n), 'signature': f'sig-{n}'}
+
+def senders():
+    """
+    シャードごとに1つずつ送信者を選ぶ
+    """
+    found = {}
+    n = 0
+    while len(found) < SHARDS:
+        found.setdefault(shard_of(f'sender-{n}', SHARDS), f'sender-{n}')
+        n += 1
+    return [found[i] for i in range(SHARDS)]
+
+class ShardedMempoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mempool = ShardedMempool(SHARDS)
+        cls.senders = senders()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mempool.close()
+
+    def setUp(self):
+        self.mempool.reset()
+
+    def test_add(self):
+        values = [transaction(1, self.senders[0]), transaction(2, self.senders[1])]
+        self.assertEqual(self.mempool.add(values), 2)
+        # 処理済みのものと，同じリクエストの中の重複は捨てる
+        self.assertEqual(self.mempool.add(values + [transaction(3), transaction(3)]), 1)
+        self.assertEqual(len(self.mempool), 3)
+
+    def test_invalid_transaction_adds_nothing(self):
+        # 正しいものと不正なものが別のシャードに入る
+        values = [transaction(1, self.senders[0]), dict(transaction(2, self.senders[1]), amount='lots')]
+        with self.assertRaises(ValueError):
+            self.mempool.add(values)
+        self.assertEqual(len(self.mempool), 0)
+        # 捨てたものは処理済みにもならない
+        self.assertEqual(self.mempool.add(values[:1]), 1)
+
+    def test_dead_shard(self):
+        self.mempool.add([transaction(1, self.senders[0])])
+        shard = self.mempool.shards[0]
+        shard.process.kill()
+        shard.process.join()
+        with self.assertRaises(ShardError):
+            self.mempool.add([transaction(2, self.senders[0]), transaction(3, self.senders[1])])
+        # 生きていたシャードにも追加しない
+        self.assertEqual(len(self.mempool), 0)
+        self.assertEqual(self.mempool.add([transaction(2, self.senders[0]), transaction(3, self.senders[1])]), 2)
+
+if __name__ == '__main__':
+    unittest.main()
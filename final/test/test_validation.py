@@ -0,0 +1,47 @@
+import copy
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'core'))
+from blockchain import Blockchain
+from validation import ChainValidator
+
+DIFFICULTY = 1
+
+class ChainValidatorTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        blockchain = Blockchain(difficulty=DIFFICULTY)
+        for _ in range(40):
+            blockchain.new_block(blockchain.proof_of_work(blockchain.last_block.proof))
+        cls.chain = [dict(b) for b in blockchain.chain]
+
+    def setUp(self):
+        self.validator = ChainValidator(workers=2, chunk_size=8, min_parallel=10)
+
+    def tearDown(self):
+        self.validator.close()
+
+    def test_valid(self):
+        self.assertEqual(self.validator.validate(self.chain, 0, DIFFICULTY), (None, None))
+
+    def test_unexpected_index(self):
+        chain = copy.deepcopy(self.chain)
+        # チャンクの境界のブロック
+        chain[16]['index'] = 1000
+        self.assertEqual(self.validator.validate(chain, 0, DIFFICULTY)[1], 'unexpected index')
+        self.assertEqual(ChainValidator(workers=1).validate(chain[:17], 0, DIFFICULTY), (1000, 'unexpected index'))
+
+    def test_worker_died(self):
+        self.validator.validate(self.chain, 0, DIFFICULTY)
+        for process in list(self.validator.executor._processes.values()):
+            process.kill()
+            process.join()
+        # 落ちたプールでもこのプロセスで検証し，次は作り直したプールを使う
+        self.assertEqual(self.validator.validate(self.chain, 0, DIFFICULTY), (None, None))
+        self.assertEqual(self.validator.validate(self.chain, 0, DIFFICULTY), (None, None))
+        self.assertIsNotNone(self.validator.executor)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,25 @@
-from Crypto.PublicKey import RSA
+import argparse
+from Crypto.PublicKey import RSA, ECC
 
-privatekey = RSA.generate(2048)
-f = open('key.pem', 'wb')
-f.write(privatekey.exportKey('PEM'))
+parser = argparse.ArgumentParser(description="generate key pair")
+parser.add_argument('--type', type=str, default='rsa', choices=['rsa', 'ed25519'])
+parser.add_argument('--out', type=str, default='key.pem')
+args = parser.parse_args()
+
+if args.type == 'ed25519':
+    # Ed25519は署名が64byteで，RSAより署名・検証が速い
+    privatekey = ECC.generate(curve='ed25519')
+    private_pem = privatekey.export_key(format='PEM').encode()
+    public_pem = privatekey.public_key().export_key(format='PEM').encode()
+else:
+    privatekey = RSA.generate(2048)
+    private_pem = privatekey.exportKey('PEM')
+    public_pem = privatekey.publickey().exportKey('PEM')
+
+f = open(args.out, 'wb')
+f.write(private_pem)
 f.close()
 
-f = open('key.pem.pub', 'wb')
-f.write(privatekey.publickey().exportKey('PEM'))
-f.close()
\ No newline at end of file
+f = open(args.out + '.pub', 'wb')
+f.write(public_pem)
+f.close()